@@ -0,0 +1,294 @@
+# SPDX-FileCopyrightText: 2024 Dragorn421
+# SPDX-License-Identifier: CC0-1.0
+
+"""
+On-demand profiling of the running bot (/profile), returning text reports,
+and continuous monitoring of the event loop's lag.
+"""
+
+import asyncio
+import cProfile
+import collections
+import io
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+
+import zoometrics
+
+
+# What the reports focus on, after the overall top
+FOCUS_PSTATS_RE = r"zoopeeker\.py|zooapi\.py|pycpp\.py|render_datapeek"
+FOCUS_FUNCTION_RE = re.compile(r"^(zoopeeker|zooapi|pycpp)\.|\.?render_datapeek$")
+
+N_TOP = 40
+
+session_lock = asyncio.Lock()
+"""One profiling session at a time, they would skew each other"""
+
+
+async def profile_cprofile(seconds: float):
+    """
+    Profiles the event loop thread (where commands and rendering run),
+    cProfile only sees the thread that enables it.
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+
+    out = io.StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE)
+    out.write(f"cProfile of the event loop thread for {seconds} s\n\n")
+    out.write(f"Top {N_TOP} by cumulative time:\n")
+    stats.print_stats(N_TOP)
+    out.write(f"Top {N_TOP} by cumulative time in {FOCUS_PSTATS_RE}:\n")
+    stats.print_stats(FOCUS_PSTATS_RE, N_TOP)
+    return out.getvalue()
+
+
+def _function_name(frame):
+    return f"{frame.f_globals.get('__name__', '?')}.{frame.f_code.co_qualname}"
+
+
+def sample_threads(seconds: float, interval: float = 0.005):
+    """
+    Samples the stacks of all threads every interval for seconds (blocking).
+    Unlike cProfile it sees every thread (writer, refresher...) and costs little.
+    """
+    sampler_thread_id = threading.get_ident()
+    n_samples = 0
+    self_counts: collections.Counter[str] = collections.Counter()
+    cumulative_counts: collections.Counter[str] = collections.Counter()
+    thread_sample_counts: collections.Counter[int] = collections.Counter()
+    location_by_function: dict[str, str] = dict()
+
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == sampler_thread_id:
+                continue
+            thread_sample_counts[thread_id] += 1
+            self_counts[_function_name(frame)] += 1
+            on_stack = set()
+            while frame is not None:
+                function_name = _function_name(frame)
+                if function_name not in on_stack:
+                    on_stack.add(function_name)
+                    cumulative_counts[function_name] += 1
+                    location_by_function.setdefault(
+                        function_name,
+                        f"{frame.f_code.co_filename}:{frame.f_code.co_firstlineno}",
+                    )
+                frame = frame.f_back
+        n_samples += 1
+        time.sleep(interval)
+
+    thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+    n_thread_samples = sum(thread_sample_counts.values())
+
+    out = io.StringIO()
+    out.write(
+        f"Sampled all threads every {interval * 1000:g} ms for {seconds} s,"
+        f" {n_samples} samples\n\n"
+    )
+    out.write("Threads (share of samples):\n")
+    for thread_id, count in thread_sample_counts.most_common():
+        out.write(
+            f"{count / n_samples:7.1%}  {thread_names.get(thread_id, thread_id)}\n"
+        )
+
+    def write_top(title, function_names):
+        out.write(f"\n{title}\n")
+        out.write("    cum%    self%  function\n")
+        for function_name in function_names[:N_TOP]:
+            out.write(
+                f"{cumulative_counts[function_name] / n_thread_samples:7.1%}"
+                f"  {self_counts[function_name] / n_thread_samples:7.1%}"
+                f"  {function_name} ({location_by_function[function_name]})\n"
+            )
+
+    by_cumulative = [
+        function_name for function_name, count in cumulative_counts.most_common()
+    ]
+    write_top(f"Top {N_TOP} by cumulative samples:", by_cumulative)
+    write_top(
+        f"Top {N_TOP} by cumulative samples in {FOCUS_FUNCTION_RE.pattern}:",
+        [
+            function_name
+            for function_name in by_cumulative
+            if FOCUS_FUNCTION_RE.search(function_name)
+        ],
+    )
+    return out.getvalue()
+
+
+async def profile_sampling(seconds: float):
+    return await asyncio.to_thread(sample_threads, seconds)
+
+
+async def profile_tracemalloc(seconds: float, n_frames: int = 10):
+    """Diffs the memory allocated over seconds, by allocation site"""
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start(n_frames)
+    try:
+        snapshot_before = await asyncio.to_thread(tracemalloc.take_snapshot)
+        await asyncio.sleep(seconds)
+        snapshot_after = await asyncio.to_thread(tracemalloc.take_snapshot)
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
+
+    def report():
+        out = io.StringIO()
+        out.write(
+            f"tracemalloc diff over {seconds} s"
+            + (" (tracing only started then)" if started_tracing else "")
+            + "\n\n"
+        )
+        current = snapshot_after.statistics("filename")
+        out.write(
+            "Traced now: "
+            f"{sum(stat.size for stat in current) / 1024 / 1024:.1f} MiB"
+            f" in {sum(stat.count for stat in current)} blocks\n"
+        )
+        diff = snapshot_after.compare_to(snapshot_before, "lineno")
+        out.write(f"\nTop {N_TOP} allocation sites by growth:\n")
+        for stat in diff[:N_TOP]:
+            out.write(f"{stat}\n")
+        diff = snapshot_after.compare_to(snapshot_before, "traceback")
+        out.write("\nTop 5 allocation tracebacks by growth:\n")
+        for stat in diff[:5]:
+            out.write(
+                f"\n{stat.size_diff / 1024:+.1f} KiB, {stat.count_diff:+} blocks\n"
+            )
+            out.write("\n".join(stat.traceback.format()) + "\n")
+        out.write(f"\nTop {N_TOP} allocation sites now:\n")
+        for stat in snapshot_after.statistics("lineno")[:N_TOP]:
+            out.write(f"{stat}\n")
+        return out.getvalue()
+
+    return await asyncio.to_thread(report)
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+ASYNCIO_DIR = os.path.dirname(os.path.abspath(asyncio.__file__))
+
+
+class LoopLagMonitor:
+    """
+    A heartbeat task measures how late the event loop wakes it up. A watchdog thread
+    captures the loop thread's stack when the heartbeat is late by threshold,
+    so a stall can be blamed on the code that blocked the loop.
+    """
+
+    def __init__(self, threshold: float = 0.25, interval: float = 0.05):
+        self.threshold = threshold
+        """Lag (seconds) from which the loop is considered stalled"""
+        self.interval = interval
+        self.last_beat: float | None = None
+        """perf_counter() when the heartbeat last went to sleep"""
+        self.capture: tuple[float, str, str, str] | None = None
+        """(last_beat, blamed, task, stack) captured by the watchdog during a stall"""
+        self.max_lag = 0.0
+        self.stop_event = threading.Event()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        watchdog_thread = threading.Thread(
+            target=self._watchdog,
+            args=(loop, threading.get_ident()),
+            name="LoopLagMonitor",
+            daemon=True,
+        )
+        self.stop_event.clear()
+        watchdog_thread.start()
+        try:
+            while True:
+                beat = time.perf_counter()
+                self.last_beat = beat
+                await asyncio.sleep(self.interval)
+                self._record(beat, time.perf_counter() - beat - self.interval)
+        finally:
+            self.stop_event.set()
+
+    def _record(self, beat: float, lag: float):
+        zoometrics.set_gauge("loop_lag_seconds", lag)
+        if lag > self.max_lag:
+            self.max_lag = lag
+            zoometrics.set_gauge("loop_lag_max_seconds", lag)
+        if lag < self.threshold:
+            return
+        capture = self.capture
+        if capture is not None and capture[0] == beat:
+            _, blamed, task, stack = capture
+        else:
+            # The watchdog didn't get to look before the loop woke up
+            blamed, task, stack = "(not captured)", "", ""
+        zoometrics.incr("loop_stalls")
+        # Task names (e.g. discord.py's per-event ones) would make a metric per stall
+        zoometrics.incr(f"loop_stalls {blamed}")
+        print(f"Event loop stalled for {lag:.3f} s in {blamed}{task}")
+        print(stack, end="")
+
+    def _watchdog(self, loop: asyncio.AbstractEventLoop, loop_thread_id: int):
+        while not self.stop_event.wait(self.threshold / 4):
+            beat = self.last_beat
+            if beat is None or (self.capture is not None and self.capture[0] == beat):
+                continue
+            if time.perf_counter() - beat - self.interval < self.threshold:
+                continue
+            frame = sys._current_frames().get(loop_thread_id)
+            if frame is None:
+                continue
+            self.capture = (
+                beat,
+                self._blame(frame),
+                self._task(loop),
+                _format_stack(frame),
+            )
+
+    def _blame(self, frame):
+        """
+        The outermost and innermost functions of this repo on the stack below the
+        event loop (the handler that blocked, and what it was blocked in)
+        """
+        repo_functions = []
+        while frame is not None:
+            frame_dir = os.path.dirname(os.path.abspath(frame.f_code.co_filename))
+            if frame_dir == ASYNCIO_DIR:
+                break
+            if frame_dir == REPO_DIR:
+                repo_functions.append(_function_name(frame))
+            frame = frame.f_back
+        if repo_functions:
+            blamed = repo_functions[-1]
+            if len(repo_functions) > 1:
+                blamed += " > " + repo_functions[0]
+        else:
+            blamed = "(outside the bot's code)"
+        return blamed
+
+    def _task(self, loop: asyncio.AbstractEventLoop):
+        """The loop's running task, for the log"""
+        # Not public, but the only way to see another thread's current task
+        current_tasks = getattr(asyncio.tasks, "_current_tasks", None)
+        if current_tasks is None:
+            return ""
+        task = current_tasks.get(loop)
+        if task is None:
+            return ""
+        return f" [task {task.get_name()}]"
+
+
+def _format_stack(frame):
+    return "".join(traceback.format_stack(frame))
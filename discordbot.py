@@ -5,19 +5,33 @@ from __future__ import annotations
 
 import sys
 import io
+import asyncio
 import datetime
+import time
 import traceback
 import sqlite3
 import re
+import csv
+import json
+import gzip
+import tempfile
+import hashlib
+import contextlib
+import collections
+import functools
+import itertools
 from pathlib import Path
-from typing import Optional, Literal
+from typing import Optional, Literal, Callable
 
 import discord
-import emoji
 
 import botconf
-import zoopeeker
+import botprofiler
 import pycpp
+import zooapi
+import zoopeeker
+import zoostats
+import zoometrics
 
 """
 /zq SQL
@@ -51,16 +65,25 @@ async def message_send_exception(wh: discord.Webhook, exc: BaseException):
     )
 
 
+_emoji = None
+"""The emoji module, imported on first use (it is slow to import)"""
+
+
 def discord_monospace_str_len(s: str):
     """
     Returns the width of a string displayed monospace by Discord (using ``)
     For example "abc" is 3, "🐲" is 2.
     """
+    global _emoji
+    if _emoji is None:
+        import emoji
+
+        _emoji = emoji
     # Not sure about keep_zwj=False but shouldn't really matter in our use cases.
     # (this is still very crummy)
     return sum(
-        2 if isinstance(token.value, emoji.EmojiMatch) else 1
-        for token in emoji.tokenizer.tokenize(s, keep_zwj=False)
+        2 if isinstance(token.value, _emoji.EmojiMatch) else 1
+        for token in _emoji.tokenizer.tokenize(s, keep_zwj=False)
     )
 
 
@@ -234,8 +257,10 @@ class DataPeekScrollButton(discord.ui.Button):
         self.scroll_by = scroll_by
 
     async def callback(self, interaction):
+        await self.dpview.ensure_data(interaction)
         self.dpview.scroll_by(self.scroll_by)
-        await interaction.response.edit_message(content=self.dpview.render())
+        await edit_component_message(interaction, content=self.dpview.render())
+        datapeek_retention.touch(self.dpview)
 
 
 class DataPeekNRowsSelect(discord.ui.Select):
@@ -266,10 +291,13 @@ class DataPeekNRowsSelect(discord.ui.Select):
         self.dpview.set_n_rows(selected_value_int)
         for opt in self.options:
             opt.default = opt.value == selected_value_str
-        await interaction.response.edit_message(
+        await self.dpview.ensure_data(interaction)
+        await edit_component_message(
+            interaction,
             content=self.dpview.render(),
             view=self.view,
         )
+        datapeek_retention.touch(self.dpview)
 
 
 class DataPeekDeleteButton(discord.ui.Button):
@@ -278,6 +306,87 @@ class DataPeekDeleteButton(discord.ui.Button):
 
     async def callback(self, interaction):
         await interaction.message.delete()
+        self.view.stop()
+        datapeek_retention.release(self.view)
+
+
+async def edit_component_message(interaction: discord.Interaction, **kwargs):
+    """Edits the message of the component, whether the interaction was deferred or not"""
+    if interaction.response.is_done():
+        await interaction.edit_original_response(**kwargs)
+    else:
+        await interaction.response.edit_message(**kwargs)
+
+
+DATAPEEK_BUDGET_BYTES = getattr(botconf, "datapeek_budget_bytes", 64 * 1024 * 1024)
+DATAPEEK_BUDGET_ROWS = getattr(botconf, "datapeek_budget_rows", 500_000)
+
+
+def estimate_rows_size(data: list[tuple]):
+    return sys.getsizeof(data) + sum(
+        sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row) for row in data
+    )
+
+
+class DataPeekRetention:
+    """
+    Process-wide budget for the rows held by live DataPeekViews.
+
+    When over budget, the least recently used views that can reload their rows
+    drop them; they are fetched again on their next scroll.
+    Only used from the event loop.
+    """
+
+    def __init__(self, max_bytes: int, max_rows: int):
+        self.max_bytes = max_bytes
+        self.max_rows = max_rows
+        self.size_by_view: collections.OrderedDict[DataPeekView, tuple[int, int]] = (
+            collections.OrderedDict()
+        )
+        """(bytes, rows) of the views holding rows, least recently used first"""
+        self.n_bytes = 0
+        self.n_rows = 0
+
+    def retain(self, view: DataPeekView, n_bytes: int | None = None):
+        """n_bytes: estimate_rows_size(view.data), if already known"""
+        self.release(view)
+        if n_bytes is None:
+            n_bytes = estimate_rows_size(view.data)
+        size = (n_bytes, len(view.data))
+        self.size_by_view[view] = size
+        self.n_bytes += size[0]
+        self.n_rows += size[1]
+        self._evict(keep=view)
+        self._update_metrics()
+
+    def touch(self, view: DataPeekView):
+        if view in self.size_by_view:
+            self.size_by_view.move_to_end(view)
+
+    def release(self, view: DataPeekView):
+        size = self.size_by_view.pop(view, None)
+        if size is not None:
+            self.n_bytes -= size[0]
+            self.n_rows -= size[1]
+            self._update_metrics()
+
+    def _evict(self, keep: DataPeekView):
+        for view in list(self.size_by_view):
+            if self.n_bytes <= self.max_bytes and self.n_rows <= self.max_rows:
+                break
+            if view is keep or view.reload is None:
+                continue
+            self.release(view)
+            view.drop_data()
+            zoometrics.incr("datapeek_evictions")
+
+    def _update_metrics(self):
+        zoometrics.set_gauge("datapeek_retained_views", len(self.size_by_view))
+        zoometrics.set_gauge("datapeek_retained_bytes", self.n_bytes)
+        zoometrics.set_gauge("datapeek_retained_rows", self.n_rows)
+
+
+datapeek_retention = DataPeekRetention(DATAPEEK_BUDGET_BYTES, DATAPEEK_BUDGET_ROWS)
 
 
 class DataPeekView(discord.ui.View):
@@ -286,11 +395,17 @@ class DataPeekView(discord.ui.View):
         query: str,
         cols: list[str],
         data: list[tuple],
+        reload: Callable[[], list[tuple]] | None = None,
     ):
+        """
+        reload: gets the rows again after they were dropped to stay within
+        datapeek_retention's budget. Views without it keep their rows.
+        """
         super().__init__(timeout=300)
         self.query = query
         self.cols = cols
         self.data = data
+        self.reload = reload
         self.i_start = 0
         self.n_rows = 10
         self.add_item(DataPeekScrollButton(self, -1, 0))
@@ -308,9 +423,32 @@ class DataPeekView(discord.ui.View):
         self.wm = wm
 
     async def on_timeout(self):
+        datapeek_retention.release(self)
         if self.wm is not None:
             await self.wm.edit(view=None)
 
+    def drop_data(self):
+        self.data = None
+
+    async def ensure_data(self, interaction: discord.Interaction):
+        """
+        Reloads the rows if they were dropped, off the event loop.
+        Defers the interaction first, reloading can take a while.
+        """
+        if self.data is not None:
+            return
+        await interaction.response.defer()
+
+        def reload():
+            data = self.reload()
+            return data, estimate_rows_size(data)
+
+        data, n_bytes = await asyncio.to_thread(reload)
+        if self.data is None:
+            self.data = data
+            zoometrics.incr("datapeek_reloads")
+            datapeek_retention.retain(self, n_bytes)
+
     def render(self):
         datapeek = self.data[self.i_start :][: self.n_rows]
         return render_datapeek(
@@ -322,11 +460,12 @@ class DataPeekView(discord.ui.View):
         )
 
     def scroll_by(self, n: int):
+        n_data = len(self.data)
         self.i_start += n
+        if self.i_start >= n_data:
+            self.i_start = n_data - 1
         if self.i_start < 0:
             self.i_start = 0
-        if self.i_start >= len(self.data):
-            self.i_start = len(self.data) - 1
 
     def set_n_rows(self, n: int):
         assert n > 0
@@ -336,10 +475,191 @@ class DataPeekView(discord.ui.View):
 cpp_context = (Path(__file__).parent / "cpp_context.sql").read_text()
 
 
+def render_query_error(e: sqlite3.Error, query: str):
+    sqlite_errorname = getattr(e, "sqlite_errorname", None)
+
+    msg = "\n".join(
+        (
+            "```diff",
+            (
+                "-Error-"
+                if sqlite_errorname is None
+                else f"-Error ({sqlite_errorname})-"
+            ),
+            "```" "```",
+            (
+                e.args[0]
+                if len(e.args) == 1 and isinstance(e.args[0], str)
+                else repr(e.args)
+            ),
+            "```",
+        )
+    )
+
+    msg_frag_query = "\n".join(
+        (
+            "```sql",
+            query,
+            "```",
+        )
+    )
+    if len(msg) + len(msg_frag_query) <= MESSAGE_MAX_LEN:
+        msg += msg_frag_query
+
+    if len(msg) > MESSAGE_MAX_LEN:
+        msg = msg[:MESSAGE_MAX_LEN]
+
+    return msg
+
+
+EXPORT_MAX_ROWS = 1_000_000
+EXPORT_MAX_BYTES = 8 * 1024 * 1024
+"""Compressed size, keeps the file under Discord's attachment size limit"""
+EXPORT_FILE_SUFFIXES = {
+    "csv": ".csv.gz",
+    "ndjson": ".ndjson.gz",
+}
+
+
+def _ndjson_default(v):
+    if isinstance(v, bytes):
+        return v.hex()
+    return str(v)
+
+
+def zpk_for_guild(guild_id: int | None) -> zoopeeker.ZooPeeker:
+    """The ZooPeeker of the guild's database partition"""
+    return zpks[partitions.partition_index(guild_id)]
+
+
+partition_index_by_discord_id: dict[int, int] = dict()
+"""
+Each user is stored in one partition only, the one of the guild they were
+first seen in, so they aren't fetched, refreshed and reminded of once per guild
+"""
+
+
+def partition_index_for_user(discord_id: int, guild_id: int | None):
+    i_partition = partition_index_by_discord_id.get(discord_id)
+    if i_partition is None:
+        i_partition = next(
+            (
+                i_partition
+                for i_partition, zpk in enumerate(zpks)
+                if zpk.get_user(discord_id) is not None
+            ),
+            partitions.partition_index(guild_id),
+        )
+        partition_index_by_discord_id[discord_id] = i_partition
+    return i_partition
+
+
+def zpk_for_user(discord_id: int, guild_id: int | None) -> zoopeeker.ZooPeeker:
+    """The ZooPeeker of the user's partition, see partition_index_by_discord_id"""
+    return zpks[partition_index_for_user(discord_id, guild_id)]
+
+
+def run_query(open_con: Callable[[], sqlite3.Connection], query: str):
+    """
+    Runs the query on a dedicated connection, so it can run off the event loop.
+    Returns the column names and the rows.
+    """
+    con = open_con()
+    try:
+        cur = con.execute(query)
+        cols: list[str] = [item[0] for item in cur.description]
+        return cols, cur.fetchall()
+    finally:
+        con.close()
+
+
+def fetch_query_rows(open_con: Callable[[], sqlite3.Connection], query: str):
+    """The rows of run_query"""
+    return run_query(open_con, query)[1]
+
+
+def export_query_results(
+    open_con: Callable[[], sqlite3.Connection],
+    query: str,
+    export_format: Literal["csv", "ndjson"],
+):
+    """
+    Runs the query on a dedicated connection (this runs off the event loop) and
+    streams the rows into a gzipped temporary file, stopping at EXPORT_MAX_ROWS
+    rows or EXPORT_MAX_BYTES compressed bytes.
+
+    Returns the file (positioned at the start, to be closed by the caller),
+    the number of rows written and whether the results were truncated.
+    """
+    con = open_con()
+    try:
+        cur = con.execute(query)
+        cols: list[str] = [item[0] for item in cur.description]
+
+        export_file = tempfile.TemporaryFile()
+        try:
+            n_rows = 0
+            truncated = False
+            # export_file's size at the last gz.flush(), and gz.tell() (uncompressed
+            # bytes written) then
+            flushed_size = 0
+            flushed_offset = 0
+            with gzip.GzipFile(fileobj=export_file, mode="wb") as gz:
+                with io.TextIOWrapper(
+                    gz, encoding="utf-8", newline="", write_through=True
+                ) as text:
+                    if export_format == "csv":
+                        writer = csv.writer(text)
+                        writer.writerow(cols)
+                        write_row = writer.writerow
+                    else:
+
+                        def write_row(row):
+                            text.write(
+                                json.dumps(
+                                    dict(zip(cols, row)),
+                                    ensure_ascii=False,
+                                    default=_ndjson_default,
+                                )
+                            )
+                            text.write("\n")
+
+                    for row in cur:
+                        if n_rows >= EXPORT_MAX_ROWS:
+                            truncated = True
+                            break
+                        # zlib holds on to compressed data, so export_file lags
+                        # behind. Only flush (which hurts compression) when what
+                        # was written since the last flush could reach the limit
+                        # if it didn't compress at all
+                        if (
+                            flushed_size + gz.tell() - flushed_offset
+                            >= EXPORT_MAX_BYTES
+                        ):
+                            gz.flush()
+                            flushed_size = export_file.tell()
+                            flushed_offset = gz.tell()
+                            if flushed_size >= EXPORT_MAX_BYTES:
+                                truncated = True
+                                break
+                        write_row(row)
+                        n_rows += 1
+            export_file.seek(0)
+        except:
+            export_file.close()
+            raise
+    finally:
+        con.close()
+
+    return export_file, n_rows, truncated
+
+
 async def zooquery_command(
     interaction: discord.Interaction,
     query: str,
     show_cpp_query: bool = False,
+    export: Optional[Literal["csv", "ndjson"]] = None,
+    all_guilds: bool = False,
 ):
     await interaction.response.defer(thinking=True)
 
@@ -347,66 +667,61 @@ async def zooquery_command(
         user_discord = interaction.user
 
         initial_query = query
-        user_cpp_context = cpp_context.format(
-            discord_user_name=user_discord.name,
-        )
         try:
-            query = pycpp.my_preprocess(user_cpp_context + "\n" + query)
+            query = pycpp.preprocess_with_context(cpp_context, query)
         except pycpp.ForbiddenUsage as e:
             await interaction.followup.send(f"pycpp.ForbiddenUsage: {e}")
             return
 
+        zpk = zpk_for_user(user_discord.id, interaction.guild_id)
         user = zpk.get_user(user_discord.id)
         if user is None:
-            user = zpk.add_user(
+            user = await asyncio.to_thread(
+                zpk.add_user,
                 user_discord.id,
                 user_discord.name,
                 user_discord.display_name,
             )
 
-        con = zpk.dbh.get_user_con(user)
-
-        try:
-            cur = con.execute(query)
-        except sqlite3.OperationalError as e:
-            sqlite_errorname = getattr(e, "sqlite_errorname", None)
+        # Dedicated connections, for what runs off the event loop
+        if all_guilds:
+            open_con = partitions.open_global_con
+        else:
+            open_con = functools.partial(zpk.dbh.open_user_con, user)
 
-            msg = "\n".join(
-                (
-                    "```diff",
-                    (
-                        "-Error-"
-                        if sqlite_errorname is None
-                        else f"-Error ({sqlite_errorname})-"
-                    ),
-                    "```" "```",
-                    (
-                        e.args[0]
-                        if len(e.args) == 1 and isinstance(e.args[0], str)
-                        else repr(e.args)
+        if export is not None:
+            try:
+                export_file, n_rows, truncated = await asyncio.to_thread(
+                    export_query_results, open_con, query, export
+                )
+            except sqlite3.OperationalError as e:
+                await interaction.followup.send(
+                    render_query_error(e, query if show_cpp_query else initial_query)
+                )
+                return
+            with export_file:
+                await interaction.followup.send(
+                    f"{n_rows} rows" + (" (truncated)" if truncated else ""),
+                    file=discord.File(
+                        export_file,
+                        filename=(
+                            "zq_"
+                            + datetime.datetime.now(datetime.UTC).strftime(
+                                "%Y%m%d_%H%M%S"
+                            )
+                            + EXPORT_FILE_SUFFIXES[export]
+                        ),
                     ),
-                    "```",
                 )
-            )
+            return
 
-            msg_frag_query = "\n".join(
-                (
-                    "```sql",
-                    query if show_cpp_query else initial_query,
-                    "```",
-                )
+        try:
+            cols, data = await asyncio.to_thread(run_query, open_con, query)
+        except sqlite3.OperationalError as e:
+            await interaction.followup.send(
+                render_query_error(e, query if show_cpp_query else initial_query)
             )
-            if len(msg) + len(msg_frag_query) <= MESSAGE_MAX_LEN:
-                msg += msg_frag_query
-
-            if len(msg) > MESSAGE_MAX_LEN:
-                msg = msg[:MESSAGE_MAX_LEN]
-
-            await interaction.followup.send(msg)
         else:
-            cols: list[str] = [item[0] for item in cur.description]
-            data = cur.fetchall()
-
             is_magic = False
 
             if cols == ["magic_lines"]:
@@ -417,13 +732,17 @@ async def zooquery_command(
 
             if not is_magic:
                 view = DataPeekView(
-                    query if show_cpp_query else initial_query, cols, data
+                    query if show_cpp_query else initial_query,
+                    cols,
+                    data,
+                    functools.partial(fetch_query_rows, open_con, query),
                 )
 
                 wm = await interaction.followup.send(
                     view.render(), view=view, wait=True
                 )
                 view.set_wm(wm)
+                datapeek_retention.retain(view)
 
     except:
         await message_send_exception(interaction.followup, sys.exception())
@@ -440,16 +759,18 @@ async def peek_command(
             user_discord = interaction.user
         else:
             user_discord = target
+        zpk = zpk_for_user(user_discord.id, interaction.guild_id)
         user = zpk.get_user(user_discord.id)
         if user is None:
-            user = zpk.add_user(
+            user = await asyncio.to_thread(
+                zpk.add_user,
                 user_discord.id,
                 user_discord.name,
                 user_discord.display_name,
             )
             await interaction.followup.send("Data created (first peek!)")
         else:
-            zpk.refresh_user_data(user)
+            await interaction.client.refresh_user_data(zpk, user)
             await interaction.followup.send("Data refreshed after a good peek")
     except:
         await message_send_exception(interaction.followup, sys.exception())
@@ -461,17 +782,45 @@ async def peekall_command(interaction: discord.Interaction):
 
     try:
         discord_user_ids = botconf.discord_user_ids
+        zpk_by_discord_id = {
+            discord_id: zpk_for_user(discord_id, interaction.guild_id)
+            for discord_id in discord_user_ids.values()
+        }
+        fetch_pool = zpks[0].fetch_pool
+        fetch_futures_by_discord_id = (
+            None
+            if fetch_pool is None
+            else {
+                discord_id: fetch_pool.submit(
+                    discord_id,
+                    (
+                        None
+                        if zpk.get_user(discord_id) is None
+                        else zpk.get_user(discord_id).known_payloads()
+                    ),
+                )
+                for discord_id, zpk in zpk_by_discord_id.items()
+            }
+        )
         for i, (name, discord_id) in enumerate(discord_user_ids.items()):
             await interaction.edit_original_response(
                 content=f"Peeking all... {i+1}/{len(discord_user_ids)} {name}"
             )
             user = await interaction.client.fetch_user(discord_id)
             assert user is not None
+            fetched = (
+                None
+                if fetch_futures_by_discord_id is None
+                else await asyncio.wrap_future(fetch_futures_by_discord_id[discord_id])
+            )
+            zpk = zpk_by_discord_id[discord_id]
             zpk_user = zpk.get_user(discord_id)
             if zpk_user is None:
-                zpk.add_user(discord_id, user.name, user.display_name)
+                await asyncio.to_thread(
+                    zpk.add_user, discord_id, user.name, user.display_name, fetched
+                )
             else:
-                zpk.refresh_user_data(zpk_user)
+                await interaction.client.refresh_user_data(zpk, zpk_user, fetched)
 
     except:
         await message_send_exception(interaction.followup, sys.exception())
@@ -480,6 +829,171 @@ async def peekall_command(interaction: discord.Interaction):
         await interaction.edit_original_response(content="Peeking all done")
 
 
+async def send_stats(
+    interaction: discord.Interaction, title: str, cols: list[str], data: list[tuple]
+):
+    view = DataPeekView(title, cols, data)
+    await interaction.response.send_message(view.render(), view=view)
+    view.set_wm(await interaction.original_response())
+    datapeek_retention.retain(view)
+
+
+def user_names_by_user_id(zpk: zoopeeker.ZooPeeker):
+    return {user.user_id: user.name for user in zpk.users_by_discord_id.values()}
+
+
+async def stats_totals_command(interaction: discord.Interaction, now: bool = False):
+    zpk = zpk_for_guild(interaction.guild_id)
+    totals = zpk.zoo_matrix.totals(now)
+    data = sorted(
+        (
+            (str(za), za.animal_name, int(total))
+            for za, total in zip(zoostats.ANIMALS, totals)
+        ),
+        key=lambda row: row[2],
+        reverse=True,
+    )
+    await send_stats(
+        interaction,
+        "/stats totals" + (" now" if now else ""),
+        ["emoji", "animal", "total"],
+        data,
+    )
+
+
+async def stats_rares_command(interaction: discord.Interaction):
+    zpk = zpk_for_guild(interaction.guild_id)
+    n_commons, n_rares, ratios = zpk.zoo_matrix.rare_ratios()
+    data = sorted(
+        (
+            (
+                za.animal_common.animal_name,
+                int(nc),
+                za.animal_name,
+                int(nr),
+                f"{ratio:.2%}",
+            )
+            for za, nc, nr, ratio in zip(zoostats.RARES, n_commons, n_rares, ratios)
+        ),
+        key=lambda row: row[3],
+        reverse=True,
+    )
+    await send_stats(
+        interaction,
+        "/stats rares",
+        ["common", "nc", "rare", "nr", "rare_ratio"],
+        data,
+    )
+
+
+async def stats_completeness_command(interaction: discord.Interaction):
+    zpk = zpk_for_guild(interaction.guild_id)
+    user_ids, n_owned, fractions = zpk.zoo_matrix.completeness()
+    names = user_names_by_user_id(zpk)
+    data = sorted(
+        (
+            (names.get(int(user_id), "?"), int(n), f"{fraction:.0%}")
+            for user_id, n, fraction in zip(user_ids, n_owned, fractions)
+        ),
+        key=lambda row: row[1],
+        reverse=True,
+    )
+    await send_stats(
+        interaction,
+        "/stats completeness",
+        ["user", "animals", "completeness"],
+        data,
+    )
+
+
+async def stats_similar_command(
+    interaction: discord.Interaction, target: Optional[discord.User]
+):
+    if target is None:
+        target = interaction.user
+    zpk = zpk_for_user(target.id, interaction.guild_id)
+    user = zpk.get_user(target.id)
+    if user is None:
+        await interaction.response.send_message(
+            f"No data for {target.name}, /peek first", ephemeral=True
+        )
+        return
+    user_ids, corrs = zpk.zoo_matrix.user_correlations(user.user_id)
+    names = user_names_by_user_id(zpk)
+    data = sorted(
+        (
+            (names.get(int(user_id), "?"), round(float(corr), 3))
+            for user_id, corr in zip(user_ids, corrs)
+            if corr == corr  # not nan
+        ),
+        key=lambda row: row[1],
+        reverse=True,
+    )
+    await send_stats(
+        interaction,
+        f"/stats similar {target.name}",
+        ["user", "correlation"],
+        data,
+    )
+
+
+async def metrics_command(interaction: discord.Interaction):
+    counters, gauges = zoometrics.snapshot()
+    data = sorted(counters.items()) + sorted(gauges.items())
+    unchanged_rate = zoometrics.ratio(
+        "refresh_profiles_unchanged", "refresh_profiles_fetched"
+    )
+    if unchanged_rate is not None:
+        data.append(("refresh_profiles_unchanged_rate", f"{unchanged_rate:.1%}"))
+    await send_stats(interaction, "/metrics", ["metric", "value"], data)
+
+
+PROFILE_MAX_SECONDS = 120
+ADMIN_USER_IDS = set(getattr(botconf, "admin_user_ids", ()))
+
+
+async def profile_command(
+    interaction: discord.Interaction,
+    mode: Literal["sample", "cprofile", "tracemalloc"],
+    seconds: int = 10,
+):
+    if interaction.user.id not in ADMIN_USER_IDS:
+        await interaction.response.send_message("Admins only", ephemeral=True)
+        return
+    if botprofiler.session_lock.locked():
+        await interaction.response.send_message(
+            "A profiling session is already running", ephemeral=True
+        )
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+
+    await interaction.response.defer(thinking=True, ephemeral=True)
+
+    try:
+        async with botprofiler.session_lock:
+            if mode == "sample":
+                report = await botprofiler.profile_sampling(seconds)
+            elif mode == "cprofile":
+                report = await botprofiler.profile_cprofile(seconds)
+            else:
+                report = await botprofiler.profile_tracemalloc(seconds)
+        await interaction.followup.send(
+            f"{mode} for {seconds} s",
+            file=discord.File(
+                io.BytesIO(report.encode()),
+                filename=(
+                    f"profile_{mode}_"
+                    + datetime.datetime.now(datetime.UTC).strftime("%Y%m%d_%H%M%S")
+                    + ".txt"
+                ),
+            ),
+            ephemeral=True,
+        )
+    except:
+        await message_send_exception(interaction.followup, sys.exception())
+        raise
+
+
 DELAY_BETWEEN_DUMPS = datetime.timedelta(minutes=1)
 datetime_next_dump = datetime.datetime.now()
 
@@ -498,8 +1012,9 @@ async def dbdump_command(interaction: discord.Interaction):
     await interaction.response.defer(thinking=True)
 
     try:
-        db_dump = dbh.dump()
-        db_backup = dbh.backup()
+        dbh = partitions.get(interaction.guild_id)
+        db_dump = await asyncio.to_thread(dbh.dump)
+        db_backup = await asyncio.to_thread(dbh.backup)
         await interaction.followup.send(
             "Here:",
             files=(
@@ -520,7 +1035,14 @@ async def help_command(
         text = (
             "Data refreshes from the api on /peek or when the bot sees zoo activity.\n"
             "Todo data comes from the bot spying on `/terminal todo` (if the user and profile are in db already).\n"
-            + "Builtins (via cpp on the query): top(cond), mytop, todo/td, todo_within(delay)/tdw, todo_soon/tds"
+            + "Builtin views: top_pairs, my_top, my_todos, my_todos_soon\n"
+            + "Leaderboard views: leaderboard_users_score, leaderboard_profiles_score, leaderboard_animals_amount, my_ranks, my_animal_ranks\n"
+            + "Builtin functions: zoo_score(amount, is_rare), zoo_is_rare(animal_id), zoo_common_of(animal_id), zoo_rare_of(animal_id)\n"
+            + "Common/rare catalog table: animal_pairs\n"
+            + "/zq all_guilds: query every guild's data, tables and views get a partition_id column."
+            + " Ranks and leaderboards in views are computed per partition, not across all guilds"
+            + " (each user's data is in the partition of the guild the bot first saw them in)\n"
+            + "Shorthands (via cpp on the query): top(cond), mytop, todo/td, todo_within(delay)/tdw, todo_soon/tds"
         )
     elif topic == "cpp_context_c":
         text = f"```c\n{cpp_context}\n```"
@@ -536,13 +1058,92 @@ async def help_command(
         await interaction.response.send_message(text)
 
 
+COMMAND_TREE_HASH_PATH = Path(
+    getattr(
+        botconf,
+        "command_tree_hash_path",
+        Path(__file__).parent / ".command_tree_hash",
+    )
+)
+
+
+def command_tree_hash(tree: discord.app_commands.CommandTree):
+    payload = json.dumps(
+        [
+            tree.client.application_id,
+            [command.to_dict() for command in tree.get_commands()],
+        ],
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+TODO_REMINDER_MODE: Literal["dm", "channel", "off"] = getattr(
+    botconf, "todo_reminder_mode", "off"
+)
+"""
+Where to remind users of their todos when they come due, off by default: reminders
+are only sent once an admin opts the bot in with "dm" or "channel"
+"""
+TODO_REMINDER_CHANNEL_ID: int | None = getattr(
+    botconf, "todo_reminder_channel_id", None
+)
+
+WARMUP_CONCURRENCY: int = getattr(botconf, "warmup_concurrency", 0)
+"""
+How many of botconf.discord_user_ids to load or refresh at once in the background
+at startup, 0 to not warm up
+"""
+
+LOOP_LAG_THRESHOLD: float = getattr(botconf, "loop_lag_threshold", 0.25)
+"""Event loop lag (seconds) from which the blocking code is logged, 0 to not monitor"""
+
+REFRESHER_MAX_SLOWDOWN: float = getattr(botconf, "refresher_max_slowdown", 6.0)
+"""See ZooPeekerDataRefresher.max_slowdown, 1 to not adapt to users"""
+REFRESHER_MAX_DEBOUNCE_SLOWDOWN: float = getattr(
+    botconf, "refresher_max_debounce_slowdown", 3.0
+)
+"""See ZooPeekerDataRefresher.max_debounce_slowdown, 1 to not adapt to users"""
+REFRESHER_CHANGE_RATE_ALPHA: float = getattr(
+    botconf, "refresher_change_rate_alpha", 0.2
+)
+"""See ZooPeekerDataRefresher.change_rate_alpha"""
+
+
 class MyClient(discord.Client):
     async def on_ready(self):
+        # Also fires on every gateway reconnect, one-time setup is in setup_hook
         print("Logged on as", self.user)
 
-        self.zpkdr = zoopeeker.ZooPeekerDataRefresher(zpk, self.loop.call_soon)
-        self.zpkdr.start()
-        # TODO zpkdr.stop()
+    async def setup_hook(self):
+        # One refresher and todo ingester per partition, indexed like zpks
+        self.zpkdrs = []
+        self.zpktdis = []
+        for zpk in zpks:
+            zpkdr = zoopeeker.ZooPeekerDataRefresher(zpk, self.call_soon_off_loop)
+            zpkdr.max_slowdown = REFRESHER_MAX_SLOWDOWN
+            zpkdr.max_debounce_slowdown = REFRESHER_MAX_DEBOUNCE_SLOWDOWN
+            zpkdr.change_rate_alpha = REFRESHER_CHANGE_RATE_ALPHA
+            await asyncio.to_thread(zpkdr.start)
+            self.zpkdrs.append(zpkdr)
+
+            zpktdi = zoopeeker.ZooPeekerTodoIngester(zpk, zpkdr)
+            zpktdi.start()
+            self.zpktdis.append(zpktdi)
+
+        self.todo_reminder_task = None
+        if TODO_REMINDER_MODE != "off":
+            self.todo_reminder_task = asyncio.create_task(self.todo_reminder_loop())
+
+        self.loop_lag_task = None
+        if LOOP_LAG_THRESHOLD > 0:
+            self.loop_lag_task = asyncio.create_task(
+                botprofiler.LoopLagMonitor(LOOP_LAG_THRESHOLD).run()
+            )
+
+        self.warmup_task = None
+        if WARMUP_CONCURRENCY > 0:
+            self.warmup_task = asyncio.create_task(self.warmup_users())
 
         tree = discord.app_commands.CommandTree(self)
 
@@ -574,6 +1175,43 @@ class MyClient(discord.Client):
         )
         tree.add_command(command)
 
+        stats_group = discord.app_commands.Group(
+            name="stats",
+            description="Stats across everyone's zoos",
+        )
+        for name, description, callback in (
+            ("totals", "Total of each animal", stats_totals_command),
+            ("rares", "Rare ratio of each animal pair", stats_rares_command),
+            (
+                "completeness",
+                "How many different animals each user has",
+                stats_completeness_command,
+            ),
+            ("similar", "Whose zoo looks the most like yours", stats_similar_command),
+        ):
+            stats_group.add_command(
+                discord.app_commands.Command(
+                    name=name,
+                    description=description,
+                    callback=callback,
+                )
+            )
+        tree.add_command(stats_group)
+
+        command = discord.app_commands.Command(
+            name="metrics",
+            description="What the bot is up to",
+            callback=metrics_command,
+        )
+        tree.add_command(command)
+
+        command = discord.app_commands.Command(
+            name="profile",
+            description="Profile the bot for a few seconds (admins only)",
+            callback=profile_command,
+        )
+        tree.add_command(command)
+
         command = discord.app_commands.Command(
             name="help",
             description="Some usage notes",
@@ -581,11 +1219,138 @@ class MyClient(discord.Client):
         )
         tree.add_command(command)
 
-        print("await tree.sync() ...")
-        await tree.sync()
+        tree_hash = command_tree_hash(tree)
+        try:
+            synced_tree_hash = COMMAND_TREE_HASH_PATH.read_text().strip()
+        except FileNotFoundError:
+            synced_tree_hash = None
+        if tree_hash != synced_tree_hash:
+            print("await tree.sync() ...")
+            await tree.sync()
+            COMMAND_TREE_HASH_PATH.write_text(tree_hash + "\n")
+        else:
+            print("Command tree unchanged since last sync, not syncing")
 
         print("Reafy-reafy")
 
+    def call_soon_off_loop(self, callback, *args):
+        """Thread-safe, runs callback(*args) in the loop's default executor"""
+        self.loop.call_soon_threadsafe(self.loop.run_in_executor, None, callback, *args)
+
+    async def warmup_users(self):
+        """
+        Loads or refreshes the configured users with background priority,
+        so their first interactions don't wait on the Zoo API.
+        Users no partition knows yet are added to the DMs' partition.
+        """
+        jobs = [
+            (zpk_for_user(discord_id, None), name, discord_id)
+            for name, discord_id in botconf.discord_user_ids.items()
+        ]
+        n_users = len(jobs)
+        n_done = 0
+        n_failed = 0
+        semaphore = asyncio.Semaphore(WARMUP_CONCURRENCY)
+        start = time.perf_counter()
+        print("Warm-up of", n_users, "users, concurrency", WARMUP_CONCURRENCY)
+        zoometrics.set_gauge("warmup_users_pending", n_users)
+
+        async def warmup_user(zpk: zoopeeker.ZooPeeker, name: str, discord_id: int):
+            nonlocal n_done, n_failed
+            async with semaphore:
+                try:
+                    with zooapi.request_priority(zooapi.RequestPriority.BACKGROUND):
+                        zpk_user = zpk.get_user(discord_id)
+                        if zpk_user is None:
+                            user = self.get_user(discord_id)
+                            if user is None:
+                                user = await self.fetch_user(discord_id)
+                            await asyncio.to_thread(
+                                zpk.add_user, discord_id, user.name, user.display_name
+                            )
+                        else:
+                            await self.refresh_user_data(zpk, zpk_user)
+                except Exception:
+                    n_failed += 1
+                    zoometrics.incr("warmup_users_failed")
+                    print("Warm-up failed for", name, discord_id)
+                    traceback.print_exc()
+                n_done += 1
+                zoometrics.incr("warmup_users_done")
+                zoometrics.set_gauge("warmup_users_pending", n_users - n_done)
+                print(f"Warm-up {n_done}/{n_users} {name}")
+
+        await asyncio.gather(*(warmup_user(*job) for job in jobs))
+        elapsed = time.perf_counter() - start
+        zoometrics.set_gauge("warmup_seconds", elapsed)
+        print(f"Warm-up done in {elapsed:.1f} s, {n_failed}/{n_users} failed")
+
+    async def refresh_user_data(
+        self,
+        zpk: zoopeeker.ZooPeeker,
+        user: zoopeeker.User,
+        fetched: zoopeeker.UserProfilesFetch | None = None,
+    ):
+        """
+        Refreshes the user's data off the event loop, and tells the partition's
+        refresher whether it changed so it learns from refreshes it didn't schedule
+        """
+        changed = await asyncio.to_thread(zpk.refresh_user_data, user, fetched)
+        self.zpkdrs[zpks.index(zpk)].record_refresh_outcome(user, changed)
+
+    async def todo_reminder_loop(self):
+        while True:
+            await asyncio.sleep(zpks[0].todo_wheel.tick)
+            for timer in itertools.chain.from_iterable(
+                zpk.pop_due_todos() for zpk in zpks
+            ):
+                try:
+                    await self.send_todo_reminder(timer)
+                except Exception:
+                    print("Failed to send todo reminder", timer.user, timer.todo_thing)
+                    traceback.print_exc()
+
+    async def send_todo_reminder(self, timer: zoopeeker.TodoTimer):
+        text = (
+            f"{timer.todo_thing.emoji} {timer.todo_thing.thing} is due"
+            f" (<t:{round(timer.todo_thing.time.timestamp())}:R>)"
+        )
+        if TODO_REMINDER_MODE == "channel":
+            channel = self.get_channel(TODO_REMINDER_CHANNEL_ID)
+            if channel is None:
+                channel = await self.fetch_channel(TODO_REMINDER_CHANNEL_ID)
+            await channel.send(
+                f"<@{timer.user.discord_id}> {text}",
+                allowed_mentions=discord.AllowedMentions(users=True),
+            )
+        else:
+            user_discord = self.get_user(timer.user.discord_id)
+            if user_discord is None:
+                user_discord = await self.fetch_user(timer.user.discord_id)
+            await user_discord.send(text)
+
+    async def close(self):
+        loop_lag_task = getattr(self, "loop_lag_task", None)
+        if loop_lag_task is not None:
+            loop_lag_task.cancel()
+            self.loop_lag_task = None
+        warmup_task = getattr(self, "warmup_task", None)
+        if warmup_task is not None:
+            warmup_task.cancel()
+            self.warmup_task = None
+        todo_reminder_task = getattr(self, "todo_reminder_task", None)
+        if todo_reminder_task is not None:
+            todo_reminder_task.cancel()
+            self.todo_reminder_task = None
+        # Stop feeding the database writer, what's queued is then drained on exit
+        for zpkdr in getattr(self, "zpkdrs", ()):
+            await asyncio.to_thread(zpkdr.stop)
+        self.zpkdrs = []
+        for zpktdi in getattr(self, "zpktdis", ()):
+            await asyncio.to_thread(zpktdi.stop)
+        self.zpktdis = []
+        await super().close()
+
     async def on_message(self, message: discord.Message):
         if message.author.id == botconf.zoo_bot_user_id:
             user_discord = None
@@ -611,13 +1376,17 @@ class MyClient(discord.Client):
                         ref = ref_msg.reference
 
             if user_discord is not None:
-                user = zpk.get_user(user_discord.id)
+                i_partition = partition_index_for_user(
+                    user_discord.id,
+                    None if message.guild is None else message.guild.id,
+                )
+                user = zpks[i_partition].get_user(user_discord.id)
                 if user is not None:
-                    client.zpkdr.notify_activity(user)
+                    self.zpkdrs[i_partition].notify_activity(user)
 
-                    self.try_parse_todo(user, message.content)
+                    self.try_parse_todo(i_partition, user, message.content)
 
-    def try_parse_todo(self, user: zoopeeker.User, msg: str):
+    def try_parse_todo(self, i_partition: int, user: zoopeeker.User, msg: str):
         msg_lines = msg.splitlines()
         try:
             i = msg_lines.index("__**Upcoming Events**__")
@@ -653,7 +1422,7 @@ class MyClient(discord.Client):
         now = datetime.datetime.now(datetime.UTC)
         for t in todo_things:
             print(user, t.emoji, t.thing, "[at]", t.time, "[in]", t.time - now)
-        zpk.set_current_profile_todos(user, todo_things)
+        self.zpktdis[i_partition].submit(user, todo_things)
 
 
 intents = discord.Intents.none()
@@ -662,6 +1431,36 @@ intents.guild_messages = True
 client = MyClient(intents=intents)
 
 # https://discord.com/oauth2/authorize?client_id=1230252029235171328&permissions=265280&integration_type=0&scope=bot
-with zoopeeker.DatabaseHandler() as dbh:
-    zpk = zoopeeker.ZooPeeker(dbh)
-    client.run(botconf.token)
+if __name__ == "__main__":
+    storage_profile = zoopeeker.StorageProfile(
+        **getattr(botconf, "storage_profile", {})
+    )
+    zooapi.rate_limiter.configure(
+        getattr(botconf, "zoo_api_rate", zooapi.rate_limiter.rate),
+        getattr(botconf, "zoo_api_burst", zooapi.rate_limiter.burst),
+    )
+    n_fetch_workers = getattr(botconf, "fetch_workers", 0)
+    archive_dir = getattr(botconf, "archive_dir", None)
+    n_partitions = getattr(botconf, "database_partitions", 1)
+
+    with contextlib.ExitStack() as exit_stack:
+        partitions = exit_stack.enter_context(
+            zoopeeker.DatabasePartitions(storage_profile, n_partitions)
+        )
+        fetch_pool = None
+        if n_fetch_workers > 0:
+            fetch_pool = zoopeeker.ZooPeekerFetchPool(n_fetch_workers)
+            fetch_pool.start()
+            exit_stack.callback(fetch_pool.stop)
+        archive = None
+        if archive_dir is not None:
+            import zooarchive
+
+            archive = exit_stack.enter_context(zooarchive.PayloadArchive(archive_dir))
+        # Started last so the queued writes are drained before the rest is torn down
+        partitions.start_writers()
+        exit_stack.callback(partitions.stop_writers)
+        zpks = [
+            zoopeeker.ZooPeeker(dbh, fetch_pool, archive) for dbh in partitions.dbhs
+        ]
+        client.run(botconf.token)
@@ -1,75 +1,1124 @@
 # SPDX-FileCopyrightText: 2024 Dragorn421
 # SPDX-License-Identifier: CC0-1.0
 
-import io
+"""
+Small C preprocessor for /zq queries.
+
+Only supports what ZooPeeker allows: #define, #undef, #ifdef, #ifndef, #if,
+#elif, #else, #endif, object-like and function-like (including variadic) macros,
+# and ##, and integer #if expressions.
+
+It follows pcpp's algorithms (which it replaces, see pycpp_reference.py) so the
+output is the same, quirks included. Run this file for a differential check
+against pcpp.
+"""
 
-import pcpp
+import sys
+import re
+import time
+import codecs
+import functools
 
 
 class ForbiddenUsage(Exception):
     pass
 
 
-class MyCPP(pcpp.Preprocessor):
-    def __init__(self):
-        super().__init__()
-        self.line_directive = None
+ALLOWED_DIRECTIVES = {
+    "define",
+    "undef",
+    "ifdef",
+    "ifndef",
+    "if",
+    "elif",
+    "else",
+    "endif",
+}
+
+T_ID = "ID"
+T_INT = "INT"
+T_STRING = "STRING"
+T_CHAR = "CHAR"
+T_WS = "WS"
+"""spaces, a newline, or a comment once stripped"""
+T_LINECONT = "LINECONT"
+T_COMMENT1 = "COMMENT1"
+T_COMMENT2 = "COMMENT2"
+T_POUND = "POUND"
+T_DPOUND = "DPOUND"
+T_OP = "OP"
+
+WS_TYPES = (T_WS, T_LINECONT)
+
+# Same rules and precedence as pcpp's lexer
+TOKEN_RE = re.compile(
+    r"""
+    (?P<WS>[ \t]+|\n)
+    |(?P<LINECONT>\\[ \t]*\n)
+    |(?P<INT>(?:0[xX][0-9a-fA-F]+|\d+)(?:[uU][lL]|[lL][uU]|[uU]|[lL])?)
+    |(?P<STRING>"(?:[^\\\n]|\\(?:.|\n))*?")
+    |(?P<CHAR>L?'(?:[^\\\n]|\\(?:.|\n))*?')
+    |(?P<COMMENT1>/\*(?:.|\n)*?\*/)
+    |(?P<COMMENT2>//[^\n]*)
+    |(?P<ID>[A-Za-z_]\w*)
+    |(?P<DPOUND>\#\#)
+    |(?P<POUND>\#)
+    |(?P<OP><<=|>>=|->|-=|--|<<|<=|>>|>=|\|\||\|=|&&|&=|==|!=|\*=|/=|\+=|\+\+|%=|.)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+STRING_LINECONT_RE = re.compile(r"\\[ \t]*\n")
+TRIGRAPH_RE = re.compile(r"""\?\?[=/\'\(\)\!<>\-]""")
+TRIGRAPH_REPLACEMENTS = {
+    "=": "#",
+    "/": "\\",
+    "'": "^",
+    "(": "[",
+    ")": "]",
+    "!": "|",
+    "<": "{",
+    ">": "}",
+    "-": "~",
+}
+
+
+class Token:
+    __slots__ = ("type", "value", "lineno", "expanded_from")
+
+    def __init__(self, type: str, value: str, lineno: int, expanded_from=None):
+        self.type = type
+        self.value = value
+        self.lineno = lineno
+        self.expanded_from: list[str] | None = expanded_from
+        """names of the macros this token was expanded from, shared by copies"""
 
-    def on_directive_handle(self, directive, toks, ifpassthru, precedingtoks):
-        assert isinstance(directive, pcpp.parser.LexToken)
+    def copy(self):
+        return Token(self.type, self.value, self.lineno, self.expanded_from)
 
-        directive_name = directive.value
+    def __repr__(self):
+        return f"Token({self.type}, {self.value!r}, {self.lineno})"
 
-        if directive_name == "include":
-            raise ForbiddenUsage("#include is forbidden")
 
-        if directive_name not in {
-            "define",
-            "undef",
-            "ifdef",
-            "ifndef",
-            "if",
-            "elif",
-            "else",
-            "endif",
-        }:
-            raise ForbiddenUsage("Unknown directive", directive_name)
+def tokenize(text: str, lineno: int = 1):
+    toks: list[Token] = []
+    for m in TOKEN_RE.finditer(text):
+        type = m.lastgroup
+        value = m.group()
+        tok_lineno = lineno
+        if type == T_LINECONT:
+            value = value[1:-1]
+            lineno += 1
+        elif type == T_STRING:
+            value, n_subs = STRING_LINECONT_RE.subn("", value)
+            lineno += n_subs + value.count("\n")
+        elif type in (T_WS, T_CHAR, T_COMMENT1):
+            lineno += value.count("\n")
+        toks.append(Token(type, value, tok_lineno))
+    return toks
 
-        return super().on_directive_handle(directive, toks, ifpassthru, precedingtoks)
 
-    def on_file_open(self, is_system_include, includepath):
-        raise Exception("#include yeeted")
+def tokenstrip(tokens: list[Token]):
+    """Removes leading and trailing whitespace tokens, in place"""
+    i = 0
+    while i < len(tokens) and tokens[i].type in WS_TYPES:
+        i += 1
+    del tokens[:i]
+    i = len(tokens) - 1
+    while i >= 0 and tokens[i].type in WS_TYPES:
+        i -= 1
+    del tokens[i + 1 :]
+    return tokens
 
-    def on_include_not_found(
-        self, is_malformed, is_system_include, curdir, includepath
+
+def on_error(lineno: int, msg: str):
+    print(f"pycpp:{lineno} error: {msg}", file=sys.stderr)
+
+
+class Macro:
+    def __init__(
+        self,
+        name: str,
+        value: list[Token],
+        arglist: list[str] | None = None,
+        variadic: bool = False,
     ):
-        raise Exception("#include yeeted")
+        self.name = name
+        self.value = value
+        self.arglist = arglist
+        """None for object-like macros"""
+        self.variadic = variadic
+        if variadic:
+            self.vararg = arglist[-1]
+        self.patch: list[tuple[str, int, int]] = []
+        """("e" expanded or "t" as is, arg index, position in value)"""
+        self.str_patch: list[tuple[int, int]] = []
+        self.var_comma_patch: list[int] = []
+        if arglist is not None:
+            self._prescan()
+
+    def _prescan(self):
+        """Finds where the arguments go in the value, once for all expansions"""
+        value = self.value
+        i = 0
+        while i < len(value):
+            if value[i].type == T_ID and value[i].value in self.arglist:
+                argnum = self.arglist.index(value[i].value)
+                j = i - 1
+                while j >= 0 and value[j].type in WS_TYPES:
+                    j -= 1
+                if j >= 0 and value[j].value == "#":
+                    value[i] = value[i].copy()
+                    value[i].type = T_STRING
+                    while i > j:
+                        del value[j]
+                        i -= 1
+                    self.str_patch.append((argnum, i))
+                    continue
+                elif (i > 0 and value[i - 1].value == "##") or (
+                    i + 1 < len(value) and value[i + 1].value == "##"
+                ):
+                    self.patch.append(("t", argnum, i))
+                    i += 1
+                    continue
+                else:
+                    self.patch.append(("e", argnum, i))
+            elif value[i].value == "##":
+                if (
+                    self.variadic
+                    and i > 0
+                    and value[i - 1].value == ","
+                    and i + 1 < len(value)
+                    and value[i + 1].type == T_ID
+                    and value[i + 1].value == self.vararg
+                ):
+                    self.var_comma_patch.append(i - 1)
+            i += 1
+        self.patch.sort(key=lambda p: p[2], reverse=True)
+
+
+class ExprError(Exception):
+    pass
+
+
+INT_MIN = -(1 << 63)
+INT_MASK = (1 << 64) - 1
+
+
+def _sclamp(v: int):
+    return ((v - INT_MIN) & INT_MASK) + INT_MIN
+
+
+def _uclamp(v: int):
+    return v & INT_MASK
+
+
+class Expr:
+    """
+    #if expressions, evaluated like pcpp: 64-bit integers tagged signed or unsigned,
+    && || ?: short-circuit, unknown identifiers and function calls are 0.
+    """
+
+    # binary operators by precedence level, lowest first (the comma and ?: excluded)
+    LEVELS = (
+        ("||",),
+        ("&&",),
+        ("|",),
+        ("^",),
+        ("&",),
+        ("==", "!="),
+        ("<", "<=", ">", ">="),
+        ("<<", ">>"),
+        ("+", "-"),
+        ("*", "/", "%"),
+    )
+
+    def __init__(self, tokens: list[Token]):
+        self.tokens = [tok for tok in tokens if tok.type not in WS_TYPES]
+        self.i = 0
+
+    @classmethod
+    def evaluate(cls, tokens: list[Token]):
+        expr = cls(tokens)
+        node = expr.parse_comma()
+        if expr.i != len(expr.tokens):
+            raise ExprError(f"around token {expr.tokens[expr.i].value!r}")
+        value, unsigned = cls.eval(node)
+        return value
+
+    def peek(self):
+        if self.i < len(self.tokens):
+            return self.tokens[self.i]
+        return None
+
+    def expect(self, value: str):
+        tok = self.peek()
+        if tok is None:
+            raise ExprError("at EOF")
+        if tok.type in (T_STRING, T_CHAR, T_INT) or tok.value != value:
+            raise ExprError(f"around token {tok.value!r}")
+        self.i += 1
+
+    def is_op(self, tok: Token | None, ops):
+        return tok is not None and tok.type in (T_OP, T_POUND) and tok.value in ops
+
+    def parse_comma(self):
+        node = self.parse_ternary()
+        while self.is_op(self.peek(), (",",)):
+            self.i += 1
+            node = (",", node, self.parse_ternary())
+        return node
+
+    def parse_ternary(self):
+        node = self.parse_binary(0)
+        while self.is_op(self.peek(), ("?",)):
+            self.i += 1
+            if_true = self.parse_comma()
+            self.expect(":")
+            # ?: is left-associative in pcpp's grammar
+            node = ("?", node, if_true, self.parse_binary(0))
+        return node
+
+    def parse_binary(self, level: int):
+        if level == len(self.LEVELS):
+            return self.parse_unary()
+        node = self.parse_binary(level + 1)
+        while self.is_op(self.peek(), self.LEVELS[level]):
+            op = self.tokens[self.i].value
+            self.i += 1
+            node = (op, node, self.parse_binary(level + 1))
+        return node
+
+    def parse_unary(self):
+        tok = self.peek()
+        if tok is None:
+            raise ExprError("at EOF")
+        self.i += 1
+        if self.is_op(tok, ("+", "-", "!", "~")):
+            return ("u" + tok.value, self.parse_unary())
+        if self.is_op(tok, ("(",)):
+            node = self.parse_comma()
+            self.expect(")")
+            return node
+        if tok.type in (T_INT, T_CHAR):
+            return ("n", tok.value)
+        if tok.type == T_ID:
+            if self.is_op(self.peek(), ("(",)):
+                self.i += 1
+                self.parse_comma()
+                self.expect(")")
+            # unknown identifiers and functions are 0, as per the C standard
+            return ("n", "0")
+        raise ExprError(f"around token {tok.value!r}")
+
+    @staticmethod
+    def parse_number(s: str):
+        unsigned = False
+        if (s.startswith("L'") or s[0] == "'") and s[-1] == "'":
+            s = s[2 if s.startswith("L'") else 1 : -1]
+            if len(s) == 0:
+                raise ExprError("Empty character escape sequence")
+            s = re.sub(
+                r"""\\U........|\\u....|\\x..|\\[0-7]{1,3}|\\N\{[^}]+\}|\\[\\'"abfnrtv]""",
+                lambda m: codecs.decode(m.group(0), "unicode-escape"),
+                s,
+            )
+            if len(s) != 1:
+                raise ExprError("Multi-character character constant")
+            return _sclamp(ord(s)), False
+        if s.startswith(("0x", "0X")):
+            base, digits = 16, "0123456789abcdefABCDEF"
+        elif s.startswith("0"):
+            base, digits = 8, "01234567"
+        else:
+            base, digits = 10, None
+        while not (s[-1] in digits if digits is not None else s[-1].isdigit()):
+            if s[-1] in "uU":
+                unsigned = True
+            s = s[:-1]
+        try:
+            v = int(s, base)
+        except ValueError as e:
+            raise ExprError(str(e))
+        return (_uclamp(v) if unsigned else _sclamp(v)), unsigned
+
+    @classmethod
+    def eval(cls, node) -> tuple[int, bool]:
+        op = node[0]
+        if op == "n":
+            return cls.parse_number(node[1])
+        if op == "u+":
+            return _sclamp(cls.eval(node[1])[0]), False
+        if op == "u-":
+            v, u = cls.eval(node[1])
+            return (_uclamp(-v) if u else _sclamp(-v)), u
+        if op == "u~":
+            v, u = cls.eval(node[1])
+            return (_uclamp(~v) if u else _sclamp(~v)), u
+        if op == "u!":
+            return (0 if cls.eval(node[1])[0] != 0 else 1), False
+        if op == "&&":
+            return int(cls.eval(node[1])[0] != 0 and cls.eval(node[2])[0] != 0), False
+        if op == "||":
+            return int(cls.eval(node[1])[0] != 0 or cls.eval(node[2])[0] != 0), False
+        if op == ",":
+            return cls.eval(node[2])
+        if op == "?":
+            cond = cls.eval(node[1])[0]
+            taken, other = (node[2], node[3]) if cond != 0 else (node[3], node[2])
+            v, u = cls.eval(taken)
+            try:
+                u = u or cls.eval(other)[1]
+            except (ExprError, ArithmeticError, ValueError):
+                pass
+            return (_uclamp(v) if u else _sclamp(v)), u
+        a, ua = cls.eval(node[1])
+        b, ub = cls.eval(node[2])
+        if op in ("<<", ">>"):
+            # Only the left operand decides, and the result is 64 bits anyway
+            unsigned = ua
+            if unsigned:
+                a, b = _uclamp(a), _uclamp(b)
+            b = min(b, 128)
+        else:
+            unsigned = ua or ub
+            if unsigned:
+                a, b = _uclamp(a), _uclamp(b)
+        if op == "*":
+            v = a * b
+        elif op == "/":
+            if b == 0:
+                raise ZeroDivisionError("division by zero")
+            v = int(a / b)
+        elif op == "%":
+            v = a % b
+        elif op == "+":
+            v = a + b
+        elif op == "-":
+            v = a - b
+        elif op == "<<":
+            v = a << b
+        elif op == ">>":
+            v = a >> b
+        elif op == "&":
+            v = a & b
+        elif op == "^":
+            v = a ^ b
+        elif op == "|":
+            v = a | b
+        else:
+            v = {
+                "<": a < b,
+                "<=": a <= b,
+                ">": a > b,
+                ">=": a >= b,
+                "==": a == b,
+                "!=": a != b,
+            }[op]
+        return (_uclamp(v) if unsigned else _sclamp(v)), unsigned
+
+
+class Preprocessor:
+    def __init__(self):
+        self.macros: dict[str, Macro] = dict()
+        self.linemacro = 0
+        self.linemacrodepth = 0
+        self.countermacro = 0
+
+        self.enable = True
+        self.iftrigger = False
+        self.ifstack: list[tuple[bool, bool, list[Token]]] = []
+        self.lineno = 1
+        """line number the next parsed text starts at"""
+
+        tm = time.localtime()
+        self.define_str('__DATE__ "%s"' % time.strftime("%b %d %Y", tm))
+        self.define_str('__TIME__ "%s"' % time.strftime("%H:%M:%S", tm))
+        self.define_str("__PCPP__ 1")
+        self.define_str('__FILE__ ""')
+
+    def copy(self):
+        pp = Preprocessor.__new__(Preprocessor)
+        pp.__dict__.update(self.__dict__)
+        pp.macros = self.macros.copy()
+        pp.ifstack = self.ifstack.copy()
+        return pp
+
+    def define_str(self, text: str):
+        self.define(tokenize(text))
+
+    def define(self, tokens: list[Token]):
+        tokens = [tok.copy() for tok in tokens]
+        name = tokens[0]
+        mtype = tokens[1] if len(tokens) > 1 else None
+        if mtype is None:
+            self.macros[name.value] = Macro(name.value, [])
+        elif mtype.type in WS_TYPES:
+            self.macros[name.value] = Macro(name.value, tokenstrip(tokens[2:]))
+        elif mtype.value == "(":
+            tokcount, args, positions = self.collect_args(tokens[1:])
+            variadic = False
+            for a in args:
+                if variadic:
+                    on_error(
+                        name.lineno, "No more arguments may follow a variadic argument"
+                    )
+                    break
+                astr = "".join(tok.value for tok in a)
+                if astr == "...":
+                    variadic = True
+                    a[0].type = T_ID
+                    a[0].value = "__VA_ARGS__"
+                    del a[1:]
+                    continue
+                elif astr[-3:] == "..." and a[0].type == T_ID:
+                    variadic = True
+                    del a[1:]
+                    continue
+                # Empty arguments are permitted
+                if len(a) == 0 and len(args) == 1:
+                    continue
+                if len(a) > 1 or a[0].type != T_ID:
+                    on_error(a[0].lineno, "Invalid macro argument")
+                    break
+            else:
+                mvalue = tokenstrip(tokens[1 + tokcount :])
+                i = 0
+                while i < len(mvalue):
+                    if i + 1 < len(mvalue):
+                        if mvalue[i].type in WS_TYPES and mvalue[i + 1].value == "##":
+                            del mvalue[i]
+                            continue
+                        elif mvalue[i].value == "##" and mvalue[i + 1].type in WS_TYPES:
+                            del mvalue[i + 1]
+                    i += 1
+                self.macros[name.value] = Macro(
+                    name.value,
+                    mvalue,
+                    [a[0].value for a in args] if args != [[]] else [],
+                    variadic,
+                )
+        else:
+            on_error(name.lineno, "Bad macro definition")
+
+    def undef(self, tokens: list[Token]):
+        self.macros.pop(tokens[0].value, None)
+
+    def collect_args(self, tokens: list[Token], ignore_errors=False):
+        """
+        Collects the comma separated arguments within parentheses at the start of
+        tokens. Returns (number of tokens consumed, args, start index of each arg),
+        the number of tokens consumed is 0 if unclosed.
+        """
+        args: list[list[Token]] = []
+        positions: list[int] = []
+        current_arg: list[Token] = []
+        nesting = 1
+        i = 0
+        while i < len(tokens) and tokens[i].type in WS_TYPES:
+            i += 1
+        if i < len(tokens) and tokens[i].value == "(":
+            positions.append(i + 1)
+        else:
+            if not ignore_errors:
+                on_error(tokens[0].lineno, "Missing '(' in macro arguments")
+            return 0, [], []
+        i += 1
+        while i < len(tokens):
+            tok = tokens[i]
+            if tok.value == "(":
+                current_arg.append(tok)
+                nesting += 1
+            elif tok.value == ")":
+                nesting -= 1
+                if nesting == 0:
+                    args.append(tokenstrip(current_arg))
+                    positions.append(i)
+                    return i + 1, args, positions
+                current_arg.append(tok)
+            elif tok.value == "," and nesting == 1:
+                args.append(tokenstrip(current_arg))
+                positions.append(i + 1)
+                current_arg = []
+            else:
+                current_arg.append(tok)
+            i += 1
+        if not ignore_errors:
+            on_error(tokens[-1].lineno, "Missing ')' in macro arguments")
+        return 0, [], []
+
+    def macro_expand_args(self, macro: Macro, args: list[list[Token]]):
+        """Returns the replacement tokens of a function-like macro for the args"""
+        rep: list[Token | None] = [tok.copy() for tok in macro.value]
+
+        str_expansion: dict[int, str] = dict()
+        for argnum, i in macro.str_patch:
+            if argnum not in str_expansion:
+                # (like pcpp, this also changes the whitespace of the arg itself)
+                tokens = args[argnum].copy()
+                for tok in tokens:
+                    if tok.type == T_WS:
+                        tok.value = " "
+                j = 0
+                while j < len(tokens) - 1:
+                    if tokens[j].type in WS_TYPES and tokens[j + 1].type in WS_TYPES:
+                        del tokens[j + 1]
+                    else:
+                        j += 1
+                s = "".join(tok.value for tok in tokens)
+                s = s.replace("\\", "\\\\").replace('"', '\\"')
+                str_expansion[argnum] = '"' + s + '"'
+            rep[i] = rep[i].copy()
+            rep[i].value = str_expansion[argnum]
+
+        comma_patch = False
+        if macro.variadic and not args[-1]:
+            for i in macro.var_comma_patch:
+                rep[i] = None
+                comma_patch = True
+
+        expanded: dict[int, list[Token]] = dict()
+        for ptype, argnum, i in macro.patch:
+            if ptype == "t":
+                rep[i : i + 1] = args[argnum]
+            else:
+                if argnum not in expanded:
+                    expanded[argnum] = self.expand_macros(args[argnum].copy())
+                rep[i : i + 1] = expanded[argnum]
+
+        if comma_patch:
+            rep = [tok for tok in rep if tok is not None]
+
+        while rep and rep[0].type == T_DPOUND:
+            del rep[0]
+        while rep and rep[-1].type == T_DPOUND:
+            del rep[-1]
+        i = 1
+        stitched = False
+        while i < len(rep) - 1:
+            if rep[i].type == T_DPOUND:
+                j = i + 1
+                while rep[j].type == T_DPOUND:
+                    j += 1
+                rep[i - 1] = rep[i - 1].copy()
+                rep[i - 1].type = None
+                rep[i - 1].value += rep[j].value
+                while j >= i:
+                    del rep[i]
+                    j -= 1
+                stitched = True
+            else:
+                i += 1
+        if stitched:
+            # Lex pasted tokens again
+            i = 0
+            while i < len(rep):
+                if rep[i].type is None:
+                    toks = tokenize(rep[i].value)
+                    while len(toks) > 1:
+                        rep.insert(i + 1, rep[i].copy())
+                        rep[i + 1].value = toks[-1].value
+                        rep[i + 1].type = toks[-1].type
+                        toks.pop()
+                    rep[i].value = toks[0].value
+                    rep[i].type = toks[0].type
+                i += 1
+
+        return rep
+
+    def expand_macros(self, tokens: list[Token], expanding_from: tuple[str] = ()):
+        for tok in tokens:
+            if tok.expanded_from is None:
+                tok.expanded_from = []
+        i = 0
+        while i < len(tokens):
+            t = tokens[i]
+            if self.linemacrodepth == 0:
+                self.linemacro = t.lineno
+            self.linemacrodepth += 1
+            if t.type == T_ID:
+                if (
+                    t.value in self.macros
+                    and t.value not in t.expanded_from
+                    and t.value not in expanding_from
+                ):
+                    m = self.macros[t.value]
+                    if m.arglist is None:
+                        rep = [tok.copy() for tok in m.value]
+                        ex = self.expand_macros(rep, expanding_from + (t.value,))
+                        for e in ex:
+                            e.lineno = t.lineno
+                            if e.expanded_from is None:
+                                e.expanded_from = []
+                            e.expanded_from.append(t.value)
+                        tokens[i : i + 1] = ex
+                    else:
+                        j = i + 1
+                        while j < len(tokens) and tokens[j].type in WS_TYPES:
+                            j += 1
+                        # A function-like macro without arguments is left as is
+                        if j == len(tokens) or tokens[j].value != "(":
+                            i = j
+                        else:
+                            tokcount, args, positions = self.collect_args(
+                                tokens[j:], True
+                            )
+                            if tokcount == 0:
+                                # Unclosed arguments
+                                break
+                            if (
+                                not m.variadic
+                                # A macro with at most one parameter may be called with nothing
+                                and (args != [[]] or len(m.arglist) > 1)
+                                and len(args) != len(m.arglist)
+                            ):
+                                on_error(
+                                    t.lineno,
+                                    f"Macro {t.value} requires {len(m.arglist)}"
+                                    f" arguments but was passed {len(args)}",
+                                )
+                                i = j + tokcount
+                            elif m.variadic and len(args) < len(m.arglist) - 1:
+                                on_error(
+                                    t.lineno,
+                                    f"Macro {t.value} must have at least"
+                                    f" {len(m.arglist) - 1} argument(s)",
+                                )
+                                i = j + tokcount
+                            else:
+                                if m.variadic:
+                                    if len(args) == len(m.arglist) - 1:
+                                        args.append([])
+                                    else:
+                                        n_fixed = len(m.arglist) - 1
+                                        args[n_fixed] = tokens[
+                                            j + positions[n_fixed] : j + tokcount - 1
+                                        ]
+                                        del args[len(m.arglist) :]
+                                else:
+                                    while len(args) < len(m.arglist):
+                                        args.append([])
+                                rep = self.macro_expand_args(m, args)
+                                ex = self.expand_macros(
+                                    rep, expanding_from + (t.value,)
+                                )
+                                for e in ex:
+                                    e.lineno = t.lineno
+                                    if e.expanded_from is None:
+                                        e.expanded_from = []
+                                    e.expanded_from.append(t.value)
+                                # Like GCC and clang (and pcpp), a space separates
+                                # the expansion from a following identifier
+                                if (
+                                    len(tokens) > j + tokcount
+                                    and tokens[j + tokcount].type == T_ID
+                                ):
+                                    newtok = tokens[j + tokcount].copy()
+                                    newtok.type = T_WS
+                                    newtok.value = " "
+                                    ex.append(newtok)
+                                tokens[i : j + tokcount] = ex
+                    self.linemacrodepth -= 1
+                    if self.linemacrodepth == 0:
+                        self.linemacro = 0
+                    continue
+                elif t.value == "__LINE__":
+                    t.type = T_INT
+                    t.value = str(self.linemacro)
+                elif t.value == "__COUNTER__":
+                    t.type = T_INT
+                    t.value = str(self.countermacro)
+                    self.countermacro += 1
+            i += 1
+            self.linemacrodepth -= 1
+            if self.linemacrodepth == 0:
+                self.linemacro = 0
+        return tokens
+
+    def replace_defined(self, tokens: list[Token]):
+        i = 0
+        while i < len(tokens):
+            if tokens[i].type == T_ID and tokens[i].value == "defined":
+                j = i + 1
+                needparen = False
+                result = "0L"
+                while j < len(tokens):
+                    if tokens[j].type in WS_TYPES:
+                        j += 1
+                        continue
+                    elif tokens[j].type == T_ID:
+                        if tokens[j].value in self.macros:
+                            result = "1L"
+                        if not needparen:
+                            break
+                    elif tokens[j].value == "(":
+                        needparen = True
+                    elif tokens[j].value == ")":
+                        break
+                    else:
+                        on_error(tokens[i].lineno, "Malformed defined()")
+                    j += 1
+                tokens[i].type = T_INT
+                tokens[i].value = result
+                del tokens[i + 1 : j + 1]
+            i += 1
+        return tokens
+
+    def evalexpr(self, tokens: list[Token]):
+        if not tokens:
+            on_error(0, "Empty expression")
+            return 0
+        tokens = self.replace_defined(tokens)
+        tokens = self.expand_macros(tokens)
+        tokens = self.replace_defined(tokens)
+        if not tokens:
+            return 0
+        try:
+            return Expr.evaluate(tokens)
+        except (ExprError, ArithmeticError, ValueError) as e:
+            on_error(
+                tokens[0].lineno,
+                f"Could not evaluate expression due to {e!r}"
+                f" (passed to evaluator: '{''.join(tok.value for tok in tokens)}')",
+            )
+            return 0
+
+    def group_lines(self, text: str):
+        lines = [line.rstrip() for line in text.splitlines()]
+        current_line: list[Token] = []
+        for tok in tokenize("\n".join(lines), self.lineno):
+            current_line.append(tok)
+            if tok.type == T_WS and tok.value == "\n":
+                yield current_line
+                current_line = []
+        if current_line:
+            nltok = current_line[-1].copy()
+            nltok.type = T_WS
+            nltok.value = "\n"
+            current_line.append(nltok)
+            yield current_line
+        self.lineno += len(lines)
+
+    def parsegen(self, text: str):
+        """Yields the output tokens"""
+        text = TRIGRAPH_RE.sub(lambda m: TRIGRAPH_REPLACEMENTS[m.group()[-1]], text)
+        chunk: list[Token] = []
+
+        for x in self.group_lines(text):
+            for tok in x:
+                if tok.type == T_COMMENT1:
+                    tok.type = T_WS
+                    tok.value = " "
+                elif tok.type == T_COMMENT2:
+                    tok.type = T_WS
+                    tok.value = "\n"
+            for i, tok in enumerate(x):
+                if tok.type not in WS_TYPES:
+                    break
+
+            if tok.value != "#":
+                if self.enable:
+                    chunk.extend(x)
+                else:
+                    # Keep the line count
+                    chunk.extend(tok for tok in x if tok.type in WS_TYPES)
+                continue
+
+            i += 1
+            while i < len(x) and x[i].type in WS_TYPES:
+                i += 1
+            dirtokens = tokenstrip(x[i:])
+            if not dirtokens:
+                continue
+            name = dirtokens[0].value
+            args = tokenstrip(dirtokens[1:])
+
+            if name == "include":
+                raise ForbiddenUsage("#include is forbidden")
+            if name not in ALLOWED_DIRECTIVES:
+                raise ForbiddenUsage("Unknown directive", name)
+
+            if name in ("define", "undef"):
+                if self.enable:
+                    yield from self.expand_macros(chunk)
+                    chunk = []
+                    if name == "define":
+                        self.define(args)
+                    else:
+                        self.undef(args)
+            elif name in ("ifdef", "ifndef"):
+                self.ifstack.append((self.enable, self.iftrigger, x))
+                if self.enable:
+                    if (args[0].value in self.macros) == (name == "ifdef"):
+                        self.iftrigger = True
+                    else:
+                        self.enable = False
+                        self.iftrigger = False
+            elif name == "if":
+                self.ifstack.append((self.enable, self.iftrigger, x))
+                if self.enable:
+                    self.iftrigger = False
+                    if not self.evalexpr(args):
+                        self.enable = False
+                    else:
+                        self.iftrigger = True
+            elif name == "elif":
+                if self.ifstack:
+                    if self.ifstack[-1][0]:
+                        if self.enable:
+                            self.enable = False
+                        elif not self.iftrigger:
+                            if self.evalexpr(args):
+                                self.enable = True
+                                self.iftrigger = True
+                else:
+                    on_error(dirtokens[0].lineno, "Misplaced #elif")
+            elif name == "else":
+                if self.ifstack:
+                    if self.ifstack[-1][0]:
+                        if self.enable:
+                            self.enable = False
+                        elif not self.iftrigger:
+                            self.enable = True
+                            self.iftrigger = True
+                else:
+                    on_error(dirtokens[0].lineno, "Misplaced #else")
+            elif name == "endif":
+                if self.ifstack:
+                    self.enable, self.iftrigger, _ = self.ifstack.pop()
+                else:
+                    on_error(dirtokens[0].lineno, "Misplaced #endif")
+
+        yield from self.expand_macros(chunk)
+
+    def check_ifstack(self):
+        for _, _, startlinetoks in self.ifstack:
+            on_error(
+                startlinetoks[0].lineno,
+                "Unterminated " + "".join(tok.value for tok in startlinetoks),
+            )
+
+    @staticmethod
+    def write(tokens):
+        """Joins the output tokens into text, the same way as pcpp"""
+        out: list[str] = []
+        it = iter(tokens)
+        lastlineno = 0
+        done = False
+        while not done:
+            toks: list[Token] = []
+            all_ws = True
+            # Accumulate a line
+            for tok in it:
+                toks.append(tok)
+                if tok.value and tok.value[0] == "\n":
+                    break
+                if tok.type not in WS_TYPES:
+                    all_ws = False
+            else:
+                done = True
+            if not toks:
+                break
+            if all_ws:
+                continue
+            # Remove line continuations, collapsing whitespace around them
+            for n in range(len(toks) - 1, -1, -1):
+                if toks[n].type == T_LINECONT:
+                    if (
+                        n > 0
+                        and n < len(toks) - 2
+                        and toks[n - 1].type in WS_TYPES
+                        and toks[n + 1].type in WS_TYPES
+                    ):
+                        if toks[n - 1].type != T_LINECONT:
+                            toks[n - 1].value = toks[n - 1].value[0]
+                            del toks[n : n + 2]
+                    else:
+                        del toks[n]
+            # Keep only the last of consecutive whitespace tokens, except indent
+            first_ws = None
+            for n in range(len(toks) - 1, -1, -1):
+                tok = toks[n]
+                if first_ws is None:
+                    if tok.type == T_WS or len(tok.value) == 0:
+                        first_ws = n
+                elif tok.type != T_WS and len(tok.value) > 0:
+                    del toks[n + 1 : first_ws]
+                    first_ws = None
+            out.append("\n" * max(0, toks[0].lineno - lastlineno - 1))
+            lastlineno = toks[0].lineno
+            out.extend(tok.value for tok in toks)
+        return "".join(out)
 
 
 def my_preprocess(text: str):
-    mycpp = MyCPP()
-    mycpp.parse(text)
-    out = io.StringIO()
-    mycpp.write(out)
-    return out.getvalue()
+    pp = Preprocessor()
+    out = pp.write(pp.parsegen(text))
+    pp.check_ifstack()
+    return out
+
+
+@functools.lru_cache(maxsize=4)
+def compile_context(context: str):
+    """
+    Parses context (macro definitions only) once, for preprocess_with_context.
+    Returns the preprocessor state after it.
+    """
+    pp = Preprocessor()
+    for tok in pp.parsegen(context + "\n"):
+        if tok.type not in WS_TYPES:
+            raise ValueError("context must not output anything", tok)
+    if pp.ifstack:
+        raise ValueError("context has unterminated conditionals")
+    return pp
+
+
+def preprocess_with_context(context: str, text: str):
+    """Same as my_preprocess(context + "\\n" + text), without parsing context again"""
+    pp = compile_context(context).copy()
+    out = pp.write(pp.parsegen(text))
+    pp.check_ifstack()
+    return out
+
+
+def _random_query(rng):
+    """Random soup of the tokens queries are made of, for main()"""
+    pieces = [
+        "top(",
+        "(",
+        ")",
+        ",",
+        "#",
+        "##",
+        " ",
+        "  ",
+        "\n",
+        "\\\n",
+        "/* c */",
+        "// c\n",
+        "'a'",
+        '"s"',
+        "0x1F",
+        "3u",
+        "-1",
+        "==",
+        "<<",
+        "?",
+        ":",
+        "&&",
+        "!",
+        "defined",
+        "NJ",
+        "Joined",
+        "td",
+        "tdw",
+        "tds",
+        "mytop",
+        "amount",
+        "x",
+        "__LINE__",
+        "#define F(a, ...) a ## __VA_ARGS__ #a\n",
+        "#define O x NJ\n",
+        "#undef NJ\n",
+        "#if ",
+        "#ifdef ",
+        "#elif ",
+        "#else\n",
+        "#endif\n",
+    ]
+    return "".join(rng.choice(pieces) for _ in range(rng.randint(1, 30)))
 
 
 def main():
-    mycpp = MyCPP()
-    mycpp.parse(
-        """#define Joined zoos join animals using(animal_id)
-SELECT * FROM Joined
-"""
-        + """#define k1 nopelol
-#define B(n) z # n k ## n
-B(1)
+    """
+    Checks pycpp produces the same output as pcpp (see pycpp_reference.py),
+    on cpp_context.sql and a corpus of queries, and compares speed.
+    """
+    import random
+    import contextlib
+    import io
+    from pathlib import Path
 
-#define Score CASE is_rare WHEN TRUE THEN 5 * amount ELSE amount END
-"""
-    )
-    out = io.StringIO()
-    mycpp.write(out)
-    print(out.getvalue())
+    import pycpp_reference
+
+    cpp_context = (Path(__file__).parent / "cpp_context.sql").read_text()
+
+    queries = [
+        "",
+        "SELECT * FROM Joined",
+        "SELECT user_name, animal_name FROM Joined WHERE amount > 3",
+        "top(amount > 10)",
+        "top (is_rare)",
+        "top(animal_name = 'Pig' and amount_now\n> 3)",
+        "top()",
+        "top(a, b)",
+        "td",
+        "tdw(+1 hour)",
+        'tdw("+2 days") limit 3',
+        "tds",
+        "mytop",
+        "mytop where user_name like '%a%' -- comment\n",
+        "/* multi\nline */ select 1\n\n\nselect 2   \n",
+        "#define Score CASE is_rare WHEN TRUE THEN 5 * amount ELSE amount END\n"
+        "SELECT user_name, sum(Score) FROM Joined GROUP BY user_id",
+        "#define k1 nopelol\n#define B(n) z # n k ## n\nB(1)",
+        '#define s(x) #x\ns("a\\"b") s(\'x\') s( a  /* c */  b )',
+        "#define p(a,b) a##b\np(x,y) p(,y) p(x,) p(1,2) p(+,=)",
+        "#define lst(...) [__VA_ARGS__]\nlst(1, 2) lst()",
+        "#define f(a) <a>\n#define g f\ng(1)",
+        "#define X X+1\nX\n#define A B\n#define B A\nA B",
+        "#if defined(NJ) && (1 << 3) == 8 && -1 < 0u\nT\n#elif 1\nE\n#else\nF\n#endif",
+        "#if 2 > 1 ? 3 : 0\nT\n#endif",
+        "#ifdef td\nyes\n#endif\n#ifndef td\nno\n#endif",
+        "#if 1\nunterminated",
+        "#endif",
+        "#define x(",
+        "a 'don''t' b\n\"unterminated\nfoo",
+        "__LINE__ __COUNTER__ __COUNTER__",
+        "#include <x>",
+        "#pragma x",
+    ]
+    rng = random.Random(421)
+    queries.extend(_random_query(rng) for _ in range(2000))
+
+    def run(preprocess, text):
+        # Errors are printed, discard them
+        with contextlib.redirect_stderr(io.StringIO()), contextlib.redirect_stdout(
+            io.StringIO()
+        ):
+            try:
+                return preprocess(text)
+            except Exception as e:
+                return type(e).__name__
+
+    n_mismatches = 0
+    for query in queries:
+        expected = run(pycpp_reference.my_preprocess, cpp_context + "\n" + query)
+        got = run(my_preprocess, cpp_context + "\n" + query)
+        got_with_context = run(
+            lambda text: preprocess_with_context(cpp_context, text), query
+        )
+        if got != expected or got_with_context != expected:
+            n_mismatches += 1
+            print("Mismatch on", repr(query))
+            print("  pcpp: ", repr(expected))
+            print("  pycpp:", repr(got))
+            print("  pycpp (cached context):", repr(got_with_context))
+    print(len(queries), "queries,", n_mismatches, "mismatches")
+
+    bench_queries = queries[:20]
+    for name, preprocess in (
+        ("pcpp", lambda q: pycpp_reference.my_preprocess(cpp_context + "\n" + q)),
+        ("pycpp", lambda q: my_preprocess(cpp_context + "\n" + q)),
+        ("pycpp (cached context)", lambda q: preprocess_with_context(cpp_context, q)),
+    ):
+        start = time.perf_counter()
+        for query in bench_queries:
+            run(preprocess, query)
+        duration = time.perf_counter() - start
+        print(f"{name}: {duration / len(bench_queries) * 1000:.3f} ms/query")
+
+    if n_mismatches != 0:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,322 @@
+# SPDX-FileCopyrightText: 2024 Dragorn421
+# SPDX-License-Identifier: CC0-1.0
+
+"""
+Replays synthetic activity traces through ZooPeekerDataRefresher in virtual time,
+to benchmark refresh policies offline.
+
+Reports the refreshes issued, how long refreshes lag behind activity and todos,
+and the CPU time spent scheduling.
+"""
+
+import argparse
+import bisect
+import contextlib
+import dataclasses
+import datetime
+import os
+import queue
+import random
+import time
+import types
+
+import zoopeeker
+
+
+class VirtualClock:
+    def __init__(self, now: datetime.datetime):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class SimUser:
+    def __init__(self, i: int, sessions_per_day: float, change_probability: float):
+        self.name = f"simuser{i}"
+        self.discord_id = i
+        self.sessions_per_day = sessions_per_day
+        self.change_probability = change_probability
+        """How likely a refresh is to find the user's data changed"""
+
+    def __str__(self):
+        return f"SimUser<{self.name}>"
+
+
+@dataclasses.dataclass(order=True)
+class SimEvent:
+    time: datetime.datetime
+    seq: int
+    user: SimUser = dataclasses.field(compare=False)
+    todo_times: list[datetime.datetime] | None = dataclasses.field(compare=False)
+    """None for activity (a zoo message)"""
+
+
+def generate_trace(
+    rng: random.Random,
+    users: list[SimUser],
+    start: datetime.datetime,
+    duration: datetime.timedelta,
+    messages_per_session: float = 6,
+    message_interval: datetime.timedelta = datetime.timedelta(seconds=20),
+    todo_view_probability: float = 0.3,
+):
+    """
+    Users play in sessions (a Poisson process) of a few messages each,
+    and sometimes look at their upcoming todos during a session.
+    """
+    events: list[SimEvent] = []
+    seq = 0
+    end = start + duration
+    for user in users:
+        t = start
+        while True:
+            t += datetime.timedelta(days=rng.expovariate(user.sessions_per_day))
+            if t >= end:
+                break
+            session_t = t
+            n_messages = 1 + int(rng.expovariate(1 / (messages_per_session - 1)))
+            for i in range(n_messages):
+                if session_t >= end:
+                    break
+                events.append(SimEvent(session_t, seq, user, None))
+                seq += 1
+                if i == 0 and rng.random() < todo_view_probability:
+                    todo_times = [
+                        session_t + datetime.timedelta(minutes=rng.uniform(5, 8 * 60))
+                        for _ in range(rng.randint(1, 4))
+                    ]
+                    events.append(SimEvent(session_t, seq, user, todo_times))
+                    seq += 1
+                session_t += datetime.timedelta(
+                    seconds=rng.expovariate(1 / message_interval.total_seconds())
+                )
+    events.sort()
+    return events
+
+
+def percentiles(values: list[float], ps=(50, 90, 99, 100)):
+    if not values:
+        return "n/a"
+    values = sorted(values)
+    return ", ".join(
+        f"p{p}={values[min(len(values) - 1, len(values) * p // 100)]:.1f}s" for p in ps
+    )
+
+
+def simulate(
+    events: list[SimEvent],
+    start: datetime.datetime,
+    duration: datetime.timedelta,
+    configure_refresher=None,
+    rng: random.Random | None = None,
+):
+    """rng decides whether each refresh changed the user's data"""
+    if rng is None:
+        rng = random.Random(0)
+    clock = VirtualClock(start)
+    refreshes: list[tuple[datetime.datetime, SimUser]] = []
+    n_full_refreshes = 0
+
+    def record_refresh(refresh_impl, user, fetch_future, only_current_profile):
+        nonlocal n_full_refreshes
+        refreshes.append((clock(), user))
+        if not only_current_profile:
+            n_full_refreshes += 1
+        refresher.record_refresh_outcome(user, rng.random() < user.change_probability)
+
+    refresher = zoopeeker.ZooPeekerDataRefresher(
+        # Only fetch_pool is used, refreshes are recorded by call_soon
+        types.SimpleNamespace(fetch_pool=None),
+        record_refresh,
+        clock,
+        queue.SimpleQueue(),
+    )
+    if configure_refresher is not None:
+        configure_refresher(refresher)
+
+    tick = datetime.timedelta(seconds=1)
+    end = start + duration
+    n_steps = 0
+    step_cpu_time = 0.0
+
+    def step(item):
+        nonlocal n_steps, step_cpu_time
+        t0 = time.process_time()
+        refresher.step(item, clock())
+        step_cpu_time += time.process_time() - t0
+        n_steps += 1
+
+    # The refresher logs every notification and refresh
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        next_tick = start
+        for event in _with_end_sentinel(events, end):
+            # Like the queue.get(timeout=1) in ZooPeekerDataRefresher._run
+            while next_tick < event.time:
+                clock.now = next_tick
+                step(None)
+                next_tick += tick
+            if event.user is None:
+                break
+            clock.now = event.time
+            if event.todo_times is None:
+                refresher.notify_activity(event.user)
+            else:
+                refresher.notify_todos(
+                    event.user,
+                    # Todo views replace their profile's plans, each simulated
+                    # one is of its own profile so the report's todos all stay
+                    event.seq,
+                    [
+                        zoopeeker.TodoThing("⏰", "sim", _t.astimezone())
+                        for _t in event.todo_times
+                    ],
+                )
+            step(refresher.queue.get_nowait())
+            next_tick = clock.now + tick
+
+    return refreshes, n_full_refreshes, n_steps, step_cpu_time, refresher
+
+
+def _with_end_sentinel(events: list[SimEvent], end: datetime.datetime):
+    """events, then a sentinel event at end"""
+    yield from events
+    yield SimEvent(end, -1, None, None)
+
+
+def report(
+    events: list[SimEvent],
+    refreshes: list[tuple[datetime.datetime, SimUser]],
+    n_full_refreshes: int,
+    n_steps: int,
+    step_cpu_time: float,
+    duration: datetime.timedelta,
+    todo_refresh_delay: datetime.timedelta,
+):
+    refresh_times_by_user: dict[SimUser, list[datetime.datetime]] = dict()
+    for t, user in refreshes:
+        refresh_times_by_user.setdefault(user, []).append(t)
+
+    # Delay between activity and the refresh that follows it
+    first_activity_delays = []
+    last_activity_delays = []
+    n_activity_unrefreshed = 0
+    activity_times_by_refresh: dict[
+        tuple[SimUser, datetime.datetime], list[datetime.datetime]
+    ] = dict()
+    todo_lateness = []
+    n_todos_missed = 0
+    for event in events:
+        user_refreshes = refresh_times_by_user.get(event.user, [])
+        i = bisect.bisect_left(user_refreshes, event.time)
+        if event.todo_times is None:
+            if i == len(user_refreshes):
+                n_activity_unrefreshed += 1
+                continue
+            activity_times_by_refresh.setdefault(
+                (event.user, user_refreshes[i]), []
+            ).append(event.time)
+        else:
+            for todo_time in event.todo_times:
+                due = todo_time + todo_refresh_delay
+                j = bisect.bisect_left(user_refreshes, due)
+                if j == len(user_refreshes):
+                    n_todos_missed += 1
+                else:
+                    todo_lateness.append((user_refreshes[j] - due).total_seconds())
+    for (user, refresh_time), activity_times in activity_times_by_refresh.items():
+        first_activity_delays.append((refresh_time - activity_times[0]).total_seconds())
+        last_activity_delays.append((refresh_time - activity_times[-1]).total_seconds())
+
+    n_activity = sum(1 for event in events if event.todo_times is None)
+    n_todos = sum(len(event.todo_times or ()) for event in events)
+    hours = duration.total_seconds() / 3600
+    print(f"simulated {hours:g} h, {len(refresh_times_by_user)} users refreshed")
+    print(f"activity events: {n_activity}, todos: {n_todos}")
+    print(
+        f"refreshes issued: {len(refreshes)}"
+        f" ({len(refreshes) / hours:.0f}/h,"
+        f" {len(refreshes) / max(1, n_activity):.2f} per activity event)"
+    )
+    print(f"of which full refreshes (all profiles): {n_full_refreshes}")
+    print("debounce delay from first activity:", percentiles(first_activity_delays))
+    print("debounce delay from last activity: ", percentiles(last_activity_delays))
+    print("activity events left unrefreshed at the end:", n_activity_unrefreshed)
+    print("refresh lateness after todo due:", percentiles(todo_lateness))
+    print("todos not refreshed after (due past the end):", n_todos_missed)
+    print(
+        f"scheduler CPU: {step_cpu_time:.3f} s over {n_steps} steps"
+        f" ({step_cpu_time / max(1, n_steps) * 1e6:.1f} us/step,"
+        f" {step_cpu_time / hours:.3f} s per simulated hour)"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulate ZooPeekerDataRefresher on synthetic activity"
+    )
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--hours", type=float, default=2)
+    parser.add_argument("--sessions-per-day", type=float, default=8)
+    parser.add_argument("--seed", type=int, default=421)
+    parser.add_argument(
+        "--min-wait", type=float, help="min_wait_after_activity, in seconds"
+    )
+    parser.add_argument(
+        "--max-wait", type=float, help="max_wait_after_activity, in seconds"
+    )
+    parser.add_argument(
+        "--max-slowdown", type=float, help="max_slowdown, 1 to not adapt to users"
+    )
+    parser.add_argument(
+        "--max-debounce-slowdown",
+        type=float,
+        help="max_debounce_slowdown, 1 to not adapt to users",
+    )
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    users = [
+        # Some users play a lot more than others
+        SimUser(
+            i,
+            args.sessions_per_day * rng.lognormvariate(0, 1),
+            # Most activity changes something, some users mostly just look
+            rng.betavariate(2, 1),
+        )
+        for i in range(args.users)
+    ]
+    start = datetime.datetime(2024, 6, 1, 12)
+    duration = datetime.timedelta(hours=args.hours)
+    events = generate_trace(rng, users, start, duration)
+
+    def configure_refresher(refresher: zoopeeker.ZooPeekerDataRefresher):
+        if args.min_wait is not None:
+            refresher.min_wait_after_activity = datetime.timedelta(
+                seconds=args.min_wait
+            )
+        if args.max_wait is not None:
+            refresher.max_wait_after_activity = datetime.timedelta(
+                seconds=args.max_wait
+            )
+        if args.max_slowdown is not None:
+            refresher.max_slowdown = args.max_slowdown
+        if args.max_debounce_slowdown is not None:
+            refresher.max_debounce_slowdown = args.max_debounce_slowdown
+
+    refreshes, n_full_refreshes, n_steps, step_cpu_time, refresher = simulate(
+        events, start, duration, configure_refresher, random.Random(args.seed)
+    )
+    report(
+        events,
+        refreshes,
+        n_full_refreshes,
+        n_steps,
+        step_cpu_time,
+        duration,
+        refresher.todo_refresh_delay,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,22 @@
 # SPDX-FileCopyrightText: 2024 Dragorn421
 # SPDX-License-Identifier: CC0-1.0
 
+import asyncio
 import json
 import enum
 import dataclasses
+import threading
+import contextlib
+import contextvars
+import concurrent.futures
+import heapq
+import itertools
+import time
 
 import requests
 
+import zoometrics
+
 
 def get_profile_view_url(id: str):
     return "https://gdcolon.com/zoo/" + id
@@ -178,79 +188,229 @@ class ProfileDataUnavailableError(Exception):
         self.error_name = error_name
         self.error_msg = error_msg
 
+    def __reduce__(self):
+        return (self.__class__, (self.error_id, self.error_name, self.error_msg))
+
+
+class RequestPriority(enum.IntEnum):
+    INTERACTIVE = 0
+    """someone is waiting on the result (commands)"""
+    BACKGROUND = 1
+    """refreshes, todo ingestion"""
+
+
+current_request_priority = contextvars.ContextVar(
+    "current_request_priority", default=RequestPriority.INTERACTIVE
+)
+
+
+@contextlib.contextmanager
+def request_priority(priority: RequestPriority):
+    """Requests made within use the given priority with the rate limiter"""
+    token = current_request_priority.set(priority)
+    try:
+        yield
+    finally:
+        current_request_priority.reset(token)
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all Zoo API requests of the process.
+    Waiting requests are served by priority, then in arrival order.
+    Waiting blocks, so it must not happen on the event loop.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.cond = threading.Condition()
+        self.waiters: list[list[int]] = []
+        """heap of [priority, seq]"""
+        self.seq = itertools.count()
+        self.configure(rate, burst)
+
+    def configure(self, rate: float, burst: int):
+        assert rate > 0 and burst >= 1
+        with self.cond:
+            self.rate = rate
+            """tokens per second"""
+            self.burst = burst
+            self.tokens = float(burst)
+            self.last_refill = time.monotonic()
+            self.cond.notify_all()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.last_refill) * self.rate
+        )
+        self.last_refill = now
+
+    def new_waiter(self, priority: RequestPriority):
+        """For acquire, lets raise_priority move the request up while it waits"""
+        return [priority, next(self.seq)]
+
+    def raise_priority(self, waiter: list[int], priority: RequestPriority):
+        with self.cond:
+            if priority < waiter[0]:
+                waiter[0] = priority
+                heapq.heapify(self.waiters)
+                self.cond.notify_all()
+
+    def acquire(self, priority: RequestPriority, waiter: list[int] | None = None):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            raise RuntimeError("Zoo API request made on the event loop, it would block")
+        with self.cond:
+            if waiter is None:
+                waiter = self.new_waiter(priority)
+            heapq.heappush(self.waiters, waiter)
+            try:
+                while True:
+                    self._refill()
+                    if self.waiters[0] != waiter:
+                        # Not our turn, wait for the waiters before us
+                        self.cond.wait()
+                    elif self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    else:
+                        self.cond.wait((1 - self.tokens) / self.rate)
+            finally:
+                self.waiters.remove(waiter)
+                heapq.heapify(self.waiters)
+                self.cond.notify_all()
+
+
+rate_limiter = RateLimiter(rate=2, burst=10)
+
+inflight_lock = threading.Lock()
+inflight_by_id: dict[str, tuple[concurrent.futures.Future[str], list[int]]] = dict()
+"""
+Requests being made and their rate limiter waiter,
+for concurrent requests of the same id to share them
+"""
+
 
 class ZooAPIContext:
     def __init__(self):
         self.requests_session = requests.Session()
 
-    def get_profile_data(self, id: str):
+    def get_profile_data_str(self, id: str):
+        """Fetches the raw json, see parse_profile_data"""
         assert isinstance(id, str)
 
+        priority = current_request_priority.get()
+        with inflight_lock:
+            inflight = inflight_by_id.get(id)
+            is_leader = inflight is None
+            if is_leader:
+                fut = concurrent.futures.Future()
+                waiter = rate_limiter.new_waiter(priority)
+                inflight_by_id[id] = fut, waiter
+            else:
+                fut, waiter = inflight
+        if not is_leader:
+            zoometrics.incr("zooapi_requests_coalesced")
+            # Don't wait behind a lower priority leader
+            rate_limiter.raise_priority(waiter, priority)
+            return fut.result()
+
+        try:
+            data_str = self._request_profile_data_str(id, waiter)
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        else:
+            fut.set_result(data_str)
+            return data_str
+        finally:
+            with inflight_lock:
+                del inflight_by_id[id]
+
+    def _request_profile_data_str(self, id: str, waiter: list[int]):
         url = get_profile_api_url(id)
 
+        t_start = time.monotonic()
+        rate_limiter.acquire(waiter[0], waiter)
+        zoometrics.set_gauge(
+            "zooapi_last_rate_limit_wait_seconds", time.monotonic() - t_start
+        )
+        zoometrics.incr("zooapi_requests")
+
         res = self.requests_session.get(url)
         res: requests.Response
         if res.status_code != requests.codes.OK:
             raise Exception("not OK", res.status_code, res)
-        data_str = res.text
-
-        try:
-            data = json.loads(data_str)
-        except:
-            print(data_str)
-            raise
-        if "error" in data:
-            """
-            Examples:
-
-            {
-                "name": "Cursed profile!",
-                "msg": "This profile has a <b>curse of invisibility</b> and cannot be viewed right now.",
-                "login": true,
-                "invalid": true,
-                "error": "invisible"
-            }
-
-            {
-                "name": "Invalid profile!",
-                "msg": "It doesn't look like this profile exists. Oh well!",
-                "invalid": true,
-                "error": "invalidProfile"
-            }
-            """
-            raise ProfileDataUnavailableError(
-                data["error"],
-                data["name"],
-                data["msg"],
-            )
+        return res.text
 
-        try:
-            return ZooProfileData(
-                data_str=data_str,
-                data=data,
-                profiles=data["profiles"],
-                profile_full_id=data["id"],
-                profile_id=data["profileID"],
-                profile_name=data["name"],
-                profile_icon=data["cosmeticIcon"],
-                animals={
-                    ZooAnimal.by_animal_name[data_animal["name"]]: data_animal["amount"]
-                    for data_animal in data["animals"]
-                },
-                animal_on_quest=(
-                    ZooAnimalRare.by_animal_name[data["quest"]["animal"]]
-                    if (
-                        # data["quest"] json is null if no quest is on
-                        data.get("quest")
-                        is not None
-                    )
-                    else None
-                ),
-            )
-        except Exception as e:
-            e.add_note(f"{url=!r}")
-            e.add_note(f"{data=!r}")
-            raise
+    def get_profile_data(self, id: str):
+        return parse_profile_data(self.get_profile_data_str(id), id)
+
+
+def parse_profile_data(data_str: str, id: str):
+    """id: only used for error messages"""
+    url = get_profile_api_url(id)
+
+    try:
+        data = json.loads(data_str)
+    except:
+        print(data_str)
+        raise
+    if "error" in data:
+        """
+        Examples:
+
+        {
+            "name": "Cursed profile!",
+            "msg": "This profile has a <b>curse of invisibility</b> and cannot be viewed right now.",
+            "login": true,
+            "invalid": true,
+            "error": "invisible"
+        }
+
+        {
+            "name": "Invalid profile!",
+            "msg": "It doesn't look like this profile exists. Oh well!",
+            "invalid": true,
+            "error": "invalidProfile"
+        }
+        """
+        raise ProfileDataUnavailableError(
+            data["error"],
+            data["name"],
+            data["msg"],
+        )
+
+    try:
+        return ZooProfileData(
+            data_str=data_str,
+            data=data,
+            profiles=data["profiles"],
+            profile_full_id=data["id"],
+            profile_id=data["profileID"],
+            profile_name=data["name"],
+            profile_icon=data["cosmeticIcon"],
+            animals={
+                ZooAnimal.by_animal_name[data_animal["name"]]: data_animal["amount"]
+                for data_animal in data["animals"]
+            },
+            animal_on_quest=(
+                ZooAnimalRare.by_animal_name[data["quest"]["animal"]]
+                if (
+                    # data["quest"] json is null if no quest is on
+                    data.get("quest")
+                    is not None
+                )
+                else None
+            ),
+        )
+    except Exception as e:
+        e.add_note(f"{url=!r}")
+        e.add_note(f"{data=!r}")
+        raise
 
 
 def main():
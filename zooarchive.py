@@ -0,0 +1,273 @@
+# SPDX-FileCopyrightText: 2024 Dragorn421
+# SPDX-License-Identifier: CC0-1.0
+
+"""
+Append-only archive of raw Zoo API payloads, and replaying it into a database.
+
+The archive is a directory of gzipped NDJSON segments, one record per stored
+payload, plus an index of the time range covered by each closed segment.
+"""
+
+from __future__ import annotations
+
+import argparse
+import dataclasses
+import datetime
+import gzip
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Iterator
+
+import zooapi
+import zoopeeker
+
+
+INDEX_FILE_NAME = "index.tsv"
+SEGMENT_SUFFIX = ".ndjson.gz"
+
+
+@dataclasses.dataclass
+class ArchiveRecord:
+    time: float
+    """unix timestamp of the fetch"""
+    discord_id: int
+    user_name: str
+    profile_zoo_id: str | None
+    """None for the user's current profile (fetched by discord id only)"""
+    data_str: str
+
+
+class PayloadArchive:
+    def __init__(
+        self,
+        path: Path,
+        segment_max_bytes: int = 16 * 1024 * 1024,
+        segment_max_age: datetime.timedelta = datetime.timedelta(hours=6),
+    ):
+        self.path = Path(path)
+        self.segment_max_bytes = segment_max_bytes
+        self.segment_max_age = segment_max_age
+        self.lock = threading.Lock()
+        self.segment_path: Path | None = None
+        self.segment_file = None
+        self.segment_first_time: float | None = None
+        self.segment_last_time: float | None = None
+        self.segment_n_records = 0
+
+    def __enter__(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self.lock:
+            self._close_segment()
+
+    def _open_segment(self, t: float):
+        self.segment_path = self.path / f"segment_{round(t * 1000)}{SEGMENT_SUFFIX}"
+        self.segment_file = gzip.open(self.segment_path, "ab")
+        self.segment_first_time = t
+        self.segment_last_time = t
+        self.segment_n_records = 0
+
+    def _close_segment(self):
+        if self.segment_file is None:
+            return
+        self.segment_file.close()
+        with (self.path / INDEX_FILE_NAME).open("a") as f:
+            f.write(
+                f"{self.segment_path.name}"
+                f"\t{self.segment_first_time}"
+                f"\t{self.segment_last_time}"
+                f"\t{self.segment_n_records}\n"
+            )
+        self.segment_file = None
+        self.segment_path = None
+
+    def append(
+        self,
+        discord_id: int,
+        user_name: str,
+        profile_zoo_id: str | None,
+        data_str: str,
+    ):
+        t = time.time()
+        line = json.dumps(
+            {
+                "t": t,
+                "discord_id": discord_id,
+                "user_name": user_name,
+                "profile_zoo_id": profile_zoo_id,
+                "data": data_str,
+            },
+            ensure_ascii=False,
+        )
+        with self.lock:
+            if self.segment_file is not None and (
+                self.segment_file.fileobj.tell() >= self.segment_max_bytes
+                or t - self.segment_first_time >= self.segment_max_age.total_seconds()
+            ):
+                self._close_segment()
+            if self.segment_file is None:
+                self._open_segment(t)
+            self.segment_file.write(line.encode() + b"\n")
+            # Keep what was written readable even if the process dies
+            self.segment_file.flush()
+            self.segment_last_time = t
+            self.segment_n_records += 1
+
+
+def iter_archive(
+    path: Path,
+    since: float | None = None,
+    until: float | None = None,
+) -> Iterator[ArchiveRecord]:
+    """
+    Yields the archived records between since and until (unix timestamps) in order.
+    Closed segments out of the range are skipped using the index.
+    """
+    path = Path(path)
+    time_range_by_segment_name: dict[str, tuple[float, float]] = dict()
+    index_path = path / INDEX_FILE_NAME
+    if index_path.exists():
+        for line in index_path.read_text().splitlines():
+            segment_name, first_time, last_time, n_records = line.split("\t")
+            time_range_by_segment_name[segment_name] = (
+                float(first_time),
+                float(last_time),
+            )
+
+    segment_paths = sorted(
+        path.glob("segment_*" + SEGMENT_SUFFIX),
+        key=lambda p: int(p.name.removeprefix("segment_").removesuffix(SEGMENT_SUFFIX)),
+    )
+    for segment_path in segment_paths:
+        time_range = time_range_by_segment_name.get(segment_path.name)
+        if time_range is not None:
+            first_time, last_time = time_range
+            if since is not None and last_time < since:
+                continue
+            if until is not None and first_time > until:
+                continue
+        try:
+            with gzip.open(segment_path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    record_json = json.loads(line)
+                    t = record_json["t"]
+                    if since is not None and t < since:
+                        continue
+                    if until is not None and t > until:
+                        continue
+                    yield ArchiveRecord(
+                        t,
+                        record_json["discord_id"],
+                        record_json["user_name"],
+                        record_json["profile_zoo_id"],
+                        record_json["data"],
+                    )
+        except EOFError:
+            # Segment still open (or the process died while writing it)
+            pass
+
+
+def replay(
+    zpk: zoopeeker.ZooPeeker,
+    records: Iterator[ArchiveRecord],
+    batch_size: int = 1000,
+):
+    """
+    Applies the archived payloads in order through ZooPeeker,
+    committing every batch_size records.
+    """
+    n_records = 0
+    n_errors = 0
+    records = iter(records)
+    while True:
+        n_records_batch = 0
+        with zpk.dbh.batch():
+            for record in records:
+                try:
+                    _replay_record(zpk, record)
+                except zooapi.ProfileDataUnavailableError:
+                    pass
+                except Exception as e:
+                    n_errors += 1
+                    print("replay: failed on", record.discord_id, record.time, repr(e))
+                n_records_batch += 1
+                if n_records_batch >= batch_size:
+                    break
+        n_records += n_records_batch
+        if n_records_batch < batch_size:
+            break
+        print("replay:", n_records, "records")
+    print("replay: done,", n_records, "records,", n_errors, "errors")
+
+
+def _replay_record(zpk: zoopeeker.ZooPeeker, record: ArchiveRecord):
+    id = str(record.discord_id)
+    if record.profile_zoo_id is not None:
+        id += "_" + record.profile_zoo_id
+    pd = zooapi.parse_profile_data(record.data_str, id)
+    data_hash = zoopeeker.payload_hash(record.data_str)
+    user = zpk.get_user(record.discord_id)
+
+    if record.profile_zoo_id is None:
+        fetched = zoopeeker.UserProfilesFetch(
+            pd, data_hash, {pd.profile_id: pd}, set(), {pd.profile_id: data_hash}
+        )
+        if user is None:
+            zpk.add_user(record.discord_id, record.user_name, record.user_name, fetched)
+        else:
+            zpk.refresh_user_data(user, fetched)
+    else:
+        if user is None:
+            # Alt profiles are only known through the current profile's list
+            return
+        fetched = zoopeeker.UserProfilesFetch(
+            None,
+            user.last_profile_data_hash,
+            {pd.profile_id: pd},
+            set(),
+            {pd.profile_id: data_hash},
+        )
+        zpk.refresh_user_data(user, fetched)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Rebuild a database from an archive of Zoo API payloads"
+    )
+    parser.add_argument("archive", type=Path)
+    parser.add_argument("out_db", type=Path)
+    parser.add_argument(
+        "--since", type=datetime.datetime.fromisoformat, help="ISO date/time"
+    )
+    parser.add_argument(
+        "--until", type=datetime.datetime.fromisoformat, help="ISO date/time"
+    )
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    # Nothing to protect until the snapshot is written out
+    storage_profile = zoopeeker.StorageProfile(
+        journal_mode="MEMORY",
+        synchronous="OFF",
+        auto_vacuum="NONE",
+    )
+    with zoopeeker.DatabaseHandler(storage_profile) as dbh:
+        zpk = zoopeeker.ZooPeeker(dbh)
+        replay(
+            zpk,
+            iter_archive(
+                args.archive,
+                None if args.since is None else args.since.timestamp(),
+                None if args.until is None else args.until.timestamp(),
+            ),
+            args.batch_size,
+        )
+        dbh.backup_to(args.out_db)
+
+
+if __name__ == "__main__":
+    main()
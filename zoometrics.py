@@ -0,0 +1,36 @@
+# SPDX-FileCopyrightText: 2024 Dragorn421
+# SPDX-License-Identifier: CC0-1.0
+
+"""
+Process-wide counters and gauges, for seeing what the bot is up to (/metrics).
+"""
+
+import threading
+
+
+lock = threading.Lock()
+counters: dict[str, int] = dict()
+gauges: dict[str, float] = dict()
+
+
+def incr(name: str, n: int = 1):
+    with lock:
+        counters[name] = counters.get(name, 0) + n
+
+
+def set_gauge(name: str, value: float):
+    with lock:
+        gauges[name] = value
+
+
+def snapshot():
+    with lock:
+        return counters.copy(), gauges.copy()
+
+
+def ratio(numerator: str, denominator: str):
+    with lock:
+        d = counters.get(denominator, 0)
+        if d == 0:
+            return None
+        return counters.get(numerator, 0) / d
@@ -10,13 +10,28 @@ import itertools
 import uuid
 import threading
 import queue
+import traceback
 import datetime
 import functools
 import dataclasses
+import concurrent.futures
+import multiprocessing
+import pickle
+import zlib
+import typing
+import hashlib
+import contextlib
+import time
+import math
 
 import zooapi
+import zoostats
+import zoometrics
 from zooapi import ZooAnimal, ZooAnimalCommon, ZooAnimalRare
 
+if typing.TYPE_CHECKING:
+    import zooarchive
+
 
 class User:
     def __init__(
@@ -30,11 +45,32 @@ class User:
         self.discord_id = discord_id
         self.user_id = user_id
         self.profile_id_by_profile_zoo_id = profile_id_by_profile_zoo_id
+        self.last_profile_data: zooapi.ZooProfileData | None = None
+        """The most recently fetched base (current profile) data"""
+        self.last_profile_data_hash: str | None = None
+        self.data_hash_by_profile_zoo_id: dict[str, str] = dict()
+        """payload_hash of the data last stored for each profile"""
+
+    def known_payloads(self):
+        pd = self.last_profile_data
+        return KnownPayloads(
+            self.last_profile_data_hash,
+            None if pd is None else pd.profile_id,
+            [] if pd is None else pd.profiles,
+            self.data_hash_by_profile_zoo_id.copy(),
+        )
 
     def __str__(self):
         return f"User<{self.name}>"
 
 
+RARE_SCORE_FACTOR = 5
+
+
+def zoo_score(amount: int, is_rare: bool):
+    return amount * RARE_SCORE_FACTOR if is_rare else amount
+
+
 @dataclasses.dataclass
 class TodoThing:
     emoji: str
@@ -67,12 +103,352 @@ class DatabaseHandlerTransactionCM:
         )
 
 
+@dataclasses.dataclass
+class StorageProfile:
+    """How the database file is journaled, cached and maintained."""
+
+    journal_mode: str = "WAL"
+    synchronous: str = "NORMAL"
+    cache_size: int = -16384
+    """Pages if positive, KiB if negative (see PRAGMA cache_size)"""
+    mmap_size: int = 64 * 1024 * 1024
+    """Bytes of the database file memory-mapped by user (read-only) connections"""
+    auto_vacuum: str = "INCREMENTAL"
+    busy_timeout_ms: int = 5000
+    wal_autocheckpoint: int = 0
+    """0 leaves checkpointing to the background DatabaseCheckpointer only"""
+    checkpoint_interval: datetime.timedelta = datetime.timedelta(seconds=30)
+    """Also accepts seconds (e.g. from botconf.storage_profile)"""
+    incremental_vacuum_pages: int = 256
+    in_memory: bool = False
+    """
+    Keep the database file in memory (on the tmpfs memory_dir) instead of on disk.
+    It is still a regular database (e.g. in WAL mode), so readers don't block
+    the writer, only its durability is gone
+    """
+    memory_dir: Path = Path("/dev/shm")
+    """For in_memory, a RAM-backed directory, the default temp dir if missing"""
+    snapshot_path: Path | None = None
+    """For in_memory, where to load the database from on start and snapshot it to"""
+    snapshot_interval: datetime.timedelta = datetime.timedelta(minutes=10)
+    """Also accepts seconds"""
+
+    def __post_init__(self):
+        self.journal_mode = self.journal_mode.upper()
+        self.synchronous = self.synchronous.upper()
+        self.auto_vacuum = self.auto_vacuum.upper()
+        self.memory_dir = Path(self.memory_dir)
+        if self.snapshot_path is not None:
+            if not self.in_memory:
+                raise ValueError("snapshot_path is only for in_memory")
+            self.snapshot_path = Path(self.snapshot_path)
+        if self.journal_mode not in {
+            "DELETE",
+            "TRUNCATE",
+            "PERSIST",
+            "MEMORY",
+            "WAL",
+            "OFF",
+        }:
+            raise ValueError("Bad journal_mode", self.journal_mode)
+        if self.synchronous not in {"OFF", "NORMAL", "FULL", "EXTRA"}:
+            raise ValueError("Bad synchronous", self.synchronous)
+        if self.auto_vacuum not in {"NONE", "FULL", "INCREMENTAL"}:
+            raise ValueError("Bad auto_vacuum", self.auto_vacuum)
+        self.cache_size = int(self.cache_size)
+        self.mmap_size = int(self.mmap_size)
+        self.busy_timeout_ms = int(self.busy_timeout_ms)
+        self.wal_autocheckpoint = int(self.wal_autocheckpoint)
+        self.incremental_vacuum_pages = int(self.incremental_vacuum_pages)
+        if not isinstance(self.checkpoint_interval, datetime.timedelta):
+            self.checkpoint_interval = datetime.timedelta(
+                seconds=self.checkpoint_interval
+            )
+        if not isinstance(self.snapshot_interval, datetime.timedelta):
+            self.snapshot_interval = datetime.timedelta(seconds=self.snapshot_interval)
+
+    def apply_rw(self, con: sqlite3.Connection):
+        # auto_vacuum only takes effect if set before the first table is created
+        con.execute(f"PRAGMA auto_vacuum = {self.auto_vacuum}")
+        con.execute(f"PRAGMA journal_mode = {self.journal_mode}")
+        con.execute(f"PRAGMA synchronous = {self.synchronous}")
+        con.execute(f"PRAGMA cache_size = {self.cache_size}")
+        con.execute(f"PRAGMA busy_timeout = {self.busy_timeout_ms}")
+        if self.journal_mode == "WAL":
+            con.execute(f"PRAGMA wal_autocheckpoint = {self.wal_autocheckpoint}")
+
+    def apply_ro(self, con: sqlite3.Connection):
+        con.execute(f"PRAGMA mmap_size = {self.mmap_size}")
+        con.execute(f"PRAGMA cache_size = {self.cache_size}")
+        con.execute(f"PRAGMA busy_timeout = {self.busy_timeout_ms}")
+
+
+class DatabaseCheckpointer:
+    """
+    Periodically checkpoints the WAL and gives freed pages back to the filesystem,
+    from its own connection so neither blocks the writer nor the readers.
+    """
+
+    def __init__(self, uri: str, storage_profile: StorageProfile):
+        self.uri = uri
+        self.storage_profile = storage_profile
+        self.stop_event = threading.Event()
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self._run,
+            name=repr(self),
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def _run(self):
+        sp = self.storage_profile
+        con = sqlite3.connect(self.uri, isolation_level=None, uri=True)
+        try:
+            con.execute(f"PRAGMA busy_timeout = {sp.busy_timeout_ms}")
+            while not self.stop_event.wait(sp.checkpoint_interval.total_seconds()):
+                self._maintain(con)
+            self._maintain(con)
+        finally:
+            con.close()
+
+    def _maintain(self, con: sqlite3.Connection):
+        sp = self.storage_profile
+        try:
+            if sp.journal_mode == "WAL":
+                # PASSIVE: copy what can be copied without waiting on anyone
+                con.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+            if sp.auto_vacuum == "INCREMENTAL":
+                con.execute(
+                    f"PRAGMA incremental_vacuum({sp.incremental_vacuum_pages})"
+                ).fetchall()
+        except sqlite3.OperationalError as e:
+            print("DatabaseCheckpointer: maintenance failed, will retry", repr(e))
+
+
+class DatabaseSnapshotter:
+    """
+    Periodically snapshots an in-memory database to StorageProfile.snapshot_path.
+    """
+
+    def __init__(self, dbh: DatabaseHandler):
+        self.dbh = dbh
+        self.stop_event = threading.Event()
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self._run,
+            name=repr(self),
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def _run(self):
+        sp = self.dbh.storage_profile
+        while not self.stop_event.wait(sp.snapshot_interval.total_seconds()):
+            try:
+                self.dbh.snapshot()
+            except Exception as e:
+                print("DatabaseSnapshotter: snapshot failed, will retry", repr(e))
+
+
+class DatabaseWriter:
+    """
+    Owns the read-write connection: runs queued operations on its own thread,
+    batching whatever is queued into one transaction.
+    Each operation runs in a savepoint, so a failing one doesn't undo the others.
+    An operation's DatabaseHandler.on_commit callbacks run once the transaction
+    is committed, and are dropped if the operation or the commit fails.
+    """
+
+    def __init__(self, dbh: DatabaseHandler, max_batch_ops: int = 256):
+        self.dbh = dbh
+        self.max_batch_ops = max_batch_ops
+        self.queue: queue.Queue[
+            tuple[concurrent.futures.Future, typing.Callable, tuple, bool] | None
+        ] = queue.Queue()
+        self.stopping = False
+        self.stopping_lock = threading.Lock()
+        self.pending_items: list = []
+        """Taken from the queue, not done yet"""
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self._run,
+            name=repr(self),
+        )
+        self.thread.start()
+
+    def stop(self):
+        """Stops once everything queued so far is written"""
+        with self.stopping_lock:
+            self.stopping = True
+            self.queue.put(None)
+        self.thread.join()
+
+    def submit(
+        self, fn, *args, in_transaction: bool = True
+    ) -> concurrent.futures.Future:
+        """
+        Queues fn(*args) to run on the writer thread.
+        The future completes once the transaction it was batched in is committed.
+        With in_transaction=False, fn runs on its own outside of any transaction
+        (e.g. the backup API can't read a connection in a write transaction).
+        """
+        fut = concurrent.futures.Future()
+        if threading.current_thread() is self.thread:
+            # From within an operation, it's already in the current transaction
+            assert in_transaction
+            fut.set_result(fn(*args))
+            return fut
+        with self.stopping_lock:
+            if self.stopping:
+                raise Exception("DatabaseWriter is stopped")
+            self.queue.put((fut, fn, args, in_transaction))
+        zoometrics.set_gauge("db_writer_queue_size", self.queue.qsize())
+        return fut
+
+    def _run(self):
+        try:
+            self._run_batches()
+        except BaseException as e:
+            print("DatabaseWriter: writer thread died", repr(e))
+            traceback.print_exc()
+            with self.stopping_lock:
+                self.stopping = True
+            # Don't leave anyone waiting forever
+            while True:
+                try:
+                    self.pending_items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for item in self.pending_items:
+                if item is not None and not item[0].done():
+                    item[0].set_exception(Exception("DatabaseWriter died", repr(e)))
+            raise
+
+    def _run_batches(self):
+        con = self.dbh.con_rw
+        pending_items = self.pending_items
+        while True:
+            # Left from the previous batch (0 or 1 item)
+            if pending_items:
+                item = pending_items[0]
+            else:
+                item = self.queue.get()
+                pending_items.append(item)
+            if item is None:
+                return
+
+            fut, fn, args, in_transaction = item
+            if not in_transaction:
+                if fut.set_running_or_notify_cancel():
+                    ok, value, commit_callbacks = self._run_op(fn, args, False)
+                    self._complete(fut, ok, value, commit_callbacks)
+                pending_items.clear()
+                continue
+
+            ops = [item]
+            while len(ops) < self.max_batch_ops:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                pending_items.append(item)
+                if item is None or not item[3]:
+                    break
+                ops.append(item)
+            zoometrics.set_gauge("db_writer_queue_size", self.queue.qsize())
+
+            results = []
+            con.execute("BEGIN")
+            self.dbh.in_batch = True
+            try:
+                for fut, fn, args, in_transaction in ops:
+                    if fut.set_running_or_notify_cancel():
+                        results.append((fut, *self._run_op(fn, args, True)))
+            finally:
+                self.dbh.in_batch = False
+                try:
+                    con.execute("COMMIT")
+                except Exception as e:
+                    print("DatabaseWriter: commit failed", repr(e))
+                    con.execute("ROLLBACK")
+                    results = [(fut, False, e, []) for fut, *_ in results]
+            for fut, ok, value, commit_callbacks in results:
+                self._complete(fut, ok, value, commit_callbacks)
+            # What's left is the held item, for the next batch
+            del pending_items[: len(ops)]
+            zoometrics.incr("db_writer_batches")
+            zoometrics.incr("db_writer_ops", len(ops))
+
+    def _run_op(self, fn, args, in_transaction: bool):
+        con = self.dbh.con_rw
+        self.dbh.commit_callbacks = []
+        try:
+            if in_transaction:
+                con.execute("SAVEPOINT write_op")
+            try:
+                result = fn(*args)
+            except Exception as e:
+                if in_transaction:
+                    con.execute("ROLLBACK TO write_op")
+                    con.execute("RELEASE write_op")
+                return False, e, []
+            if in_transaction:
+                con.execute("RELEASE write_op")
+            return True, result, self.dbh.commit_callbacks
+        finally:
+            self.dbh.commit_callbacks = None
+
+    def _complete(self, fut, ok, value, commit_callbacks):
+        if ok:
+            try:
+                _run_commit_callbacks(commit_callbacks)
+            except Exception as e:
+                ok, value = False, e
+        if ok:
+            fut.set_result(value)
+        else:
+            fut.set_exception(value)
+
+
+def _run_commit_callbacks(commit_callbacks: list[tuple[typing.Callable, tuple]]):
+    for fn, args in commit_callbacks:
+        fn(*args)
+
+
 class DatabaseHandler:
-    def __init__(self):
-        pass
+    def __init__(self, storage_profile: StorageProfile | None = None):
+        if storage_profile is None:
+            storage_profile = StorageProfile()
+        self.storage_profile = storage_profile
+        self.in_batch = False
+        self.writer: DatabaseWriter | None = None
+        """When started, con_rw is only used from the writer's thread"""
+        self.snapshotter: DatabaseSnapshotter | None = None
+        self.commit_callbacks: list[tuple[typing.Callable, tuple]] | None = None
+        """Of the write being run, see on_commit"""
 
     def __enter__(self):
-        self.tempdir = tempfile.TemporaryDirectory(Path(__file__).stem)
+        tempdir_dir = None
+        if self.storage_profile.in_memory:
+            if self.storage_profile.memory_dir.is_dir():
+                tempdir_dir = self.storage_profile.memory_dir
+            else:
+                print(
+                    "in_memory: no",
+                    self.storage_profile.memory_dir,
+                    "directory, the database is in the temp dir",
+                )
+        self.tempdir = tempfile.TemporaryDirectory(Path(__file__).stem, dir=tempdir_dir)
         self.path = Path(self.tempdir.name) / "db.sqlite"
         self.uri = self.path.as_uri()
 
@@ -80,16 +456,37 @@ class DatabaseHandler:
             self.uri,
             isolation_level=None,
             uri=True,
+            # Handed over to the writer thread once set up, see start_writer
+            check_same_thread=False,
         )
+        self.storage_profile.apply_rw(self.con_rw)
 
         self.user_cons: dict[User, sqlite3.Connection] = dict()
 
-        self.animal_ids = self._init_tables()
+        loaded_snapshot = self._load_snapshot()
+        if loaded_snapshot:
+            # The snapshot's header came along, e.g. its journal mode
+            self.storage_profile.apply_rw(self.con_rw)
+        else:
+            self._init_tables()
+        self.animal_ids = self._get_animal_ids()
+        self._init_animal_catalog(fill_tables=not loaded_snapshot)
+        self._register_functions(self.con_rw)
+
+        self.checkpointer = DatabaseCheckpointer(self.uri, self.storage_profile)
+        self.checkpointer.start()
 
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         try:
+            if self.writer is not None:
+                self.stop_writer()
+            if self.checkpointer is not None:
+                self.checkpointer.stop()
+                self.checkpointer = None
+            if self.storage_profile.snapshot_path is not None:
+                self.snapshot()
             self.con_rw.close()
             self.con_rw = None
             for user_con in self.user_cons.values():
@@ -116,6 +513,7 @@ class DatabaseHandler:
                 "profile_zoo_id" TEXT    NOT NULL,
                 "profile_name"   TEXT    NOT NULL,
                 "profile_icon"   TEXT    NOT NULL,
+                "data_hash"      TEXT,
                 PRIMARY KEY("profile_id" AUTOINCREMENT),
                 FOREIGN KEY("user_id") REFERENCES "users"("user_id")
             );
@@ -146,6 +544,173 @@ class DatabaseHandler:
                 utcdatetime  TEXT    NOT NULL,
                 FOREIGN KEY("profile_id") REFERENCES "profiles"("profile_id")
             );
+            CREATE INDEX "zoos_profile_animal" ON "zoos" ("profile_id", "animal_id");
+            CREATE INDEX "todos_profile" ON "todos" ("profile_id");
+
+            CREATE TABLE "animal_pairs" (
+                "common_id"    INTEGER NOT NULL,
+                "rare_id"      INTEGER NOT NULL,
+                "common"       TEXT    NOT NULL,
+                "common_emoji" TEXT    NOT NULL,
+                "rare"         TEXT    NOT NULL,
+                "rare_emoji"   TEXT    NOT NULL,
+                PRIMARY KEY("common_id"),
+                FOREIGN KEY("common_id") REFERENCES "animals"("animal_id"),
+                FOREIGN KEY("rare_id") REFERENCES "animals"("animal_id")
+            ) WITHOUT ROWID;
+
+            -- Leaderboards, maintained by DatabaseHandler._update_leaderboards
+            -- for the profiles written to only
+            CREATE TABLE "leaderboard_animals" (
+                "animal_id"  INTEGER NOT NULL,
+                "profile_id" INTEGER NOT NULL,
+                "user_id"    INTEGER NOT NULL,
+                "amount"     INTEGER NOT NULL,
+                PRIMARY KEY("animal_id", "profile_id"),
+                FOREIGN KEY("animal_id") REFERENCES "animals"("animal_id"),
+                FOREIGN KEY("profile_id") REFERENCES "profiles"("profile_id"),
+                FOREIGN KEY("user_id") REFERENCES "users"("user_id")
+            ) WITHOUT ROWID;
+            CREATE INDEX "leaderboard_animals_rank"
+                ON "leaderboard_animals" ("animal_id", "amount" DESC);
+            CREATE INDEX "leaderboard_animals_profile"
+                ON "leaderboard_animals" ("profile_id");
+            CREATE TABLE "leaderboard_profiles" (
+                "profile_id" INTEGER NOT NULL,
+                "user_id"    INTEGER NOT NULL,
+                "score"      INTEGER NOT NULL,
+                "n_rares"    INTEGER NOT NULL,
+                PRIMARY KEY("profile_id"),
+                FOREIGN KEY("profile_id") REFERENCES "profiles"("profile_id"),
+                FOREIGN KEY("user_id") REFERENCES "users"("user_id")
+            );
+            CREATE INDEX "leaderboard_profiles_rank"
+                ON "leaderboard_profiles" ("score" DESC);
+            CREATE INDEX "leaderboard_profiles_user"
+                ON "leaderboard_profiles" ("user_id");
+            CREATE TABLE "leaderboard_users" (
+                "user_id" INTEGER NOT NULL,
+                "score"   INTEGER NOT NULL,
+                "n_rares" INTEGER NOT NULL,
+                PRIMARY KEY("user_id"),
+                FOREIGN KEY("user_id") REFERENCES "users"("user_id")
+            );
+            CREATE INDEX "leaderboard_users_rank"
+                ON "leaderboard_users" ("score" DESC);
+
+            -- Built-in views. The my_* views are relative to the connection's user,
+            -- see get_user_con and zoo_current_user_id()
+            -- zoo_* functions are registered by DatabaseHandler._register_functions,
+            -- for user queries. The views stick to plain SQL so they run without
+            -- calling back into Python per row
+            CREATE VIEW "top_pairs" AS
+                SELECT
+                    profiles.profile_id, profile_zoo_id, profile_name,
+                    users.user_id, discord_id, user_name, user_display_name,
+                    common, zc.amount AS nc, rare, zr.amount AS nr,
+                    -- 5 is RARE_SCORE_FACTOR
+                    zc.amount + 5 * zr.amount AS score
+                FROM animal_pairs
+                JOIN zoos AS zc
+                    ON zc.animal_id == common_id
+                JOIN zoos AS zr
+                    ON zr.profile_id == zc.profile_id AND zr.animal_id == rare_id
+                JOIN profiles
+                    ON profiles.profile_id == zc.profile_id
+                JOIN users
+                    ON users.user_id == profiles.user_id;
+            CREATE VIEW "my_top" AS
+                SELECT common, sum(nc) AS nc, rare, sum(nr) AS nr, sum(score) AS score
+                FROM top_pairs
+                WHERE user_id == zoo_current_user_id()
+                GROUP BY common
+                ORDER BY score DESC;
+            -- Ranks are numbered in one pass over the rank indexes, so reading
+            -- them never aggregates the zoos table
+            CREATE VIEW "leaderboard_users_score" AS
+                SELECT
+                    rank() OVER (ORDER BY score DESC) AS rank,
+                    user_name, score, n_rares, user_id
+                FROM leaderboard_users
+                JOIN users USING (user_id)
+                ORDER BY score DESC;
+            CREATE VIEW "leaderboard_profiles_score" AS
+                SELECT
+                    rank() OVER (ORDER BY score DESC) AS rank,
+                    user_name, profile_name, score, n_rares, user_id, profile_id
+                FROM leaderboard_profiles
+                JOIN profiles USING (profile_id, user_id)
+                JOIN users USING (user_id)
+                ORDER BY score DESC;
+            CREATE VIEW "leaderboard_animals_amount" AS
+                SELECT
+                    animal_name,
+                    rank() OVER (PARTITION BY animal_id ORDER BY amount DESC) AS rank,
+                    user_name, profile_name, amount, animal_id, user_id, profile_id
+                FROM leaderboard_animals
+                JOIN animals USING (animal_id)
+                JOIN profiles USING (profile_id, user_id)
+                JOIN users USING (user_id)
+                ORDER BY animal_id, amount DESC;
+            -- A single rank is the count of the rows before it, a range seek in the
+            -- same rank indexes rather than numbering the whole leaderboard
+            CREATE VIEW "my_ranks" AS
+                SELECT
+                    1 + (
+                        SELECT count(*)
+                        FROM leaderboard_users AS better
+                        WHERE better.score > lu.score
+                    ) AS rank,
+                    score, n_rares
+                FROM leaderboard_users AS lu
+                WHERE user_id == zoo_current_user_id();
+            CREATE VIEW "my_animal_ranks" AS
+                SELECT
+                    animal_name,
+                    1 + (
+                        SELECT count(*)
+                        FROM leaderboard_animals AS better
+                        WHERE better.animal_id == la.animal_id
+                            AND better.amount > la.amount
+                    ) AS rank,
+                    profile_name, amount
+                FROM leaderboard_profiles AS lp
+                JOIN leaderboard_animals AS la USING (profile_id, user_id)
+                JOIN animals USING (animal_id)
+                JOIN profiles USING (profile_id, user_id)
+                WHERE lp.user_id == zoo_current_user_id()
+                ORDER BY la.animal_id, amount DESC;
+            CREATE VIEW "my_todos" AS
+                SELECT
+                    (
+                        profile_icon
+                        || ' '
+                        || substr(profile_name,1,2)
+                        || ' '
+                        || emoji
+                        || ' '
+                        || thing
+                        || ' <t:'
+                        || utctimestamp
+                        || ':R>'
+                        || ' (<t:'
+                        || utctimestamp
+                        || ':f>)'
+                        || (CASE
+                                WHEN datetime(utcdatetime)<datetime('now') THEN ' ⏰'
+                                ELSE ''
+                            END)
+                    ) AS magic_lines,
+                    emoji, thing, utctimestamp, utcdatetime,
+                    profile_id, profile_zoo_id, profile_name, profile_icon,
+                    user_id, discord_id, user_name, user_display_name
+                FROM todos NATURAL JOIN profiles NATURAL JOIN users
+                WHERE user_id == zoo_current_user_id();
+            CREATE VIEW "my_todos_soon" AS
+                SELECT magic_lines
+                FROM my_todos
+                WHERE datetime(utcdatetime)<datetime('now','+10 hours')
+                ORDER BY utctimestamp;
             """
         )
 
@@ -211,6 +776,7 @@ class DatabaseHandler:
 
         self.con_rw.execute("COMMIT")
 
+    def _get_animal_ids(self):
         animal_ids: dict[ZooAnimal, int] = dict()
         for animal_id, animal_name in self.con_rw.execute(
             "SELECT animal_id, animal_name FROM animals"
@@ -220,9 +786,138 @@ class DatabaseHandler:
 
         return animal_ids
 
+    def _init_animal_catalog(self, fill_tables: bool = True):
+        self.is_rare_by_animal_id: dict[int, bool] = dict()
+        self.common_id_by_animal_id: dict[int, int] = dict()
+        self.rare_id_by_animal_id: dict[int, int] = dict()
+        for za in ZooAnimalRare:
+            rare_id = self.animal_ids[za]
+            common_id = self.animal_ids[za.animal_common]
+            self.is_rare_by_animal_id[rare_id] = True
+            self.is_rare_by_animal_id[common_id] = False
+            for animal_id in (rare_id, common_id):
+                self.common_id_by_animal_id[animal_id] = common_id
+                self.rare_id_by_animal_id[animal_id] = rare_id
+
+        if not fill_tables:
+            return
+
+        self.con_rw.execute("BEGIN")
+        self.con_rw.executemany(
+            "INSERT INTO"
+            " animal_pairs (common_id, rare_id, common, common_emoji, rare, rare_emoji)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                (
+                    self.animal_ids[za.animal_common],
+                    self.animal_ids[za],
+                    za.animal_common.animal_name,
+                    za.animal_common.emoji,
+                    za.animal_name,
+                    za.emoji,
+                )
+                for za in ZooAnimalRare
+            ),
+        )
+        self.con_rw.execute("COMMIT")
+
+    def _register_functions(self, con: sqlite3.Connection):
+        con.create_function("zoo_score", 2, zoo_score, deterministic=True)
+        con.create_function(
+            "zoo_is_rare", 1, self.is_rare_by_animal_id.get, deterministic=True
+        )
+        con.create_function(
+            "zoo_common_of", 1, self.common_id_by_animal_id.get, deterministic=True
+        )
+        con.create_function(
+            "zoo_rare_of", 1, self.rare_id_by_animal_id.get, deterministic=True
+        )
+
+    def start_writer(self):
+        """From now on, writes go through a DatabaseWriter thread (see submit_write)"""
+        assert self.writer is None
+        self.writer = DatabaseWriter(self)
+        self.writer.start()
+        if self.storage_profile.snapshot_path is not None:
+            self.snapshotter = DatabaseSnapshotter(self)
+            self.snapshotter.start()
+
+    def stop_writer(self):
+        """Waits for the queued writes to be done"""
+        if self.snapshotter is not None:
+            self.snapshotter.stop()
+            self.snapshotter = None
+        self.writer.stop()
+        self.writer = None
+
+    def submit_write(
+        self, fn, *args, in_transaction: bool = True
+    ) -> concurrent.futures.Future:
+        """
+        Runs fn(*args), which may use con_rw, on the writer thread if started,
+        else right away. See DatabaseWriter.submit
+        """
+        if self.writer is not None:
+            return self.writer.submit(fn, *args, in_transaction=in_transaction)
+        fut = concurrent.futures.Future()
+        if self.in_batch or self.commit_callbacks is not None:
+            # Part of the write being run
+            try:
+                fut.set_result(fn(*args))
+            except Exception as e:
+                fut.set_exception(e)
+            return fut
+        self.commit_callbacks = []
+        try:
+            result = fn(*args)
+            commit_callbacks = self.commit_callbacks
+        except Exception as e:
+            fut.set_exception(e)
+            return fut
+        finally:
+            self.commit_callbacks = None
+        try:
+            _run_commit_callbacks(commit_callbacks)
+        except Exception as e:
+            fut.set_exception(e)
+        else:
+            fut.set_result(result)
+        return fut
+
+    def on_commit(self, fn, *args):
+        """
+        For writes to call fn(*args) (e.g. to update in-memory state) once what
+        they wrote is committed, and not if it's rolled back.
+        Outside of writes and within batch() (which is all or nothing), runs now.
+        """
+        if self.commit_callbacks is None:
+            fn(*args)
+        else:
+            self.commit_callbacks.append((fn, args))
+
     def transaction(self):
+        if self.in_batch:
+            return contextlib.nullcontext()
         return DatabaseHandlerTransactionCM(self.con_rw)
 
+    @contextlib.contextmanager
+    def batch(self):
+        """Runs everything written within in one transaction, for bulk writes."""
+        # The writer thread batches writes by itself
+        assert self.writer is None
+        assert not self.in_batch
+        self.con_rw.execute("BEGIN")
+        self.in_batch = True
+        try:
+            yield
+        except:
+            self.con_rw.execute("ROLLBACK")
+            raise
+        else:
+            self.con_rw.execute("COMMIT")
+        finally:
+            self.in_batch = False
+
     def add_user(self, discord_id: str, user_name: str, user_display_name: str):
         cur = self.con_rw.cursor()
         cur.execute(
@@ -255,17 +950,19 @@ class DatabaseHandler:
         profile_icon: str,
         animals_amount: dict[ZooAnimal, int],
         animals_amount_now: dict[ZooAnimal, int],
+        data_hash: str | None = None,
     ):
         cur = self.con_rw.cursor()
         cur.execute(
             "INSERT INTO"
-            " profiles (user_id, profile_zoo_id, profile_name, profile_icon)"
-            " VALUES (?, ?, ?, ?)",
-            (user_id, profile_zoo_id, profile_name, profile_icon),
+            " profiles (user_id, profile_zoo_id, profile_name, profile_icon, data_hash)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (user_id, profile_zoo_id, profile_name, profile_icon, data_hash),
         )
         profile_id = cur.lastrowid
 
         self._insert_zoo_animals(cur, profile_id, animals_amount, animals_amount_now)
+        self._update_leaderboards(cur, profile_id, user_id, animals_amount)
 
         return profile_id
 
@@ -291,10 +988,68 @@ class DatabaseHandler:
             ),
         )
 
+    def _get_profile_user_id(self, cur: sqlite3.Cursor, profile_id: int) -> int:
+        cur.execute("SELECT user_id FROM profiles WHERE profile_id = ?", (profile_id,))
+        (user_id,) = cur.fetchone()
+        return user_id
+
+    def _update_leaderboards(
+        self,
+        cur: sqlite3.Cursor,
+        profile_id: int,
+        user_id: int,
+        animals_amount: dict[ZooAnimal, int] | None,
+    ):
+        """
+        Updates the leaderboard rows of one profile (removing them if animals_amount
+        is None) and the totals of its user.
+        """
+        cur.execute(
+            "DELETE FROM leaderboard_animals WHERE profile_id = ?", (profile_id,)
+        )
+        cur.execute(
+            "DELETE FROM leaderboard_profiles WHERE profile_id = ?", (profile_id,)
+        )
+        if animals_amount is not None:
+            cur.executemany(
+                "INSERT INTO"
+                " leaderboard_animals (animal_id, profile_id, user_id, amount)"
+                " VALUES (?, ?, ?, ?)",
+                (
+                    (self.animal_ids[za], profile_id, user_id, amount)
+                    for za, amount in animals_amount.items()
+                    if amount > 0
+                ),
+            )
+            cur.execute(
+                "INSERT INTO"
+                " leaderboard_profiles (profile_id, user_id, score, n_rares)"
+                " VALUES (?, ?, ?, ?)",
+                (
+                    profile_id,
+                    user_id,
+                    sum(
+                        zoo_score(amount, za.is_rare)
+                        for za, amount in animals_amount.items()
+                    ),
+                    sum(amount for za, amount in animals_amount.items() if za.is_rare),
+                ),
+            )
+        cur.execute("DELETE FROM leaderboard_users WHERE user_id = ?", (user_id,))
+        cur.execute(
+            "INSERT INTO"
+            " leaderboard_users (user_id, score, n_rares)"
+            " SELECT user_id, sum(score), sum(n_rares)"
+            " FROM leaderboard_profiles WHERE user_id = ? GROUP BY user_id",
+            (user_id,),
+        )
+
     def remove_profile(self, profile_id: int):
         cur = self.con_rw.cursor()
+        user_id = self._get_profile_user_id(cur, profile_id)
         cur.execute("DELETE FROM profiles WHERE profile_id = ?", (profile_id,))
         self._delete_zoo_animals(cur, profile_id)
+        self._update_leaderboards(cur, profile_id, user_id, None)
 
     def _delete_zoo_animals(self, cur: sqlite3.Cursor, profile_id: int):
         cur.execute("DELETE FROM zoos WHERE profile_id = ?", (profile_id,))
@@ -306,14 +1061,22 @@ class DatabaseHandler:
         profile_icon: str,
         animals_amount: dict[ZooAnimal, int],
         animals_amount_now: dict[ZooAnimal, int],
+        data_hash: str | None = None,
     ):
         cur = self.con_rw.cursor()
         cur.execute(
-            "UPDATE profiles SET profile_name = ?, profile_icon = ? WHERE profile_id = ?",
-            (profile_name, profile_icon, profile_id),
+            "UPDATE profiles SET profile_name = ?, profile_icon = ?, data_hash = ?"
+            " WHERE profile_id = ?",
+            (profile_name, profile_icon, data_hash, profile_id),
         )
         self._delete_zoo_animals(cur, profile_id)
         self._insert_zoo_animals(cur, profile_id, animals_amount, animals_amount_now)
+        self._update_leaderboards(
+            cur,
+            profile_id,
+            self._get_profile_user_id(cur, profile_id),
+            animals_amount,
+        )
 
     def set_profile_todos(
         self,
@@ -342,34 +1105,301 @@ class DatabaseHandler:
         user_con = self.user_cons.get(user)
         if user_con:
             return user_con
+        user_con = self.open_user_con(user)
+        self.user_cons[user] = user_con
+        return user_con
+
+    def open_user_con(self, user: User):
+        """
+        Opens a new read-only connection for the user, owned by the caller.
+        Use get_user_con instead to share one per user.
+        """
         # https://www.sqlite.org/uri.html
         user_con = sqlite3.connect(
             self.uri + "?mode=ro",
             uri=True,
         )
-        self.user_cons[user] = user_con
+        self.storage_profile.apply_ro(user_con)
+        self._register_functions(user_con)
+        # Binds the my_* views to this user
+        user_con.create_function(
+            "zoo_current_user_id", 0, lambda: user.user_id, deterministic=True
+        )
         return user_con
 
     def dump(self):
-        return "".join(line + "\n" for line in self.con_rw.iterdump())
+        return self.submit_write(
+            lambda: "".join(line + "\n" for line in self.con_rw.iterdump())
+        ).result()
+
+    def backup_to(self, path: Path):
+        self.submit_write(self._backup_to_impl, path, in_transaction=False).result()
+
+    def _backup_to_impl(self, path: Path):
+        backup_con = sqlite3.connect(path)
+        try:
+            self.con_rw.backup(backup_con)
+        finally:
+            backup_con.close()
+
+    def _load_snapshot(self):
+        """Loads StorageProfile.snapshot_path into the (empty) database"""
+        snapshot_path = self.storage_profile.snapshot_path
+        if snapshot_path is None or not snapshot_path.exists():
+            return False
+        snapshot_con = sqlite3.connect(snapshot_path)
+        try:
+            snapshot_con.backup(self.con_rw)
+        finally:
+            snapshot_con.close()
+        print("Loaded database snapshot", snapshot_path)
+        return True
+
+    def snapshot(self):
+        """Writes the database to StorageProfile.snapshot_path, atomically"""
+        start = time.perf_counter()
+        snapshot_path = self.storage_profile.snapshot_path
+        # Copy in memory from the writer (fast), then write to disk without holding it
+        memory_con = sqlite3.connect(":memory:", check_same_thread=False)
+        try:
+            self.submit_write(
+                self.con_rw.backup, memory_con, in_transaction=False
+            ).result()
+            tmp_path = snapshot_path.with_name(snapshot_path.name + ".tmp")
+            tmp_path.unlink(missing_ok=True)
+            tmp_con = sqlite3.connect(tmp_path)
+            try:
+                memory_con.backup(tmp_con)
+            finally:
+                tmp_con.close()
+        finally:
+            memory_con.close()
+        tmp_path.replace(snapshot_path)
+        zoometrics.set_gauge("db_snapshot_seconds", time.perf_counter() - start)
 
     def backup(self):
-        return self.path.read_bytes()
+        # The WAL may hold commits not yet in the main file, so copy through SQLite
+        with tempfile.TemporaryDirectory(Path(__file__).stem) as backup_dir:
+            backup_path = Path(backup_dir) / "backup.sqlite"
+            self.backup_to(backup_path)
+            return backup_path.read_bytes()
+
+
+class DatabasePartitions:
+    """
+    Partitioned storage: one DatabaseHandler (own database, writer and lock)
+    per shard of guilds. Queries across all partitions go through a connection
+    attaching them all (see open_global_con).
+    """
+
+    CATALOG_TABLES = ("animals", "animal_pairs")
+    """The same in every partition, not unioned in global connections"""
+
+    def __init__(
+        self, storage_profile: StorageProfile | None = None, n_partitions: int = 1
+    ):
+        if storage_profile is None:
+            storage_profile = StorageProfile()
+        if n_partitions < 1:
+            raise ValueError("Bad n_partitions", n_partitions)
+        self.storage_profile = storage_profile
+        self.n_partitions = n_partitions
+        self.dbhs: list[DatabaseHandler] = []
+        self.global_con: sqlite3.Connection | None = None
+
+    def __enter__(self):
+        with contextlib.ExitStack() as exit_stack:
+            for i in range(self.n_partitions):
+                self.dbhs.append(
+                    exit_stack.enter_context(
+                        DatabaseHandler(self._partition_storage_profile(i))
+                    )
+                )
+            self.exit_stack = exit_stack.pop_all()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.global_con is not None:
+            self.global_con.close()
+            self.global_con = None
+        self.exit_stack.close()
+        self.dbhs = []
+
+    def _partition_storage_profile(self, i: int):
+        snapshot_path = self.storage_profile.snapshot_path
+        if self.n_partitions == 1 or snapshot_path is None:
+            return self.storage_profile
+        return dataclasses.replace(
+            self.storage_profile,
+            snapshot_path=snapshot_path.with_stem(f"{snapshot_path.stem}_{i}"),
+        )
+
+    def partition_index(self, guild_id: int | None):
+        """DMs (guild_id None) go to the first partition"""
+        if guild_id is None:
+            return 0
+        return guild_id % self.n_partitions
+
+    def get(self, guild_id: int | None):
+        return self.dbhs[self.partition_index(guild_id)]
+
+    def start_writers(self):
+        for dbh in self.dbhs:
+            dbh.start_writer()
+
+    def stop_writers(self):
+        for dbh in self.dbhs:
+            if dbh.writer is not None:
+                dbh.stop_writer()
+
+    def get_global_con(self):
+        if self.global_con is None:
+            self.global_con = self.open_global_con()
+        return self.global_con
+
+    def open_global_con(self):
+        """
+        Opens a new read-only connection attaching every partition, owned by
+        the caller. Each table of the partitions is a temp view of the same name
+        with a partition_id column (so natural joins stay within a partition),
+        views are the union of each partition's (so e.g. ranks are per partition).
+        The my_* views are empty, there is no current user.
+        """
+        global_con = sqlite3.connect(":memory:", uri=True)
+        max_attached = global_con.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+        if self.n_partitions > max_attached:
+            global_con.close()
+            raise ValueError(
+                "Too many partitions to attach", self.n_partitions, max_attached
+            )
+        try:
+            for i, dbh in enumerate(self.dbhs):
+                global_con.execute(
+                    f"ATTACH DATABASE ? AS p{i}",
+                    (dbh.uri + "?mode=ro",),
+                )
+            for type, name in global_con.execute(
+                "SELECT type, name FROM p0.sqlite_master"
+                " WHERE type IN ('table', 'view') AND name NOT LIKE 'sqlite_%'"
+            ).fetchall():
+                if name in self.CATALOG_TABLES:
+                    select = f'SELECT * FROM p0."{name}"'
+                else:
+                    select = " UNION ALL ".join(
+                        f'SELECT {i} AS partition_id, * FROM p{i}."{name}"'
+                        for i in range(self.n_partitions)
+                    )
+                global_con.execute(f'CREATE TEMP VIEW "{name}" AS {select}')
+            self.storage_profile.apply_ro(global_con)
+            self.dbhs[0]._register_functions(global_con)
+            global_con.create_function(
+                "zoo_current_user_id", 0, lambda: None, deterministic=True
+            )
+        except:
+            global_con.close()
+            raise
+        return global_con
 
 
 class ZooPeekerDataRefresher:
-    def __init__(self, zpk: ZooPeeker, call_soon):
+    def __init__(
+        self,
+        zpk: ZooPeeker,
+        call_soon,
+        clock: typing.Callable[[], datetime.datetime] = datetime.datetime.now,
+        event_queue: queue.Queue | None = None,
+    ):
+        """
+        clock returns the current naive local time, and event_queue receives
+        notifications. Both can be replaced for simulations (see refreshsim.py).
+        """
         self.zpk = zpk
         self.call_soon = call_soon
-        self.queue = queue.Queue()
+        self.clock = clock
+        self.queue = queue.Queue() if event_queue is None else event_queue
         self.keep_running = threading.Event()
         self.keep_running.set()
+        self.todo_refresh_delay = datetime.timedelta(seconds=30)
+        """How long after a todo's time to refresh"""
+        self.todo_coalesce_window = datetime.timedelta(minutes=5)
+        """Planned refreshes of a user closer than this are merged into the last one"""
+        self.min_wait_after_activity = datetime.timedelta(seconds=10)
+        """Refresh this long after activity, pushed back by more activity..."""
+        self.max_wait_after_activity = datetime.timedelta(minutes=1)
+        """...but no later than this after the first activity"""
+        self.full_refresh_interval = datetime.timedelta(hours=6)
+        """
+        Refreshes only fetch the user's current profile (what activity is about),
+        and all profiles at most this often
+        """
+        self.last_full_refresh_lock = threading.Lock()
+        """For the two dicts below, also updated by refreshes (off this thread)"""
+        self.last_full_refresh_by_user: dict[object, datetime.datetime] = dict()
+        self.listed_profiles_by_user: dict[object, frozenset[str]] = dict()
+        """
+        The profiles the user's base profile listed at the last full refresh.
+        Current profile refreshes don't add new profiles, a full refresh is forced
+        when the base profile lists more
+        """
+        self.max_slowdown = 6.0
+        """
+        full_refresh_interval is for users whose refreshes always change something,
+        and is stretched up to this factor for users whose refreshes never do
+        """
+        self.max_debounce_slowdown = 3.0
+        """
+        Same for min_wait_after_activity, which never stretches past
+        max_wait_after_activity: the user is around and expects fresh data
+        """
+        self.change_rate_alpha = 0.2
+        """Weight of the latest refresh in a user's change rate"""
+        self.change_rate_lock = threading.Lock()
+        self.change_rate_by_user: dict[object, float] = dict()
+        """EWMA of whether refreshes changed the user's data, 1 until known"""
+
+        self.refresh_range_by_user: dict[
+            object, tuple[datetime.datetime, datetime.datetime]
+        ] = dict()
+        # sorted, coalesced
+        self.planned_refreshes_by_user: dict[object, list[datetime.datetime]] = dict()
+        self.todo_refreshes_by_user: dict[
+            object, dict[int, list[datetime.datetime]]
+        ] = dict()
+        """The refreshes planned for each profile's todos, by profile id"""
 
     def notify_activity(self, user: User):
         print("notify_activity", user)
-        self.queue.put(user)
+        self.queue.put((user, None, None))
+
+    def notify_todos(self, user: User, profile_id: int, todo_things: list[TodoThing]):
+        """
+        Plans refreshing the user's data shortly after each todo of the profile is due,
+        instead of after the profile's previously notified todos.
+        """
+        self.queue.put(
+            (
+                user,
+                profile_id,
+                [
+                    # naive local time, like datetime.datetime.now() in _run
+                    _t.time.astimezone().replace(tzinfo=None) + self.todo_refresh_delay
+                    for _t in todo_things
+                ],
+            )
+        )
 
     def start(self):
+        # Only finds todos if the database was loaded from a snapshot, otherwise
+        # plans start empty and come from notify_todos
+        for user, todo_times_by_profile_id in self.zpk.get_todo_times_by_user().items():
+            for profile_id, todo_times in todo_times_by_profile_id.items():
+                self.queue.put(
+                    (
+                        user,
+                        profile_id,
+                        [_t + self.todo_refresh_delay for _t in todo_times],
+                    )
+                )
         self.thread = threading.Thread(
             target=self._run,
             name=repr(self),
@@ -381,84 +1411,672 @@ class ZooPeekerDataRefresher:
         self.queue.put(None)
         self.thread.join()
 
-    def _refresh_impl(self, user):
+    def _refresh_impl(
+        self,
+        user,
+        fetch_future: concurrent.futures.Future | None,
+        only_current_profile: bool,
+    ):
         try:
-            self.zpk.refresh_user_data(user)
+            fetched = None if fetch_future is None else fetch_future.result()
+            with zooapi.request_priority(zooapi.RequestPriority.BACKGROUND):
+                changed = self.zpk.refresh_user_data(
+                    user, fetched, only_current_profile
+                )
         except:
             print("_refresh_impl: refresh_user_data failed, rescheduling", user)
+            if not only_current_profile:
+                # Retry refreshing all profiles
+                with self.last_full_refresh_lock:
+                    self.last_full_refresh_by_user.pop(user, None)
             self.notify_activity(user)
             raise
+        self.record_refresh_outcome(user, changed)
+
+        base = user.last_profile_data
+        listed_profiles = frozenset(() if base is None else base.profiles)
+        with self.last_full_refresh_lock:
+            if only_current_profile:
+                has_new_profiles = (
+                    not listed_profiles
+                    <= self.listed_profiles_by_user.get(user, listed_profiles)
+                )
+                if has_new_profiles:
+                    self.last_full_refresh_by_user.pop(user, None)
+            else:
+                has_new_profiles = False
+                self.listed_profiles_by_user[user] = listed_profiles
+        if has_new_profiles:
+            print("_refresh_impl: new profiles, rescheduling a full refresh", user)
+            zoometrics.incr("refresher_refreshes_new_profiles")
+            self.notify_activity(user)
 
-    def _call_refresh_sync(self, user):
-        print("_call_refresh_sync", user)
-        self.call_soon(self._refresh_impl, user)
+    def record_refresh_outcome(self, user, changed: bool):
+        """Thread-safe, updates the user's change rate"""
+        zoometrics.incr(
+            "refresher_refreshes_changed"
+            if changed
+            else "refresher_refreshes_unchanged"
+        )
+        with self.change_rate_lock:
+            change_rate = self.change_rate_by_user.get(user, 1.0)
+            self.change_rate_by_user[user] = change_rate + self.change_rate_alpha * (
+                float(changed) - change_rate
+            )
 
-    def _run(self):
-        min_wait_after_activity = datetime.timedelta(seconds=10)
-        max_wait_after_activity = datetime.timedelta(minutes=1)
+    def slowdown(self, user, max_slowdown: float | None = None):
+        """
+        How much to stretch the user's full_refresh_interval, 1 to max_slowdown
+        (self.max_slowdown if None)
+        """
+        if max_slowdown is None:
+            max_slowdown = self.max_slowdown
+        change_rate = self.change_rate_by_user.get(user, 1.0)
+        return 1 + (1 - change_rate) * (max_slowdown - 1)
+
+    def min_wait(self, user) -> datetime.timedelta:
+        """The user's min_wait_after_activity, see max_debounce_slowdown"""
+        return min(
+            self.min_wait_after_activity
+            * self.slowdown(user, self.max_debounce_slowdown),
+            self.max_wait_after_activity,
+        )
 
-        refresh_range_by_user: dict[
-            object, tuple[datetime.datetime, datetime.datetime]
-        ] = dict()
+    def _call_refresh_sync(self, user):
+        now = self.clock()
+        with self.last_full_refresh_lock:
+            last_full_refresh = self.last_full_refresh_by_user.get(user)
+            only_current_profile = (
+                last_full_refresh is not None
+                and now - last_full_refresh
+                < self.full_refresh_interval * self.slowdown(user)
+            )
+            if not only_current_profile:
+                self.last_full_refresh_by_user[user] = now
+        if only_current_profile:
+            zoometrics.incr("refresher_refreshes_current_profile")
+        else:
+            zoometrics.incr("refresher_refreshes_full")
+        print("_call_refresh_sync", user, "only_current_profile", only_current_profile)
+        fetch_pool = self.zpk.fetch_pool
+        if fetch_pool is None:
+            self.call_soon(self._refresh_impl, user, None, only_current_profile)
+        else:
+            fetch_pool.submit(
+                user.discord_id,
+                user.known_payloads(),
+                zooapi.RequestPriority.BACKGROUND,
+                only_current_profile,
+            ).add_done_callback(
+                lambda fut: self.call_soon(
+                    self._refresh_impl, user, fut, only_current_profile
+                )
+            )
 
+    def _run(self):
         while True:
             try:
-                active_user = self.queue.get(timeout=1)
+                item = self.queue.get(timeout=1)
             except queue.Empty:
-                active_user = None
+                item = None
             if not self.keep_running.is_set():
                 return
-            now = datetime.datetime.now()
-            if active_user is not None:
-                if active_user in refresh_range_by_user:
-                    rr_min, rr_max = refresh_range_by_user[active_user]
-                    rr_min += min_wait_after_activity
-                    if rr_min > rr_max:
-                        rr_min = rr_max
+            self.step(item, self.clock())
+
+    def step(self, item, now: datetime.datetime):
+        """
+        Takes in one notification (None if none) and issues the refreshes due at now.
+        """
+        refresh_range_by_user = self.refresh_range_by_user
+        planned_refreshes_by_user = self.planned_refreshes_by_user
+        active_user = None
+        if item is not None:
+            user, profile_id, todo_refreshes = item
+            if todo_refreshes is None:
+                active_user = user
+            else:
+                todo_refreshes_by_profile_id = self.todo_refreshes_by_user.setdefault(
+                    user, dict()
+                )
+                # The profile's todos as of now, some may be gone
+                todo_refreshes_by_profile_id[profile_id] = todo_refreshes
+                planned_refreshes = self._coalesce_refreshes(
+                    now,
+                    itertools.chain.from_iterable(
+                        todo_refreshes_by_profile_id.values()
+                    ),
+                )
+                if planned_refreshes:
+                    planned_refreshes_by_user[user] = planned_refreshes
                 else:
-                    rr_min = now + min_wait_after_activity
-                    rr_max = now + max_wait_after_activity
-                refresh_range_by_user[active_user] = rr_min, rr_max
-            refresh_users = []
-            for user, (rr_min, rr_max) in refresh_range_by_user.items():
-                if now >= rr_min:
-                    refresh_users.append(user)
-            for refresh_user in refresh_users:
-                refresh_range_by_user.pop(refresh_user)
-                self._call_refresh_sync(refresh_user)
+                    planned_refreshes_by_user.pop(user, None)
+        if active_user is not None:
+            min_wait = self.min_wait(active_user)
+            if active_user in refresh_range_by_user:
+                rr_min, rr_max = refresh_range_by_user[active_user]
+                rr_min += min_wait
+                if rr_min > rr_max:
+                    rr_min = rr_max
+            else:
+                rr_min = now + min_wait
+                rr_max = now + self.max_wait_after_activity
+            refresh_range_by_user[active_user] = rr_min, rr_max
+        refresh_users = []
+        for user, (rr_min, rr_max) in refresh_range_by_user.items():
+            if now >= rr_min:
+                refresh_users.append(user)
+        for user, planned_refreshes in planned_refreshes_by_user.items():
+            if now >= planned_refreshes[0]:
+                refresh_users.append(user)
+        for refresh_user in set(refresh_users):
+            refresh_range_by_user.pop(refresh_user, None)
+            planned_refreshes = [
+                _t for _t in planned_refreshes_by_user.pop(refresh_user, []) if _t > now
+            ]
+            if planned_refreshes:
+                planned_refreshes_by_user[refresh_user] = planned_refreshes
+            self._call_refresh_sync(refresh_user)
+
+    def _coalesce_refreshes(
+        self,
+        now: datetime.datetime,
+        planned_refreshes: typing.Iterable[datetime.datetime],
+    ):
+        coalesced: list[datetime.datetime] = []
+        for _t in sorted(planned_refreshes):
+            if _t <= now:
+                continue
+            if coalesced and _t - coalesced[-1] <= self.todo_coalesce_window:
+                # refresh once after the last of nearby todos
+                coalesced[-1] = _t
+            else:
+                coalesced.append(_t)
+        return coalesced
+
+
+class ZooPeekerTodoIngester:
+    """
+    Resolves which profile parsed todos belong to and stores them,
+    off the event loop.
+    """
+
+    def __init__(self, zpk: ZooPeeker, refresher: ZooPeekerDataRefresher | None = None):
+        """refresher, if any, is told about the todos once they're stored"""
+        self.zpk = zpk
+        self.refresher = refresher
+        self.queue = queue.Queue()
+
+    def submit(self, user: User, todo_things: list[TodoThing]):
+        self.queue.put((user, todo_things))
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self._run,
+            name=repr(self),
+        )
+        self.thread.start()
+
+    def stop(self):
+        """Stops once the todos submitted so far are stored"""
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            user, todo_things = item
+            try:
+                with zooapi.request_priority(zooapi.RequestPriority.BACKGROUND):
+                    profile_id = self.zpk.resolve_current_profile_id(user)
+            except:
+                print("ZooPeekerTodoIngester: failed to resolve profile", user)
+                traceback.print_exc()
+                continue
+            if profile_id is None:
+                continue
+            try:
+                self.zpk.set_profile_todos(profile_id, todo_things)
+            except:
+                print("ZooPeekerTodoIngester: failed to store todos", user)
+                traceback.print_exc()
+                continue
+            if self.refresher is not None:
+                self.refresher.notify_todos(user, profile_id, todo_things)
+
+
+@dataclasses.dataclass(eq=False)
+class TodoTimer:
+    user: User
+    profile_id: int
+    todo_thing: TodoThing
+    rounds: int
+    """Times to go around the wheel before being due"""
+    cancelled: bool = False
+
+
+class TodoTimerWheel:
+    """
+    Hashed timer wheel of upcoming todos: scheduling and cancelling are O(1),
+    advancing costs one slot per tick elapsed.
+    """
+
+    def __init__(self, tick: float = 1, n_slots: int = 4096):
+        self.tick = tick
+        """Seconds per slot"""
+        self.slots: list[list[TodoTimer]] = [[] for _ in range(n_slots)]
+        self.current_tick = int(time.time() / tick)
+        self.timers_by_profile_id: dict[int, list[TodoTimer]] = dict()
+        self.n_timers = 0
+        self.lock = threading.Lock()
+
+    def set_profile_todos(
+        self, user: User, profile_id: int, todo_things: list[TodoThing]
+    ):
+        """Replaces the timers of the profile, todos already due are dropped"""
+        now = time.time()
+        with self.lock:
+            for timer in self.timers_by_profile_id.pop(profile_id, []):
+                # Removed from its slot lazily, when reached
+                timer.cancelled = True
+                self.n_timers -= 1
+            timers = []
+            for todo_thing in todo_things:
+                due = todo_thing.time.timestamp()
+                if due <= now:
+                    continue
+                expiry_tick = max(math.ceil(due / self.tick), self.current_tick + 1)
+                timer = TodoTimer(
+                    user,
+                    profile_id,
+                    todo_thing,
+                    (expiry_tick - self.current_tick - 1) // len(self.slots),
+                )
+                self.slots[expiry_tick % len(self.slots)].append(timer)
+                timers.append(timer)
+            if timers:
+                self.timers_by_profile_id[profile_id] = timers
+                self.n_timers += len(timers)
+            zoometrics.set_gauge("todo_timers_scheduled", self.n_timers)
+
+    def advance(self, now: float | None = None):
+        """Returns the timers that became due since the last call"""
+        if now is None:
+            now = time.time()
+        target_tick = int(now / self.tick)
+        due_timers: list[TodoTimer] = []
+        with self.lock:
+            while self.current_tick < target_tick:
+                self.current_tick += 1
+                i = self.current_tick % len(self.slots)
+                kept_timers = []
+                for timer in self.slots[i]:
+                    if timer.cancelled:
+                        continue
+                    if timer.rounds > 0:
+                        timer.rounds -= 1
+                        kept_timers.append(timer)
+                    else:
+                        due_timers.append(timer)
+                self.slots[i] = kept_timers
+            for timer in due_timers:
+                timers = self.timers_by_profile_id[timer.profile_id]
+                timers.remove(timer)
+                if not timers:
+                    del self.timers_by_profile_id[timer.profile_id]
+            self.n_timers -= len(due_timers)
+            zoometrics.set_gauge("todo_timers_scheduled", self.n_timers)
+        zoometrics.incr("todo_reminders_due", len(due_timers))
+        return due_timers
+
+
+def payload_hash(data_str: str):
+    return hashlib.blake2b(data_str.encode(), digest_size=16).hexdigest()
+
+
+@dataclasses.dataclass
+class KnownPayloads:
+    """What was last stored for a user, see User.known_payloads"""
+
+    base_hash: str | None
+    base_profile_id: str | None
+    base_profiles: list[str]
+    hash_by_profile_zoo_id: dict[str, str]
+
+
+@dataclasses.dataclass
+class UserProfilesFetch:
+    base: zooapi.ZooProfileData | None
+    """The user's current profile, None if unchanged (same payload as known)"""
+    base_hash: str
+    pds: dict[str, zooapi.ZooProfileData | None]
+    """The user's changed profiles by profile zoo id, None if unavailable"""
+    unchanged_profile_zoo_ids: set[str]
+    """Profiles whose payload is the same as known, they were not parsed"""
+    data_hashes: dict[str, str]
+    """payload_hash of each profile in pds that isn't None"""
+
+
+def fetch_user_profiles(
+    zapic: zooapi.ZooAPIContext,
+    discord_id: int,
+    known: KnownPayloads | None = None,
+    only_current_profile: bool = False,
+):
+    """
+    With only_current_profile, the other profiles aren't fetched: ZooPeeker then
+    only updates the current profile, and doesn't add new other profiles yet.
+    """
+    if known is None:
+        known = KnownPayloads(None, None, [], dict())
+    pds: dict[str, zooapi.ZooProfileData | None] = dict()
+    unchanged_profile_zoo_ids: set[str] = set()
+    data_hashes: dict[str, str] = dict()
+
+    id = str(discord_id)
+    data_str = zapic.get_profile_data_str(id)
+    base_hash = payload_hash(data_str)
+    if base_hash == known.base_hash:
+        base_pd = None
+        base_profile_id = known.base_profile_id
+        base_profiles = known.base_profiles
+        unchanged_profile_zoo_ids.add(base_profile_id)
+    else:
+        base_pd = zooapi.parse_profile_data(data_str, id)
+        base_profile_id = base_pd.profile_id
+        base_profiles = base_pd.profiles
+        if known.hash_by_profile_zoo_id.get(base_profile_id) == base_hash:
+            unchanged_profile_zoo_ids.add(base_profile_id)
+        else:
+            pds[base_profile_id] = base_pd
+            data_hashes[base_profile_id] = base_hash
+
+    for profile_zoo_id in [] if only_current_profile else base_profiles:
+        if profile_zoo_id == base_profile_id:
+            continue
+        id = f"{discord_id}_{profile_zoo_id}"
+        data_str = zapic.get_profile_data_str(id)
+        data_hash = payload_hash(data_str)
+        if known.hash_by_profile_zoo_id.get(profile_zoo_id) == data_hash:
+            unchanged_profile_zoo_ids.add(profile_zoo_id)
+            continue
+        try:
+            pd = zooapi.parse_profile_data(data_str, id)
+        except zooapi.ProfileDataUnavailableError as e:
+            pd = None
+        else:
+            assert pd.profile_id == profile_zoo_id
+            data_hashes[profile_zoo_id] = data_hash
+        pds[profile_zoo_id] = pd
+    return UserProfilesFetch(
+        base_pd, base_hash, pds, unchanged_profile_zoo_ids, data_hashes
+    )
+
+
+def _fetch_worker_main(
+    job_queue: multiprocessing.Queue, result_queue, rate: float, burst: int
+):
+    zooapi.rate_limiter.configure(rate, burst)
+    zapic = zooapi.ZooAPIContext()
+    while True:
+        job = job_queue.get()
+        if job is None:
+            return
+        job_id, discord_id, known, priority, only_current_profile = job
+        try:
+            with zooapi.request_priority(priority):
+                fetched = fetch_user_profiles(
+                    zapic, discord_id, known, only_current_profile
+                )
+        except BaseException as e:
+            try:
+                pickle.dumps(e)
+            except Exception:
+                e = Exception("".join(traceback.format_exception(e)))
+            result_queue.put((job_id, False, e))
+        else:
+            # Only send back what ZooPeeker uses, not the parsed json
+            fetched = dataclasses.replace(
+                fetched,
+                base=(
+                    None
+                    if fetched.base is None
+                    else dataclasses.replace(fetched.base, data=None)
+                ),
+                pds={
+                    profile_zoo_id: (
+                        None if pd is None else dataclasses.replace(pd, data=None)
+                    )
+                    for profile_zoo_id, pd in fetched.pds.items()
+                },
+            )
+            result_queue.put((job_id, True, fetched))
+
+
+class ZooPeekerFetchPool:
+    """
+    Fetches and parses users' profiles in worker processes, each with its own
+    ZooAPIContext. Users are sharded across workers by discord id.
+    Results are applied to the database by the caller (see ZooPeeker's fetched=).
+
+    The rate limit is split evenly between the workers and the main process,
+    so the total stays within zooapi.rate_limiter's configured rate.
+    """
+
+    def __init__(self, n_workers: int):
+        assert n_workers > 0
+        self.n_workers = n_workers
+        self.futures_by_job_id: dict[int, concurrent.futures.Future] = dict()
+        self.futures_lock = threading.Lock()
+        self.job_ids = itertools.count()
+
+    def start(self):
+        # spawn rather than fork, the parent has threads (discord, refresher...)
+        mp_context = multiprocessing.get_context("spawn")
+        self.result_queue = mp_context.Queue()
+        self.job_queues = []
+        self.processes = []
+        rate_share = zooapi.rate_limiter.rate / (self.n_workers + 1)
+        burst_share = max(1, zooapi.rate_limiter.burst // (self.n_workers + 1))
+        zooapi.rate_limiter.configure(rate_share, burst_share)
+        for i in range(self.n_workers):
+            job_queue = mp_context.Queue()
+            process = mp_context.Process(
+                target=_fetch_worker_main,
+                args=(job_queue, self.result_queue, rate_share, burst_share),
+                name=f"{self.__class__.__name__}-{i}",
+                daemon=True,
+            )
+            process.start()
+            self.job_queues.append(job_queue)
+            self.processes.append(process)
+        self.collector_thread = threading.Thread(
+            target=self._collect,
+            name=repr(self),
+        )
+        self.collector_thread.start()
+
+    def stop(self):
+        for job_queue in self.job_queues:
+            job_queue.put(None)
+        for process in self.processes:
+            process.join()
+        self.result_queue.put(None)
+        self.collector_thread.join()
+
+    def submit(
+        self,
+        discord_id: int,
+        known: KnownPayloads | None = None,
+        priority: zooapi.RequestPriority = zooapi.RequestPriority.INTERACTIVE,
+        only_current_profile: bool = False,
+    ) -> concurrent.futures.Future[UserProfilesFetch]:
+        fut = concurrent.futures.Future()
+        job_id = next(self.job_ids)
+        with self.futures_lock:
+            self.futures_by_job_id[job_id] = fut
+        shard = zlib.crc32(str(discord_id).encode()) % self.n_workers
+        self.job_queues[shard].put(
+            (job_id, discord_id, known, priority, only_current_profile)
+        )
+        return fut
+
+    def _collect(self):
+        while True:
+            result = self.result_queue.get()
+            if result is None:
+                return
+            job_id, ok, value = result
+            with self.futures_lock:
+                fut = self.futures_by_job_id.pop(job_id)
+            if ok:
+                fut.set_result(value)
+            else:
+                fut.set_exception(value)
 
 
 class ZooPeeker:
-    def __init__(self, dbh: DatabaseHandler):
+    def __init__(
+        self,
+        dbh: DatabaseHandler,
+        fetch_pool: ZooPeekerFetchPool | None = None,
+        archive: zooarchive.PayloadArchive | None = None,
+    ):
         self.dbh = dbh
+        self.fetch_pool = fetch_pool
+        self.archive = archive
         self.users_by_discord_id: dict[int, User] = dict()
+        self.user_by_profile_id: dict[int, User] = dict()
+        """Owner of each known profile, only used on the writer thread"""
+        self.adding_users_lock = threading.Lock()
+        self.adding_user_futures: dict[int, concurrent.futures.Future[User]] = dict()
+        """In-flight add_user calls, joined by concurrent adds of the same user"""
         self.zapic_main = zooapi.ZooAPIContext()
+        self.todo_wheel = TodoTimerWheel()
+        """Upcoming todos, for reminders (see pop_due_todos)"""
+        self.zoo_matrix = dbh.submit_write(
+            zoostats.ZooMatrix.from_db, dbh.con_rw, dbh.animal_ids
+        ).result()
+        dbh.submit_write(self._load_users_from_db).result()
+
+    def _load_users_from_db(self):
+        """Loads the users already in the database (e.g. from a snapshot)"""
+        profiles_by_user_id: dict[int, list[tuple[str, int, str | None]]] = dict()
+        for user_id, profile_zoo_id, profile_id, data_hash in self.dbh.con_rw.execute(
+            "SELECT user_id, profile_zoo_id, profile_id, data_hash FROM profiles"
+        ):
+            profiles_by_user_id.setdefault(user_id, []).append(
+                (profile_zoo_id, profile_id, data_hash)
+            )
+        for user_id, discord_id, user_name in self.dbh.con_rw.execute(
+            "SELECT user_id, discord_id, user_name FROM users"
+        ):
+            discord_id = int(discord_id)
+            profiles = profiles_by_user_id.get(user_id, [])
+            user = User(
+                user_name,
+                discord_id,
+                user_id,
+                {
+                    profile_zoo_id: profile_id
+                    for profile_zoo_id, profile_id, data_hash in profiles
+                },
+            )
+            user.data_hash_by_profile_zoo_id = {
+                profile_zoo_id: data_hash
+                for profile_zoo_id, profile_id, data_hash in profiles
+                if data_hash is not None
+            }
+            self.users_by_discord_id[discord_id] = user
+            for profile_id in user.profile_id_by_profile_zoo_id.values():
+                self.user_by_profile_id[profile_id] = user
+        if self.users_by_discord_id:
+            print("Loaded", len(self.users_by_discord_id), "users from the database")
+
+        todo_things_by_profile_id: dict[int, list[TodoThing]] = dict()
+        for profile_id, emoji, thing, utctimestamp in self.dbh.con_rw.execute(
+            "SELECT profile_id, emoji, thing, utctimestamp FROM todos"
+            " WHERE utctimestamp > ?",
+            (time.time(),),
+        ):
+            todo_things_by_profile_id.setdefault(profile_id, []).append(
+                TodoThing(
+                    emoji,
+                    thing,
+                    datetime.datetime.fromtimestamp(utctimestamp, datetime.UTC),
+                )
+            )
+        for profile_id, todo_things in todo_things_by_profile_id.items():
+            user = self.user_by_profile_id.get(profile_id)
+            if user is not None:
+                self.todo_wheel.set_profile_todos(user, profile_id, todo_things)
 
     def get_user(self, discord_id: int):
         return self.users_by_discord_id.get(discord_id)
 
-    def add_user(self, discord_id: int, user_name: str, user_display_name: str):
-        if discord_id in self.users_by_discord_id:
-            raise Exception(
-                "User already added", discord_id, user_name, user_display_name
-            )
+    def add_user(
+        self,
+        discord_id: int,
+        user_name: str,
+        user_display_name: str,
+        fetched: UserProfilesFetch | None = None,
+    ):
+        """
+        Adds the user, or returns them if already added.
+        Concurrent adds of the same user share one fetch.
+        """
+        with self.adding_users_lock:
+            user = self.users_by_discord_id.get(discord_id)
+            if user is not None:
+                return user
+            add_future = self.adding_user_futures.get(discord_id)
+            if add_future is None:
+                add_future = concurrent.futures.Future()
+                self.adding_user_futures[discord_id] = add_future
+                is_adding = True
+            else:
+                is_adding = False
+        if not is_adding:
+            return add_future.result()
 
         try:
-            pd = self.zapic_main.get_profile_data(str(discord_id))
-        except zooapi.ProfileDataUnavailableError as e:
+            if fetched is None:
+                fetched = fetch_user_profiles(self.zapic_main, discord_id)
+            self._archive_fetched(discord_id, user_name, fetched)
+            user = self.dbh.submit_write(
+                self._add_user_impl, discord_id, user_name, user_display_name, fetched
+            ).result()
+        except BaseException as e:
+            add_future.set_exception(e)
             raise
-        pds = {pd.profile_id: pd}
-        unavailable_profiles = []
-        for profile_zoo_id in pd.profiles:
-            if profile_zoo_id in pds:
-                continue
-            try:
-                pd = self.zapic_main.get_profile_data(f"{discord_id}_{profile_zoo_id}")
-            except zooapi.ProfileDataUnavailableError as e:
-                unavailable_profiles.append(profile_zoo_id)
-            else:
-                assert pd.profile_id == profile_zoo_id
-                pds[profile_zoo_id] = pd
+        else:
+            add_future.set_result(user)
+            return user
+        finally:
+            with self.adding_users_lock:
+                del self.adding_user_futures[discord_id]
+
+    def _add_user_impl(
+        self,
+        discord_id: int,
+        user_name: str,
+        user_display_name: str,
+        fetched: UserProfilesFetch,
+    ):
+        user = self.users_by_discord_id.get(discord_id)
+        if user is not None:
+            return user
+
+        assert fetched.base is not None
+        pds = {
+            profile_zoo_id: pd
+            for profile_zoo_id, pd in fetched.pds.items()
+            if pd is not None
+        }
+        unavailable_profiles = [
+            profile_zoo_id for profile_zoo_id, pd in fetched.pds.items() if pd is None
+        ]
 
         with self.dbh.transaction():
             user_id = self.dbh.add_user(str(discord_id), user_name, user_display_name)
@@ -467,7 +2085,9 @@ class ZooPeeker:
             for pd in pds.values():
                 profile_zoo_id = pd.profile_id
 
-                profile_id = self._add_profile(user_id, profile_zoo_id, pd)
+                profile_id = self._add_profile(
+                    user_id, profile_zoo_id, pd, fetched.data_hashes[profile_zoo_id]
+                )
 
                 profile_id_by_profile_zoo_id[profile_zoo_id] = profile_id
 
@@ -480,13 +2100,41 @@ class ZooPeeker:
                     dict(),
                     dict(),
                 )
+                self.dbh.on_commit(
+                    self.zoo_matrix.set_profile, profile_id, user_id, dict(), dict()
+                )
                 profile_id_by_profile_zoo_id[profile_zoo_id] = profile_id
 
         user = User(user_name, discord_id, user_id, profile_id_by_profile_zoo_id)
-        self.users_by_discord_id[discord_id] = user
+        user.last_profile_data = fetched.base
+        user.last_profile_data_hash = fetched.base_hash
+        user.data_hash_by_profile_zoo_id = fetched.data_hashes.copy()
+        self.dbh.on_commit(self.users_by_discord_id.__setitem__, discord_id, user)
+        self.dbh.on_commit(
+            self.user_by_profile_id.update,
+            dict.fromkeys(profile_id_by_profile_zoo_id.values(), user),
+        )
 
         return user
 
+    def _archive_fetched(
+        self, discord_id: int, user_name: str, fetched: UserProfilesFetch
+    ):
+        """
+        Archives the payloads that changed. Called once per fetch, before the write
+        is submitted, so the file I/O isn't part of the write (which may be retried)
+        """
+        if self.archive is None:
+            return
+        base_profile_id = None
+        if fetched.base is not None:
+            base_profile_id = fetched.base.profile_id
+            self.archive.append(discord_id, user_name, None, fetched.base.data_str)
+        for profile_zoo_id, pd in fetched.pds.items():
+            if pd is None or profile_zoo_id == base_profile_id:
+                continue
+            self.archive.append(discord_id, user_name, profile_zoo_id, pd.data_str)
+
     def _pd_to_amounts(self, pd: zooapi.ZooProfileData):
         animals_amount = pd.animals.copy()
         if pd.animal_on_quest:
@@ -499,7 +2147,11 @@ class ZooPeeker:
         return animals_amount, animals_amount_now
 
     def _add_profile(
-        self, user_id: int, profile_zoo_id: str, pd: zooapi.ZooProfileData
+        self,
+        user_id: int,
+        profile_zoo_id: str,
+        pd: zooapi.ZooProfileData,
+        data_hash: str,
     ):
         profile_icon = pd.profile_icon
         if profile_icon is None:
@@ -514,96 +2166,233 @@ class ZooPeeker:
             profile_icon,
             animals_amount,
             animals_amount_now,
+            data_hash,
+        )
+        self.dbh.on_commit(
+            self.zoo_matrix.set_profile,
+            profile_id,
+            user_id,
+            animals_amount,
+            animals_amount_now,
         )
 
         return profile_id
 
-    def _update_profile(self, profile_id: int, pd: zooapi.ZooProfileData):
+    def _update_profile(
+        self,
+        user_id: int,
+        profile_id: int,
+        pd: zooapi.ZooProfileData,
+        data_hash: str,
+    ):
         profile_icon = pd.profile_icon
         if profile_icon is None:
             profile_icon = "👤"
 
         animals_amount, animals_amount_now = self._pd_to_amounts(pd)
 
-        profile_id = self.dbh.update_profile(
+        self.dbh.update_profile(
             profile_id,
             pd.profile_name,
             profile_icon,
             animals_amount,
             animals_amount_now,
+            data_hash,
+        )
+        self.dbh.on_commit(
+            self.zoo_matrix.set_profile,
+            profile_id,
+            user_id,
+            animals_amount,
+            animals_amount_now,
         )
 
-    def refresh_user_data(self, user: User):
-        try:
-            pd = self.zapic_main.get_profile_data(str(user.discord_id))
-        except zooapi.ProfileDataUnavailableError as e:
-            raise
-        pds = {pd.profile_id: pd}
+    def refresh_user_data(
+        self,
+        user: User,
+        fetched: UserProfilesFetch | None = None,
+        only_current_profile: bool = False,
+    ):
+        """
+        Fetches (unless fetched is given) and stores the user's profiles.
+        only_current_profile leaves the other profiles as they are,
+        see fetch_user_profiles.
+        Returns whether any profile was added, removed or changed.
+        """
+        if fetched is None:
+            fetched = fetch_user_profiles(
+                self.zapic_main,
+                user.discord_id,
+                user.known_payloads(),
+                only_current_profile,
+            )
+        self._archive_fetched(user.discord_id, user.name, fetched)
+        return self.dbh.submit_write(
+            self._refresh_user_data_impl, user, fetched
+        ).result()
+
+    def _refresh_user_data_impl(self, user: User, fetched: UserProfilesFetch):
+        pd = fetched.base if fetched.base is not None else user.last_profile_data
+        pds = fetched.pds
+
+        n_unchanged = len(fetched.unchanged_profile_zoo_ids)
+        n_fetched = len(pds) + n_unchanged
+        zoometrics.incr("refresh_profiles_fetched", n_fetched)
+        zoometrics.incr("refresh_profiles_unchanged", n_unchanged)
+        if n_unchanged != 0:
+            print(
+                "refresh_user_data:",
+                user,
+                f"{n_unchanged}/{n_fetched} profiles unchanged, skipped",
+            )
 
+        # From the database, which (unlike user, updated on commit) includes
+        # the writes batched before this one
+        profile_id_by_profile_zoo_id: dict[str, int] = dict(
+            self.dbh.con_rw.execute(
+                "SELECT profile_zoo_id, profile_id FROM profiles WHERE user_id = ?",
+                (user.user_id,),
+            )
+        )
         updated_profile_zoo_ids = set(pd.profiles)
-        known_profile_zoo_ids = set(user.profile_id_by_profile_zoo_id.keys())
+        known_profile_zoo_ids = set(profile_id_by_profile_zoo_id.keys())
         new_profile_zoo_ids = updated_profile_zoo_ids - known_profile_zoo_ids
         removed_profile_zoo_ids = known_profile_zoo_ids - updated_profile_zoo_ids
-        updated_profile_id_by_profile_zoo_id = user.profile_id_by_profile_zoo_id.copy()
+        added_profile_id_by_profile_zoo_id: dict[str, int] = dict()
+        updated_data_hashes: dict[str, str] = dict()
         with self.dbh.transaction():
             for new_profile_zoo_id in new_profile_zoo_ids:
                 pd = pds.get(new_profile_zoo_id)
                 if pd is None:
-                    try:
-                        pd = self.zapic_main.get_profile_data(
-                            f"{user.discord_id}_{new_profile_zoo_id}"
-                        )
-                    except zooapi.ProfileDataUnavailableError as e:
-                        pass
-                    pds[new_profile_zoo_id] = pd
-                    if pd is None:
-                        continue
-                profile_id = self._add_profile(user.user_id, new_profile_zoo_id, pd)
-                updated_profile_id_by_profile_zoo_id[new_profile_zoo_id] = profile_id
+                    continue
+                data_hash = fetched.data_hashes[new_profile_zoo_id]
+                profile_id = self._add_profile(
+                    user.user_id, new_profile_zoo_id, pd, data_hash
+                )
+                added_profile_id_by_profile_zoo_id[new_profile_zoo_id] = profile_id
+                updated_data_hashes[new_profile_zoo_id] = data_hash
             for removed_profile_zoo_id in removed_profile_zoo_ids:
-                self.dbh.remove_profile(
-                    updated_profile_id_by_profile_zoo_id[removed_profile_zoo_id]
+                removed_profile_id = profile_id_by_profile_zoo_id[
+                    removed_profile_zoo_id
+                ]
+                self.dbh.remove_profile(removed_profile_id)
+                self.dbh.on_commit(self.zoo_matrix.remove_profile, removed_profile_id)
+                self.dbh.on_commit(
+                    self.todo_wheel.set_profile_todos, user, removed_profile_id, []
                 )
-                del updated_profile_id_by_profile_zoo_id[removed_profile_zoo_id]
-        user.profile_id_by_profile_zoo_id = updated_profile_id_by_profile_zoo_id
 
         kept_profile_zoo_ids = updated_profile_zoo_ids & known_profile_zoo_ids
         with self.dbh.transaction():
             for profile_zoo_id in kept_profile_zoo_ids:
+                if profile_zoo_id in fetched.unchanged_profile_zoo_ids:
+                    continue
                 pd = pds.get(profile_zoo_id)
                 if pd is None:
-                    try:
-                        pd = self.zapic_main.get_profile_data(
-                            f"{user.discord_id}_{profile_zoo_id}"
-                        )
-                    except zooapi.ProfileDataUnavailableError as e:
-                        pass
-                    pds[profile_zoo_id] = pd
-                    if pd is None:
-                        continue
+                    continue
+                data_hash = fetched.data_hashes[profile_zoo_id]
                 self._update_profile(
-                    user.profile_id_by_profile_zoo_id[profile_zoo_id],
+                    user.user_id,
+                    profile_id_by_profile_zoo_id[profile_zoo_id],
                     pd,
+                    data_hash,
                 )
+                updated_data_hashes[profile_zoo_id] = data_hash
+
+        def update_user():
+            if fetched.base is not None:
+                user.last_profile_data = fetched.base
+                user.last_profile_data_hash = fetched.base_hash
+            # Replaced rather than changed in place, other threads read them
+            profile_id_by_profile_zoo_id = user.profile_id_by_profile_zoo_id.copy()
+            data_hash_by_profile_zoo_id = user.data_hash_by_profile_zoo_id.copy()
+            for removed_profile_zoo_id in removed_profile_zoo_ids:
+                removed_profile_id = profile_id_by_profile_zoo_id.pop(
+                    removed_profile_zoo_id, None
+                )
+                self.user_by_profile_id.pop(removed_profile_id, None)
+                data_hash_by_profile_zoo_id.pop(removed_profile_zoo_id, None)
+            profile_id_by_profile_zoo_id.update(added_profile_id_by_profile_zoo_id)
+            for added_profile_id in added_profile_id_by_profile_zoo_id.values():
+                self.user_by_profile_id[added_profile_id] = user
+            data_hash_by_profile_zoo_id.update(updated_data_hashes)
+            user.profile_id_by_profile_zoo_id = profile_id_by_profile_zoo_id
+            user.data_hash_by_profile_zoo_id = data_hash_by_profile_zoo_id
+
+        self.dbh.on_commit(update_user)
+        return bool(removed_profile_zoo_ids or updated_data_hashes)
+
+    def get_todo_times_by_user(self):
+        """
+        Returns the upcoming todo times (naive local time) of each known user,
+        by profile id.
+        """
+        return self.dbh.submit_write(self._get_todo_times_by_user_impl).result()
+
+    def _get_todo_times_by_user_impl(self):
+        todo_times_by_user: dict[User, dict[int, list[datetime.datetime]]] = dict()
+        for profile_id, utctimestamp in self.dbh.con_rw.execute(
+            "SELECT profile_id, utctimestamp FROM todos WHERE utctimestamp > ?",
+            (datetime.datetime.now(datetime.UTC).timestamp(),),
+        ):
+            user = self.user_by_profile_id.get(profile_id)
+            if user is None:
+                continue
+            todo_times_by_user.setdefault(user, dict()).setdefault(
+                profile_id, []
+            ).append(datetime.datetime.fromtimestamp(utctimestamp))
+        return todo_times_by_user
+
+    def resolve_current_profile_id(self, user: User):
+        """
+        Returns the database id of the user's current profile, or None if unknown.
+        Only hits the API if no profile data was fetched for the user yet.
+        Runs off the writer thread, so leaves user (updated on commit) as it is.
+        """
+        pd = user.last_profile_data
+        if pd is None:
+            try:
+                pd = self.zapic_main.get_profile_data(str(user.discord_id))
+            except zooapi.ProfileDataUnavailableError as e:
+                print("Can't resolve current profile for", user, "because", e)
+                return None
+        if pd.profile_id not in user.profile_id_by_profile_zoo_id:
+            print(
+                "Trying to set todos for unknown profile (new profile?), aborting", pd
+            )
+            return None
+        return user.profile_id_by_profile_zoo_id[pd.profile_id]
+
+    def set_profile_todos(
+        self,
+        profile_id: int,
+        todo_things: list[TodoThing],
+    ):
+        self.dbh.submit_write(
+            self._set_profile_todos_impl, profile_id, todo_things
+        ).result()
+
+    def _set_profile_todos_impl(self, profile_id: int, todo_things: list[TodoThing]):
+        with self.dbh.transaction():
+            self.dbh.set_profile_todos(profile_id, todo_things)
+        user = self.user_by_profile_id.get(profile_id)
+        if user is not None:
+            self.dbh.on_commit(
+                self.todo_wheel.set_profile_todos, user, profile_id, todo_things
+            )
+
+    def pop_due_todos(self):
+        """Returns the todos that became due since the last call, as TodoTimers"""
+        return self.todo_wheel.advance()
 
     def set_current_profile_todos(
         self,
         user: User,
         todo_things: list[TodoThing],
     ):
-        try:
-            pd = self.zapic_main.get_profile_data(str(user.discord_id))
-        except zooapi.ProfileDataUnavailableError as e:
-            print("Can't set todos for", user, "because", e)
-            return
-        if pd.profile_id not in user.profile_id_by_profile_zoo_id:
-            print(
-                "Trying to set todos for unknown profile (new profile?), aborting", pd
-            )
+        profile_id = self.resolve_current_profile_id(user)
+        if profile_id is None:
             return
-        profile_id = user.profile_id_by_profile_zoo_id[pd.profile_id]
-        with self.dbh.transaction():
-            self.dbh.set_profile_todos(profile_id, todo_things)
+        self.set_profile_todos(profile_id, todo_things)
 
 
 def main():
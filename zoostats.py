@@ -0,0 +1,164 @@
+# SPDX-FileCopyrightText: 2024 Dragorn421
+# SPDX-License-Identifier: CC0-1.0
+
+from __future__ import annotations
+
+import itertools
+import sqlite3
+import threading
+
+import numpy as np
+
+from zooapi import ZooAnimal, ZooAnimalCommon, ZooAnimalRare
+
+
+ANIMALS: list[ZooAnimal] = list(itertools.chain(ZooAnimalCommon, ZooAnimalRare))
+COL_BY_ANIMAL = {za: i for i, za in enumerate(ANIMALS)}
+IS_RARE = np.array([za.is_rare for za in ANIMALS])
+RARES: list[ZooAnimalRare] = list(ZooAnimalRare)
+RARE_COLS = np.array([COL_BY_ANIMAL[za] for za in RARES])
+COMMON_COLS_OF_RARES = np.array([COL_BY_ANIMAL[za.animal_common] for za in RARES])
+
+
+class ZooMatrix:
+    """
+    Dense profiles x animals matrices of amount and amount_now, mirroring the zoos
+    table in memory for fast cross-user aggregates.
+
+    Rows of removed profiles are recycled. Kept in sync by ZooPeeker's write path,
+    see set_profile and remove_profile.
+    """
+
+    def __init__(self, capacity: int = 64):
+        self.lock = threading.Lock()
+        self.row_by_profile_id: dict[int, int] = dict()
+        self.free_rows: list[int] = []
+        self.n_rows_used = 0
+        self.active = np.zeros(capacity, dtype=bool)
+        self.user_ids = np.zeros(capacity, dtype=np.int64)
+        self.amount = np.zeros((capacity, len(ANIMALS)), dtype=np.int64)
+        self.amount_now = np.zeros((capacity, len(ANIMALS)), dtype=np.int64)
+
+    @classmethod
+    def from_db(cls, con: sqlite3.Connection, animal_ids: dict[ZooAnimal, int]):
+        zm = cls()
+        col_by_animal_id = {
+            animal_id: COL_BY_ANIMAL[za] for za, animal_id in animal_ids.items()
+        }
+        with zm.lock:
+            for profile_id, user_id in con.execute(
+                "SELECT profile_id, user_id FROM profiles"
+            ):
+                zm._alloc_row(profile_id, user_id)
+            for profile_id, animal_id, amount, amount_now in con.execute(
+                "SELECT profile_id, animal_id, amount, amount_now FROM zoos"
+            ):
+                row = zm.row_by_profile_id.get(profile_id)
+                if row is None:
+                    continue
+                col = col_by_animal_id[animal_id]
+                zm.amount[row, col] = amount
+                zm.amount_now[row, col] = amount_now
+        return zm
+
+    def _grow(self):
+        capacity = self.active.shape[0] * 2
+        self.active = np.resize(self.active, capacity)
+        self.active[self.n_rows_used :] = False
+        self.user_ids = np.resize(self.user_ids, capacity)
+        for name in ("amount", "amount_now"):
+            old = getattr(self, name)
+            new = np.zeros((capacity, len(ANIMALS)), dtype=old.dtype)
+            new[: old.shape[0]] = old
+            setattr(self, name, new)
+
+    def _alloc_row(self, profile_id: int, user_id: int):
+        row = self.row_by_profile_id.get(profile_id)
+        if row is None:
+            if self.free_rows:
+                row = self.free_rows.pop()
+            else:
+                if self.n_rows_used == self.active.shape[0]:
+                    self._grow()
+                row = self.n_rows_used
+                self.n_rows_used += 1
+            self.row_by_profile_id[profile_id] = row
+        self.active[row] = True
+        self.user_ids[row] = user_id
+        return row
+
+    def set_profile(
+        self,
+        profile_id: int,
+        user_id: int,
+        animals_amount: dict[ZooAnimal, int],
+        animals_amount_now: dict[ZooAnimal, int],
+    ):
+        with self.lock:
+            row = self._alloc_row(profile_id, user_id)
+            self.amount[row] = 0
+            self.amount_now[row] = 0
+            for za, amount in animals_amount.items():
+                self.amount[row, COL_BY_ANIMAL[za]] = amount
+            for za, amount in animals_amount_now.items():
+                self.amount_now[row, COL_BY_ANIMAL[za]] = amount
+
+    def remove_profile(self, profile_id: int):
+        with self.lock:
+            row = self.row_by_profile_id.pop(profile_id, None)
+            if row is None:
+                return
+            self.active[row] = False
+            self.amount[row] = 0
+            self.amount_now[row] = 0
+            self.free_rows.append(row)
+
+    def _per_user(self, m: np.ndarray):
+        """Sums the rows of m (active rows only) by user. Returns user ids, sums."""
+        active = self.active[: self.n_rows_used]
+        user_ids, inverse = np.unique(
+            self.user_ids[: self.n_rows_used][active], return_inverse=True
+        )
+        sums = np.zeros((user_ids.shape[0], m.shape[1]), dtype=m.dtype)
+        np.add.at(sums, inverse, m[: self.n_rows_used][active])
+        return user_ids, sums
+
+    def totals(self, now: bool = False):
+        """Total of each animal across all profiles, in ANIMALS order."""
+        with self.lock:
+            m = self.amount_now if now else self.amount
+            return m[: self.n_rows_used].sum(axis=0)
+
+    def rare_ratios(self):
+        """For each rare in RARES order: (n commons, n rares, rares / total)."""
+        totals = self.totals()
+        n_rares = totals[RARE_COLS]
+        n_commons = totals[COMMON_COLS_OF_RARES]
+        n = n_rares + n_commons
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ratios = np.where(n > 0, n_rares / n, 0.0)
+        return n_commons, n_rares, ratios
+
+    def completeness(self):
+        """For each user: user ids, number of distinct animals owned, fraction owned."""
+        with self.lock:
+            user_ids, sums = self._per_user(self.amount)
+        n_owned = (sums > 0).sum(axis=1)
+        return user_ids, n_owned, n_owned / len(ANIMALS)
+
+    def user_correlations(self, user_id: int):
+        """
+        Pearson correlation of the user's per-animal amounts with each other user's.
+        Returns user ids, correlations (nan if undefined).
+        """
+        with self.lock:
+            user_ids, sums = self._per_user(self.amount)
+        (i_user,) = np.nonzero(user_ids == user_id)
+        if i_user.shape[0] == 0:
+            return user_ids[:0], np.zeros(0)
+        centered = sums - sums.mean(axis=1, keepdims=True)
+        norms = np.linalg.norm(centered, axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            corrs = (centered @ centered[i_user[0]]) / (norms * norms[i_user[0]])
+        others = user_ids != user_id
+        return user_ids[others], corrs[others]